@@ -1,15 +1,21 @@
 """API"""
 import base64
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps, lru_cache
 import inspect
 import logging
 import pathlib
 import pickle
+import threading
 import time
+import weakref
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import or_, select
+from sqlalchemy.event import listen
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
 from gensim.conf import settings
 from gensim.db import (
@@ -31,7 +37,10 @@ from gensim.db import (
     Buff,
     Command,
     CommandMap,
+    EventLock,
+    make_engine,
 )
+from gensim.graph import EventGraph
 from gensim.log import logged
 
 log = logging.getLogger("global")
@@ -117,22 +126,249 @@ def _get_generic_table(cls_name, event, target, target_property):
     return cls
 
 
+@lru_cache(maxsize=None)
+def _get_generic_children(table_name):
+    """Generic tables whose 'event' is a row of the given table"""
+    return [
+        cls
+        for cls in GENERIC_CLASSES.values()
+        if any(
+            fk.column.table.name == table_name
+            for fk in cls.__table__.c.event_id.foreign_keys
+        )
+    ]
+
+
+class Versions:
+    """
+    Version of every table, bumped when a transaction that wrote to it is
+    committed. The server makes ETags out of them (check gensim.server.conditional).
+
+    :data epoch: Tells apart the versions of every client (game)
+    :data commits: Transactions that wrote something
+    """
+
+    def __init__(self):
+        self.epoch = time.time()
+        self.counters = defaultdict(int)
+        self.modified = {}
+        self.commits = 0
+        self.lock = threading.Lock()
+
+    def bump(self, tables):
+        with self.lock:
+            if tables:
+                self.commits += 1
+            now = time.time()
+            for table in tables:
+                self.counters[table] += 1
+                self.modified[table] = now
+
+    def etag(self, tables):
+        return f"{int(self.epoch * 1000):x}-" + "-".join(
+            str(self.counters[table]) for table in tables
+        )
+
+    def last_modified(self, tables):
+        return max(self.modified.get(table, self.epoch) for table in tables)
+
+
+def written(session, tables):
+    """Note that the transaction of the session writes the tables (check Versions)"""
+    session.info.setdefault("written_tables", set()).update(tables)
+
+
 @logged
 class Client:
-    def __init__(self, url=URL, config=None):
-        config = config or {}
-        self.logger.info("Started %s. Engine: %s", self.__class__.__name__, URL)
+    def __init__(
+        self, url=URL, config=None, transaction_mode=None, profile=None, working=None
+    ):
+        """
+        :param transaction_mode:
+            AUTOCOMMIT to make every statement its own transaction or REQUEST to
+            group them in units of work (check Client.transaction).
+            Defaults to settings.TRANSACTION_MODE
+        :param profile:
+            Storage profile (pragmas) of the connections, check make_engine.
+            Defaults to the one of the default database
+        :param working:
+            memdb.WorkingCopy of the database at url to play on instead of the
+            file
+        """
+        config = dict(config or {})
+        self.transaction_mode = transaction_mode or settings.TRANSACTION_MODE
+        self.logger.info(
+            "Started %s. Engine: %s. Transactions: %s",
+            self.__class__.__name__,
+            URL,
+            self.transaction_mode,
+        )
 
         db_file = pathlib.Path(url.split("///")[-1])
         assert db_file.exists(), f"DB file doesn't exist! {db_file}"
         assert db_file.stat().st_size > 0, "DB file is just an empty file!"
 
-        engine = create_engine(url, isolation_level="AUTOCOMMIT")
-        Session = sessionmaker(bind=engine, **config)  # pylint: --disable=C0103
-        self.session = Session()
+        engine_config = {}
+        if self.transaction_mode == "AUTOCOMMIT":
+            engine_config["isolation_level"] = "AUTOCOMMIT"
+        if working is not None:
+            # its only connection
+            url = "sqlite://"
+            engine_config.update(poolclass=StaticPool, creator=working.connect)
+        else:
+            engine_config.update(poolclass=QueuePool, pool_size=settings.POOL_SIZE)
+        # one engine (and pool) shared by the sessions of every thread
+        self.engine = make_engine(
+            url,
+            profile,
+            connect_args={"check_same_thread": False},
+            **engine_config,
+        )
+        if working is not None:
+            working.attach(self.engine)
+        # shared by every session, check Event.available
+        self.event_graph = EventGraph()
+        config["info"] = {**config.get("info", {}), "event_graph": self.event_graph}
+        self.Session = scoped_session(  # pylint: --disable=C0103
+            sessionmaker(bind=self.engine, **config)
+        )
+
+        # writes made through the ORM (relationships, effects...) are tracked
+        # too; the versions only change once they are committed
+        self.versions = Versions()
+        # sessions of every thread, for Client.memory
+        self._sessions = weakref.WeakSet()
+        # requests served by the game, check Client.release
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+        listen(self.Session, "after_begin", self._track_session)
+        listen(self.Session, "before_flush", self._track_writes)
+        listen(self.Session, "after_commit", self._bump_versions)
+        listen(self.Session, "after_rollback", self._forget_writes)
+
+    @property
+    def session(self):
+        """Session of the current thread"""
+        return self.Session()
+
+    def remove(self):
+        """Close the session of the current thread"""
+        self.Session.remove()
+
+    def close(self):
+        self.Session.remove()
+        self.engine.dispose()
+
+    def release(self):
+        """
+        End of a request. Lifecycle of the session of the current thread: it's
+        closed once the game served settings.SESSION_MAX_REQUESTS requests
+        since it was opened (whatever thread served them) or once its identity
+        map holds settings.SESSION_MAX_OBJECTS objects; otherwise the objects
+        are expunged (if settings.SESSION_EXPUNGE) so they don't pile up.
+        """
+        session = self.session
+        with self._requests_lock:
+            self.requests += 1
+            requests = self.requests
+        served = requests - session.info.setdefault("opened_at", requests - 1)
+        objects = len(session.identity_map)
+        if (
+            served >= settings.SESSION_MAX_REQUESTS
+            or objects >= settings.SESSION_MAX_OBJECTS
+        ):
+            self.logger.debug(
+                "Recycling session (%d requests, %d objects)", served, objects
+            )
+            self.remove()
+        elif settings.SESSION_EXPUNGE:
+            session.expunge_all()
+
+    def memory(self):
+        """Objects held by the sessions of every thread"""
+        sessions = list(self._sessions)
+        return {
+            "sessions": len(sessions),
+            "objects": sum(len(session.identity_map) for session in sessions),
+        }
 
     def __delete__(self, obj):
-        self.session.close()
+        self.close()
+
+    def _track_session(self, session, transaction, connection):
+        self._sessions.add(session)
+        session.info.setdefault("opened_at", self.requests)
+
+    # versions
+    @staticmethod
+    def _track_writes(session, flush_context, instances):
+        written(
+            session,
+            (
+                obj.__tablename__
+                for obj in (*session.new, *session.dirty, *session.deleted)
+            ),
+        )
+
+    def _bump_versions(self, session):
+        self.versions.bump(session.info.pop("written_tables", ()))
+
+    @staticmethod
+    def _forget_writes(session):
+        session.info.pop("written_tables", None)
+
+    # transactions
+    def begin(self):
+        """Open a unit of work. Nested units of work join the outer one"""
+        units = self.session.info.get("units_of_work", 0)
+        self.session.info["units_of_work"] = units + 1
+
+    def end(self, exc=None):
+        """
+        Close the unit of work. Commit if everything went well, rollback otherwise.
+        Notice that in AUTOCOMMIT mode flushed statements can't be rolled back.
+        """
+        info = self.session.info
+        info["units_of_work"] -= 1
+        if exc is not None:
+            # a nested unit of work failed; the outer one can't commit
+            info["rollback_only"] = exc
+        if info["units_of_work"]:
+            return
+        exc = info.pop("rollback_only", None)
+        if exc is None:
+            try:
+                self.session.commit()
+            except BaseException:
+                self.session.rollback()
+                raise
+        else:
+            self.logger.error("Rolling back unit of work. REASON: %s", exc)
+            self.session.rollback()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run everything inside the block in one transaction with one commit at
+        the end.
+        """
+        self.begin()
+        try:
+            yield self.session
+        except BaseException as exc:
+            self.end(exc)
+            raise
+        self.end()
+
+    def commit(self):
+        """
+        Commit now unless we are inside a unit of work; in that case we only flush
+        and the unit of work commits at the end.
+        """
+        if self.session.info.get("units_of_work"):
+            self.session.flush()
+        else:
+            self.session.commit()
 
     # low level
     @loggedmethod
@@ -149,6 +385,7 @@ class Client:
         """Low level insert implementation"""
         obj = Obj(**kwargs)
         self.session.add(obj)
+        written(self.session, (Obj.__tablename__,))
         # self.session.commit()
 
         return obj
@@ -168,6 +405,7 @@ class Client:
             obj = query.update(**kwargs).one()
         else:
             raise AssertionError(f"{obj} is not update-able")
+        written(self.session, (obj.__tablename__,))
 
         return obj
 
@@ -215,7 +453,25 @@ class Client:
 
     # event
     def create_event(self, /, **kwargs):
-        return self._create(Event, **kwargs)
+        event = self._create(Event, **kwargs)
+        if self.event_graph.compiled:
+            activator = kwargs.get("activator")
+            self.event_graph.add_event(
+                event.name,
+                activator.name if activator is not None else event.activator_name,
+            )
+        return event
+
+    def compile_events(self):
+        """
+        Compile the locks and activator chains into an EventGraph so checking
+        if an event is available doesn't traverse them every time.
+        Locks added through the relationships after this are not tracked.
+        """
+        self.event_graph.compile(self.session)
+        self.logger.info("Compiled %s", self.event_graph)
+
+        return self.event_graph
 
     def get_event(self, /, **kwargs):
         return self._get(Event, **kwargs)
@@ -332,6 +588,81 @@ class Client:
         time_stat = self.get_global(label="time").one()
         return self.create_requirement(event, time_stat, "value", **kwargs)
 
+    def _delete_generic(self, table_name, parent_ids):
+        """
+        Set-based DELETE of the generic rows (requirements and effects) hanging
+        from the parents, along with their buffs and dialogs.
+        """
+        for cls in _get_generic_children(table_name):
+            rows = select(cls.id).where(cls.event_id.in_(parent_ids))
+            for related in ("buff", "dialog"):
+                Related = getattr(cls, related, None)  # pylint: --disable=C0103
+                if Related is None:
+                    continue
+                related_ids = select(Related.id).where(Related.parent_id.in_(rows))
+                # buffs have requirements of their own
+                self._delete_generic(Related.__tablename__, related_ids)
+                self.session.query(Related).filter(
+                    Related.parent_id.in_(rows)
+                ).delete(synchronize_session=False)
+            self.session.query(cls).filter(cls.event_id.in_(parent_ids)).delete(
+                synchronize_session=False
+            )
+
+    def prune_events(self, events):
+        """
+        Delete events that are not going to be used again with a handful of
+        statements instead of loading and deleting every row one by one.
+        """
+        if not events:
+            return
+        ids = [event.id for event in events]
+        names = [event.name for event in events]
+        self.logger.info("_PRUNE_ %s", names)
+
+        self.session.flush()
+        # their parents and activators are still around
+        chained = {event.parent_name for event in events}
+        chained |= {event.activator_name for event in events}
+        self._delete_generic(Event.__tablename__, ids)
+        self.session.query(EventLock).filter(
+            or_(EventLock.key.in_(names), EventLock.lock.in_(names))
+        ).delete(synchronize_session=False)
+        # they would be due with no event
+        self.session.query(Schedule).filter(Schedule.event_name.in_(names)).delete(
+            synchronize_session=False
+        )
+        # the events chained to them are on their own now (like in the graph)
+        for column in (Event.parent_name, Event.activator_name):
+            self.session.query(Event).filter(column.in_(names)).update(
+                {column: None}, synchronize_session=False
+            )
+        self.session.query(Event).filter(Event.id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        for event in events:
+            self.session.expunge(event)
+        self._expire_pruned(set(names), chained)
+
+        if self.event_graph.compiled:
+            for name in names:
+                self.event_graph.prune(name)
+
+    def _expire_pruned(self, names, chained):
+        """The bulk statements skip the identity map, fix what they changed"""
+        for obj in list(self.session.identity_map.values()):
+            values = obj.__dict__
+            if isinstance(obj, Schedule) and values.get("event_name") in names:
+                self.session.expunge(obj)
+            elif not isinstance(obj, Event):
+                continue
+            elif {values.get("parent_name"), values.get("activator_name")} & names:
+                self.session.expire(
+                    obj, ["parent_name", "parent", "activator_name", "activator"]
+                )
+            elif values.get("name") in chained:
+                self.session.expire(obj, ["children", "activates"])
+
     def flush_date_requirements(self, event):
         reqs = self.get_date_requirement(event).all()
         for req in reqs:
@@ -456,5 +787,7 @@ class Client:
 
         return obj
 
-    def get_command_map(self, key):
+    def get_command_map(self, key=None):
+        if key is None:
+            return self._get(CommandMap)
         return self._get(CommandMap, key=key.upper())
@@ -0,0 +1,211 @@
+"""
+ASGI (asyncio) serving mode for the API.
+
+The routes are the same ones of gensim.server. The event loop only deals with
+the connections: the views (SQLite and logging I/O) run in a bounded pool of
+threads, so many mostly-idle clients (long polls, the CLI waiting for input)
+don't tie up a thread each.
+
+    gensim runasgi
+
+or with any ASGI server
+
+    uvicorn gensim.asgi:app
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import io
+import json
+import logging
+import sys
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+from gensim.conf import settings
+
+logger = logging.getLogger("user_info." + __name__)
+
+
+def make_environ(scope, body):
+    """WSGI environ for an ASGI http scope"""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    # the whole body has been read already (even if it was chunked)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+class AsyncAPI:
+    """
+    ASGI app running a WSGI app in a bounded thread pool.
+
+    :param wsgi_app: Usually gensim.server.app
+    :param max_workers: Threads running the views
+    """
+
+    def __init__(self, wsgi_app, max_workers=settings.ASYNC_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="gensim-view"
+        )
+
+    async def run(self, function, *args, **kwargs):
+        """Run blocking code in the view pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, partial(function, *args, **kwargs))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.websocket(receive, send)
+        else:
+            logger.warning("Ignoring unsupported ASGI scope %s", scope["type"])
+
+    @staticmethod
+    async def websocket(receive, send):
+        """There are no websocket routes (streams are server-sent events)"""
+        message = await receive()
+        if message["type"] == "websocket.connect":
+            # rejected with a 403 before it's accepted
+            await send({"type": "websocket.close"})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # pylint: --disable=C0415
+                from gensim.server import app as wsgi_app
+
+                await self.run(wsgi_app.games.close_all)
+                self.pool.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        await self.call_wsgi(make_environ(scope, body), send)
+
+    async def call_wsgi(self, environ, send):
+        """
+        The view runs in the pool and hands the response over chunk by chunk so
+        streamed responses are sent as soon as they are produced.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def put(*item):
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        def start_response(status, headers, exc_info=None):
+            put("start", int(status.split(" ", 1)[0]), headers)
+
+        def wsgi():
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put("body", chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            finally:
+                put("end")
+
+        future = loop.run_in_executor(self.pool, wsgi)
+        started = False
+        while True:
+            kind, *data = await queue.get()
+            if kind == "start":
+                status, headers = data
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": status,
+                        "headers": [
+                            (key.lower().encode("latin-1"), value.encode("latin-1"))
+                            for key, value in headers
+                        ],
+                    }
+                )
+                started = True
+            elif kind == "body":
+                await send(
+                    {"type": "http.response.body", "body": data[0], "more_body": True}
+                )
+            else:
+                break
+
+        try:
+            await future
+        except Exception as exc:  # pylint: disable=W0703
+            logger.error("Error serving %s: %r", environ["PATH_INFO"], exc)
+            if not started:
+                await self.send_json(send, {"status_code": 500, "errors": str(exc)}, 500)
+                return
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    @staticmethod
+    async def send_json(send, data, status=200):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+def make_app():
+    # pylint: --disable=C0415
+    from gensim.server import app as wsgi_app
+
+    return AsyncAPI(wsgi_app)
+
+
+app = make_app()
+
+
+def runserver():
+    assert uvicorn, "Install uvicorn to serve the API with asyncio"
+    uvicorn.run(app, host=settings.HOST, port=int(settings.PORT))
@@ -0,0 +1,163 @@
+"""
+Autosaves of the hosted games.
+
+The server tells the Autosaver about every request it finishes; that only
+updates a few counters. A game is queued for an autosave after
+settings.AUTOSAVE_ACTIONS actions (transactions that wrote something), when a
+new in-game day starts (settings.AUTOSAVE_DAILY) and every
+settings.AUTOSAVE_INTERVAL seconds if it changed. A background thread saves
+the queued games one by one (check management.db.save_game), so the requests
+never wait for them.
+
+Every game keeps its last settings.AUTOSAVE_SLOTS autosaves, named
+autosave-<save id>-<n> so they never replace the saves of the players or of
+the other games.
+"""
+import logging
+import os
+from pathlib import Path
+import queue
+import threading
+import time
+
+from gensim import metrics
+from gensim.conf import settings
+from gensim.management import db as man_db
+
+logger = logging.getLogger("user_info." + __name__)
+
+
+class Autosaver:
+    """
+    :param games: GameManager of the server
+    :param actions: Autosave every that many actions (0 to disable)
+    :param daily: Autosave when a new in-game day starts
+    :param interval: Autosave every that many seconds (0 to disable)
+    :param slots: Autosaves kept for every game
+    """
+
+    def __init__(
+        self,
+        games,
+        actions=settings.AUTOSAVE_ACTIONS,
+        daily=settings.AUTOSAVE_DAILY,
+        interval=settings.AUTOSAVE_INTERVAL,
+        slots=settings.AUTOSAVE_SLOTS,
+    ):
+        self.games = games
+        self.actions = actions
+        self.daily = daily
+        self.interval = interval
+        self.slots = slots
+        # save id -> state of its autosaves
+        self.states = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self._thread = None
+
+    def notify(self, save_id, game):
+        """A request of the game finished"""
+        if not self.slots:
+            return
+        versions = game.client.versions
+        with self.lock:
+            state = self.states.get(save_id)
+            # first request of the game (or another game was loaded)
+            if state is None or state["versions"] is not versions:
+                state = self.states[save_id] = {
+                    "versions": versions,
+                    # since the game was opened
+                    "commits": 0,
+                    "actions": 0,
+                    "day": game.today and game.today.date(),
+                    "saved": time.time(),
+                    "pending": state["pending"] if state else False,
+                }
+            commits = versions.commits
+            state["actions"] += commits - state["commits"]
+            state["commits"] = commits
+
+            day = game.today and game.today.date()
+            if self.actions and state["actions"] >= self.actions:
+                self._enqueue(save_id, state, "actions")
+            elif self.daily and None not in (day, state["day"]) and day != state["day"]:
+                self._enqueue(save_id, state, "day")
+            state["day"] = day
+        self.start()
+
+    def _enqueue(self, save_id, state, trigger):
+        if state["pending"]:
+            return
+        state["pending"] = True
+        state["actions"] = 0
+        self.queue.put((save_id, trigger, time.perf_counter()))
+
+    def _check_interval(self):
+        now = time.time()
+        with self.lock:
+            for save_id, state in self.states.items():
+                if state["actions"] and now - state["saved"] >= self.interval:
+                    self._enqueue(save_id, state, "interval")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, daemon=True, name="gensim-autosave"
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                if self.interval:
+                    self._check_interval()
+                self.prune()
+                continue
+            self.save(*item)
+
+    def prune(self):
+        """Forget the games that were closed (their autosaves are kept)"""
+        with self.lock:
+            for save_id in list(self.states):
+                state = self.states[save_id]
+                if not state["pending"] and self.games.peek(save_id) is None:
+                    del self.states[save_id]
+
+    def slot(self, save_id):
+        """The autosave of the game to write: a missing one or the oldest"""
+        names = [
+            f"{man_db.AUTOSAVE_PREFIX}{save_id}-{index}"
+            for index in range(1, self.slots + 1)
+        ]
+
+        def saved_at(name):
+            path = Path(man_db.get_save(name).split("///")[-1])
+            return os.stat(path).st_mtime_ns if path.exists() else 0
+
+        return min(names, key=saved_at)
+
+    def save(self, save_id, trigger, queued=None):
+        if queued is not None:
+            metrics.AUTOSAVE_LAG.observe(time.perf_counter() - queued)
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            slot = self.slot(save_id)
+            game = self.games.peek(save_id)
+            if game is not None:
+                game.checkpoint()
+            man_db.save_game(slot, save=save_id)
+            logger.info("Autosaved %s to %s (%s)", save_id, slot, trigger)
+        except Exception as exc:  # pylint: disable=W0703
+            status = "error"
+            logger.error("Autosave of %s failed: %r", save_id, exc)
+        metrics.AUTOSAVE_DURATION.observe(time.perf_counter() - start)
+        metrics.AUTOSAVES.inc(trigger, status)
+
+        with self.lock:
+            state = self.states.get(save_id)
+            if state is not None:
+                state["pending"] = False
+                state["saved"] = time.time()
@@ -9,6 +9,108 @@ DATA_DIR = BASE_DIR / "data"
 # Config
 DEBUG = False
 
+# Database
+# AUTOCOMMIT - every statement is its own transaction
+# REQUEST    - one transaction for each API request (or trigger pass) with
+#              one commit at the end and rollback on errors
+TRANSACTION_MODE = "REQUEST"
+# connections kept open by the engine. Every thread serving requests
+# has its own session
+POOL_SIZE = 8
+# lifecycle of the sessions (check Client.release): a session is closed once
+# its game served SESSION_MAX_REQUESTS requests (in any thread) since it was
+# opened or once it holds SESSION_MAX_OBJECTS objects, and its objects are
+# expunged after every request
+SESSION_MAX_REQUESTS = 1000
+SESSION_MAX_OBJECTS = 5000
+SESSION_EXPUNGE = True
+
+# pragmas set on every connection (check gensim.db.make_engine). A database
+# in DATABASES picks one with {"config": {"profile": name}} (and can override
+# some with "pragmas"); STORAGE_PROFILE otherwise
+STORAGE_PROFILES = {
+    # sqlite's defaults: rollback journal and every commit synced to disk
+    "durable": {"journal_mode": "DELETE", "synchronous": "FULL"},
+    # WAL (readers don't block the writer), synced at checkpoints only; a
+    # power loss can undo the last commits but not corrupt the file
+    "fast-local": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # KiB
+        "temp_store": "MEMORY",
+    },
+    # journal in memory and no syncs at all; a crash can corrupt the file
+    "in-memory": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "mmap_size": 1024 * 1024 * 1024,
+        "cache_size": -256 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+STORAGE_PROFILE = "durable"
+# pages copied at a time when saving and loading (check management.db.copy_db);
+# the game can write between steps. 0 copies the whole file in one step
+BACKUP_PAGES = 1024
+# times the copy of a database that isn't in WAL mode can start over (because
+# it was written between steps) before copying it at once
+BACKUP_RESTARTS = 3
+# save only the rows that differ from the master world the game was created
+# from (check management.db.save_diff) instead of the whole database. The
+# worlds are kept as long as a save is built from them
+DIFF_SAVES = False
+# compress the saves with lzma. Level 1 is a lot faster than the default (6)
+# and not much bigger
+COMPRESS_SAVES = True
+COMPRESS_LEVEL = 1
+# autosave the games in the background (check gensim.autosave) every
+# AUTOSAVE_ACTIONS actions, when a new in-game day starts and every
+# AUTOSAVE_INTERVAL seconds (if they changed); 0 disables a trigger. Every
+# game keeps its last AUTOSAVE_SLOTS autosaves (0 disables them)
+AUTOSAVE_ACTIONS = 50
+AUTOSAVE_DAILY = True
+AUTOSAVE_INTERVAL = 5 * 60
+AUTOSAVE_SLOTS = 3
+# where the games are played:
+# file   - straight on their save file
+# memory - on a copy in memory written to the save file (check gensim.memdb)
+#          every CHECKPOINT_INTERVAL seconds, on saving and on closing the game.
+#          The requests of a game are handled one at a time
+WORKING_DB = "file"
+CHECKPOINT_INTERVAL = 60
+# with WORKING_DB = "memory", journal the writes between checkpoints so they
+# survive a crash (one fsync per commit)
+CHECKPOINT_JOURNAL = False
+# build the characters and events of data/ with bulk inserts in one transaction
+# (check serializers.bulk_build) instead of one commit per event
+BULK_BUILD = True
+
+# Server
+# handle requests concurrently
+THREADED = True
+# encode the responses with orjson (if it is installed)
+FAST_JSON = True
+# rows per page of the list endpoints when they are paginated (?limit or
+# ?after; otherwise they send every row) and the most a page can have
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# share of the requests measured for /api/metrics (0 disables the measures)
+METRICS_SAMPLE_RATE = 1.0
+# games (saves) hosted at the same time and seconds before an idle
+# game is closed
+MAX_GAMES = 16
+GAME_IDLE_TIMEOUT = 30 * 60
+# worker processes for "gensim runcluster"; the games are sharded among them
+WORKERS = 4
+# seconds the dispatcher waits for a worker to connect, reply or send the
+# next chunk of a streamed response
+WORKER_TIMEOUT = 60
+# "gensim runasgi": threads running the views
+ASYNC_WORKERS = 8
+# threads copying the saves made in the background
+FILE_WORKERS = 2
+
 # Logging
 LOGGERS = {
     "version": 1,
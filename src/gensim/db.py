@@ -1,15 +1,18 @@
 """
 ORM layer for the DB
 """
-import os
+from functools import cache
+import hashlib
+import json
+from operator import attrgetter
 import random
 import re
 import logging
 import pathlib
-from warnings import warn
 import shutil
+import time
 
-from sqlalchemy import Column, create_engine
+from sqlalchemy import Column, create_engine, inspect, literal
 from sqlalchemy import (
     Integer,
     Float,
@@ -19,15 +22,21 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
 )
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.event import listen
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, as_declarative
-from sqlalchemy.schema import UniqueConstraint  # , CheckConstraint
+from sqlalchemy.orm import relationship, as_declarative, object_session
+from sqlalchemy.schema import CreateIndex, UniqueConstraint  # , CheckConstraint
 
 from gensim.conf import settings
 from gensim.log import logged
 
 logger = logging.getLogger("user_info." + __name__)
 
+# model -> (column names, getter of their values) (check Base.as_dict)
+_COLUMN_GETTERS = {}
+
 
 @as_declarative()
 class Base:
@@ -42,10 +51,31 @@ class Base:
         table_name = "".join(table_name).lower()
         return table_name
 
+    @classmethod
+    def _column_getter(cls):
+        if cls not in _COLUMN_GETTERS:
+            columns = tuple(cls.__table__.columns.keys())
+            getter = attrgetter(*columns)
+            if len(columns) == 1:
+                getter = lambda obj, get=getter: (get(obj),)
+            _COLUMN_GETTERS[cls] = (columns, getter)
+        return _COLUMN_GETTERS[cls]
+
     def as_dict(self):
-        return {
-            column: getattr(self, column) for column in self.__table__.columns.keys()
-        }
+        columns, getter = self._column_getter()
+        return dict(zip(columns, getter(self)))
+
+    @classmethod
+    def rows_as_dicts(cls, query, columns=None):
+        """
+        Same as [obj.as_dict() for obj in query] but straight from the rows,
+        without loading the objects
+
+        :param columns: Only these columns (all of them by default)
+        """
+        columns = columns or cls._column_getter()[0]
+        query = query.with_entities(*(getattr(cls, column) for column in columns))
+        return [dict(zip(columns, row)) for row in query]
 
     def __str__(self):
         return f"[ {self.__class__.__name__} ] ({self.as_dict()})"
@@ -350,8 +380,22 @@ class Event(Base):
             effect.commit() for effect in self.effects if effect.score in (score, -1)
         ]
 
+    @property
+    def graph(self):
+        """Compiled lock/activator graph (gensim.graph) if the client has one"""
+        session = object_session(self)
+        if session is None:
+            return None
+        graph = session.info.get("event_graph")
+        if graph is None or not graph.compiled:
+            return None
+        return graph
+
     @property
     def available(self):
+        graph = self.graph
+        if graph is not None:
+            return graph.available(self)
         # we define __bool__ in Event
         # so don't use "if self.activator"
         if self.activator is not None:
@@ -377,6 +421,32 @@ class Event(Base):
 
         return base
 
+    @classmethod
+    def rows_as_dicts(cls, query, columns=None):
+        """The children are loaded as rows too, one query for each generation"""
+        events = super().rows_as_dicts(query, columns)
+        if columns is not None:
+            # projections don't have children
+            return events
+        generation = events
+        seen = set()
+        while generation:
+            parents = {}
+            for event in generation:
+                event["children"] = []
+                if event["name"] not in seen:
+                    parents[event["name"]] = event
+            seen.update(parents)
+            generation = super().rows_as_dicts(
+                query.session.query(cls)
+                .filter(cls.parent_name.in_(parents))
+                .order_by(cls.id)
+            )
+            for child in generation:
+                parents[child["parent_name"]]["children"].append(child)
+
+        return events
+
 
 # monkey-patched since it's self-referential
 # The event name is specially important here since we
@@ -624,9 +694,299 @@ class Command(Base):
 class CommandMap(Base):
     key = Column(String, nullable=False)
 
-def create_db(name=settings.DATABASES["default"]["engine"]):
+
+class Meta(Base):
+    """About the database itself (like the fingerprint of its schema)"""
+
+    key = Column(String, nullable=False, unique=True)
+    value = Column(String)
+
+
+def storage_profile(database="default"):
     """
-    Create database and schema if and only if the schema was modified
+    Pragmas of a database in settings.DATABASES: its config can name a profile
+    (settings.STORAGE_PROFILES, settings.STORAGE_PROFILE by default) and
+    override some of its pragmas
+    """
+    config = settings.DATABASES.get(database, {}).get("config") or {}
+    profile = config.get("profile", settings.STORAGE_PROFILE)
+    return {**settings.STORAGE_PROFILES[profile], **config.get("pragmas", {})}
+
+
+def make_engine(url, profile=None, **kwargs):
+    """
+    create_engine applying the pragmas of a storage profile to every connection.
+
+    :param profile: Name in settings.STORAGE_PROFILES or dict of pragmas.
+        Defaults to the profile of the default database
+    """
+    if profile is None:
+        profile = storage_profile()
+    elif isinstance(profile, str):
+        profile = settings.STORAGE_PROFILES[profile]
+    engine = create_engine(url, **kwargs)
+
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in profile.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    listen(engine, "connect", set_pragmas)
+    return engine
+
+
+# Schema versioning: the fingerprint of the models is kept in the Meta table of
+# every database. When it doesn't match, migrate upgrades the database in place
+class MigrationError(Exception):
+    """The schema of a database can't be upgraded in place"""
+
+
+SCHEMA_KEY = "schema"
+
+
+def _describe(table, dialect):
+    return {
+        "columns": [
+            [
+                column.name,
+                column.type.compile(dialect),
+                column.nullable,
+                column.primary_key,
+            ]
+            for column in table.columns
+        ],
+        "foreign_keys": sorted(
+            [key.parent.name, key.target_fullname, key.ondelete or ""]
+            for key in table.foreign_keys
+        ),
+        "indexes": sorted(
+            [index.name, [column.name for column in index.columns], index.unique]
+            for index in table.indexes
+        ),
+        "unique": sorted(
+            [column.name for column in constraint.columns]
+            for constraint in table.constraints
+            if isinstance(constraint, UniqueConstraint)
+        ),
+    }
+
+
+@cache
+def schema_fingerprint():
+    """sha256 of the tables, columns, keys and indexes of the models"""
+    dialect = sqlite.dialect()
+    description = {
+        name: _describe(table, dialect)
+        for name, table in sorted(Base.metadata.tables.items())
+    }
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def _add_column(table, column, dialect):
+    """ALTER TABLE adding a column (existing rows get its default)"""
+    where = f"{table.name}.{column.name}"
+    if column.primary_key or column.unique:
+        raise MigrationError(f"New column {where} is a key")
+    compiler = dialect.ddl_compiler(dialect, None)
+    default = compiler.get_column_default_string(column)
+    if default is None and column.default is not None and column.default.is_scalar:
+        default = str(
+            literal(column.default.arg).compile(
+                dialect=dialect, compile_kwargs={"literal_binds": True}
+            )
+        )
+
+    ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}"'
+    ddl += f" {column.type.compile(dialect)}"
+    if default is not None:
+        ddl += f" DEFAULT {default}"
+    if not column.nullable:
+        if default is None:
+            raise MigrationError(f"New column {where} can't be null and has no default")
+        ddl += " NOT NULL"
+    for key in column.foreign_keys:
+        ddl += f' REFERENCES "{key.column.table.name}" ("{key.column.name}")'
+        if key.ondelete:
+            ddl += f" ON DELETE {key.ondelete}"
+    return ddl
+
+
+def _foreign_keys(keys):
+    """column -> sorted [target, ondelete] of the foreign keys (as _describe)"""
+    columns = {}
+    for column, target, ondelete in keys:
+        columns.setdefault(column, []).append([target, ondelete or ""])
+    return {column: sorted(targets) for column, targets in columns.items()}
+
+
+def _migration(connection):
+    """
+    Tables to create and DDL statements that upgrade a database to the models.
+    Raises MigrationError for the changes that can't be done in place.
+    """
+    dialect = connection.dialect
+    inspector = inspect(connection)
+    existing = set(inspector.get_table_names())
+    missing = []
+    statements = []
+    # tables the models don't have anymore
+    for name in sorted(existing - Base.metadata.tables.keys()):
+        logger.warning("Dropping removed table %s", name)
+        statements.append(f'DROP TABLE "{name}"')
+    for name, table in Base.metadata.tables.items():
+        if name not in existing:
+            missing.append(table)
+            continue
+
+        columns = {column["name"]: column for column in inspector.get_columns(name)}
+        for column in table.columns:
+            if column.name not in columns:
+                statements.append(_add_column(table, column, dialect))
+                continue
+            old_type = columns[column.name]["type"].compile(dialect)
+            if old_type != column.type.compile(dialect):
+                raise MigrationError(
+                    f"{name}.{column.name} changed its type from {old_type}"
+                )
+            if not column.primary_key and (
+                columns[column.name]["nullable"] != column.nullable
+            ):
+                raise MigrationError(f"{name}.{column.name} changed its nullability")
+        # removed columns are left alone unless they would break the inserts
+        for column_name in columns.keys() - table.columns.keys():
+            old = columns[column_name]
+            if not old["nullable"] and old["default"] is None:
+                raise MigrationError(
+                    f"Removed column {name}.{column_name} can't be null"
+                )
+
+        # SQLite can't change the foreign keys of a table (the new columns get
+        # theirs when they are added)
+        old_keys = _foreign_keys(
+            (
+                column,
+                f"{key['referred_table']}.{target}",
+                key["options"].get("ondelete"),
+            )
+            for key in inspector.get_foreign_keys(name)
+            for column, target in zip(
+                key["constrained_columns"], key["referred_columns"]
+            )
+        )
+        new_keys = _foreign_keys(
+            (key.parent.name, key.target_fullname, key.ondelete)
+            for key in table.foreign_keys
+        )
+        # (the removed columns are left alone with their keys)
+        for column_name in columns.keys() & table.columns.keys():
+            if old_keys.get(column_name) != new_keys.get(column_name):
+                raise MigrationError(
+                    f"The foreign keys of {name}.{column_name} changed"
+                )
+
+        indexes = {index["name"]: index for index in inspector.get_indexes(name)}
+        constraints = {
+            frozenset(column.name for column in constraint.columns)
+            for constraint in table.constraints
+            if isinstance(constraint, UniqueConstraint)
+        }
+        models = {index.name: index for index in table.indexes}
+        for index_name, index in list(indexes.items()):
+            model = models.get(index_name)
+            if model is None:
+                # the unique indexes doing the job of the unique constraints
+                kept = index["unique"] and (
+                    frozenset(index["column_names"]) in constraints
+                )
+            else:
+                kept = [column.name for column in model.columns] == index[
+                    "column_names"
+                ] and bool(model.unique) == bool(index["unique"])
+            if not kept:
+                # removed or changed (then it's created again below)
+                statements.append(f'DROP INDEX "{index_name}"')
+                del indexes[index_name]
+        unique = {
+            frozenset(constraint["column_names"])
+            for constraint in (
+                *inspector.get_unique_constraints(name),
+                *indexes.values(),
+            )
+            if constraint.get("unique", True)
+        }
+        for index in table.indexes:
+            if index.name not in indexes:
+                statements.append(str(CreateIndex(index).compile(dialect=dialect)))
+        # SQLite can't add constraints: a unique index does the same job
+        for constraint in table.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            column_names = [column.name for column in constraint.columns]
+            if frozenset(column_names) not in unique:
+                index_name = "uq_" + "_".join((name, *column_names))
+                quoted = ", ".join(f'"{column}"' for column in column_names)
+                statements.append(
+                    f'CREATE UNIQUE INDEX "{index_name}" ON "{name}" ({quoted})'
+                )
+    return missing, statements
+
+
+def migrate(url, profile=None):
+    """
+    Upgrade the schema of a database (created if it doesn't exist) to the
+    models in place: create the missing tables and indexes, add the missing
+    columns and drop the removed tables and indexes. Nothing is done if its
+    fingerprint is current.
+
+    Raises MigrationError (and changes nothing) if it can't be done in place.
+    Returns whether it had to be migrated.
+    """
+    fingerprint = schema_fingerprint()
+    engine = make_engine(url, profile)
+    try:
+        with engine.begin() as connection:
+            # pysqlite doesn't begin transactions before DDL statements
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            if inspect(connection).has_table(Meta.__tablename__):
+                stored = connection.execute(
+                    Meta.__table__.select()
+                    .with_only_columns(Meta.value)
+                    .where(Meta.key == SCHEMA_KEY)
+                ).scalar()
+                if stored == fingerprint:
+                    return False
+
+            start = time.time()
+            missing, statements = _migration(connection)
+            try:
+                Base.metadata.create_all(connection, tables=missing)
+                for statement in statements:
+                    connection.exec_driver_sql(statement)
+            except DBAPIError as exc:
+                raise MigrationError(str(exc.orig)) from exc
+            connection.execute(Meta.__table__.delete().where(Meta.key == SCHEMA_KEY))
+            connection.execute(
+                Meta.__table__.insert().values(key=SCHEMA_KEY, value=fingerprint)
+            )
+        logger.info(
+            "Migrated %s in %.2fs (%d tables created, %d statements)",
+            url,
+            time.time() - start,
+            len(missing),
+            len(statements),
+        )
+        return True
+    finally:
+        # the last connection to close checkpoints the WAL (if any) so the
+        # file can be copied
+        engine.dispose()
+
+
+def create_db(name=settings.DATABASES["default"]["engine"], profile=None):
+    """
+    Create the database from the master database, which is migrated first (or
+    rebuilt if it can't be)
     """
     file = name.split("/")[-1]
     master = "master_" + file
@@ -636,16 +996,19 @@ def create_db(name=settings.DATABASES["default"]["engine"]):
     master_path = pathlib.Path(path.replace(file, master))
     child_path = pathlib.Path(path)
 
-    # Nuke everything and build it from scratch.
-    if db_schema_modified("db.py") or not master_path.exists():
-        master_engine = create_engine(master_name)
-        Base.metadata.drop_all(master_engine)
-        Base.metadata.create_all(master_engine)
+    try:
+        migrate(master_name, profile)
+    except MigrationError as exc:
+        # Nuke everything and build it from scratch.
+        logger.warning("Can't migrate %s (%s). Rebuilding it", master_path, exc)
+        for suffix in ("", "-wal", "-shm"):
+            pathlib.Path(str(master_path) + suffix).unlink(missing_ok=True)
+        migrate(master_name, profile)
 
     shutil.copy(master_path, child_path)
     print(child_path)
 
-    engine = create_engine(name)
+    engine = make_engine(name, profile)
 
     return str(engine.url)
 
@@ -653,29 +1016,3 @@ def create_db(name=settings.DATABASES["default"]["engine"]):
 def drop_db(name=settings.DATABASES["default"]["engine"]):
     engine = create_engine(name)
     Base.metadata.drop_all(engine)
-
-
-def db_schema_modified(filename):
-    """
-    Utility tool to know if a file was modified.
-    :param file: Path object, file to watch
-    """
-    ts_file = settings.BASE_DIR / f"_last_mod_{filename}.timestamp"
-    _last_schema_mod = os.stat(settings.BASE_DIR / filename).st_mtime
-    try:
-        with open(ts_file, encoding="utf-8") as file:
-            _lst_reg_schema_mod = file.read()
-    except FileNotFoundError as exc:
-        _, error = exc.args
-        warn(error)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
-            _lst_reg_schema_mod = 0
-
-    SCHEMA_MODIFIED = float(_lst_reg_schema_mod) != _last_schema_mod
-    if SCHEMA_MODIFIED:
-        logger.info("Detected change in %s ... db will be rebuilt", filename)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
-
-    return SCHEMA_MODIFIED
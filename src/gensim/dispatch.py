@@ -0,0 +1,195 @@
+"""
+Run the API in several processes.
+
+One process can only use one core. Here the games are sharded among N worker
+processes by save id: every worker runs the usual server (gensim.server) and
+owns the save files (and caches) of its games, so there are never two
+processes writing to the same SQLite file. The dispatcher is a thin WSGI app
+that forwards each request to the worker that owns its save.
+"""
+from http.client import HTTPConnection
+import logging
+import multiprocessing
+from pathlib import Path
+import threading
+import time
+import zlib
+
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+
+from gensim.conf import settings
+from gensim.game import request_save_id
+
+logger = logging.getLogger("user_info." + __name__)
+
+# headers that only make sense for one hop
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "te",
+    "trailer",
+    "upgrade",
+    "proxy-authorization",
+    "proxy-authenticate",
+}
+
+# requests sent again if a stale keep-alive connection fails
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS"}
+CHUNK = 64 * 1024
+
+
+def shard(save_id, workers):
+    """Stable (unlike hash()) worker index for a save"""
+    return zlib.crc32(save_id.encode("utf-8")) % workers
+
+
+class Dispatcher:
+    """
+    WSGI app forwarding requests to the workers.
+
+    :param ports: ports of the workers, the index is the shard
+    """
+
+    def __init__(self, ports, host=settings.HOST, timeout=settings.WORKER_TIMEOUT):
+        self.ports = ports
+        self.host = host
+        self.timeout = timeout
+        # one keep-alive connection to every worker for each thread
+        self._connections = threading.local()
+
+    def _connection(self, index):
+        connections = self._connections.__dict__.setdefault("pool", {})
+        if index not in connections:
+            connections[index] = HTTPConnection(
+                self.host, self.ports[index], timeout=self.timeout
+            )
+        return connections[index]
+
+    def _drop(self, index):
+        self._connections.pool.pop(index).close()
+
+    def _send(self, index, method, path, body, headers):
+        connection = self._connection(index)
+        # the worker may have closed an idle keep-alive connection
+        reused = connection.sock is not None
+        try:
+            connection.request(method, path, body=body, headers=headers)
+        except OSError:
+            self._drop(index)
+            if not reused:
+                raise
+            logger.debug("Stale connection to worker %d, sending again", index)
+            return self._send(index, method, path, body, headers)
+        try:
+            return connection.getresponse()
+        except OSError:
+            self._drop(index)
+            # the worker got the request, it may have run it
+            if not reused or method not in IDEMPOTENT:
+                raise
+            logger.debug("Stale connection to worker %d, sending again", index)
+            return self._send(index, method, path, body, headers)
+
+    @staticmethod
+    def _body(res):
+        yield from iter(lambda: res.read1(CHUNK), b"")
+        # read1 doesn't close a response with a Content-Length at the end
+        res.close()
+
+    def _close(self, index, res):
+        # the client went away before the end, the connection is unusable
+        if not res.isclosed():
+            self._drop(index)
+
+    def forward(self, index, request):
+        headers = {
+            key: value
+            for key, value in request.headers.items()
+            if key.lower() not in HOP_HEADERS
+        }
+        body = request.get_data()
+        path = request.full_path if request.query_string else request.path
+        res = self._send(index, request.method, path, body, headers)
+
+        # stream the body as it comes (server-sent events never end)
+        response = Response(
+            self._body(res),
+            status=res.status,
+            headers=[
+                (key, value)
+                for key, value in res.getheaders()
+                if key.lower() not in HOP_HEADERS
+            ],
+            direct_passthrough=True,
+        )
+        response.call_on_close(lambda: self._close(index, res))
+        return response
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        # invalid ids are rejected by the worker
+        save_id = request_save_id(request.headers, request.args) or ""
+        response = self.forward(shard(save_id, len(self.ports)), request)
+        return response(environ, start_response)
+
+
+def run_worker(port, saves=None):
+    """
+    :param saves: Directory of the saves and the games of the worker instead of
+        settings.SAVES (the one of the play database)
+    """
+    if saves is not None:
+        # before the modules reading them are imported
+        play = settings.DATABASES["play"]
+        engine = "sqlite:///" + str(Path(saves, play["engine"].split("/")[-1]))
+        settings.SAVES = Path(saves)
+        settings.DATABASES = {**settings.DATABASES, "play": {**play, "engine": engine}}
+    # pylint: --disable=C0415
+    from gensim.server import app
+
+    app.run(host=settings.HOST, port=port, threaded=settings.THREADED)
+
+
+def wait_for(host, port, timeout=30):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            connection = HTTPConnection(host, port, timeout=1)
+            connection.request("GET", "/api/game/")
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Worker at {host}:{port} didn't start")
+
+
+def start_workers(workers=settings.WORKERS, port=settings.PORT, saves=None):
+    """
+    Start the worker processes on the ports following the dispatcher's
+
+    :param saves: Directory of their saves (check run_worker)
+    """
+    context = multiprocessing.get_context("spawn")
+    ports = [int(port) + index + 1 for index in range(workers)]
+    processes = [
+        context.Process(target=run_worker, args=(worker_port, saves), daemon=True)
+        for worker_port in ports
+    ]
+    for process in processes:
+        process.start()
+    for worker_port in ports:
+        wait_for(settings.HOST, worker_port)
+    logger.info("Started %d workers at %s", workers, ports)
+
+    return processes, ports
+
+
+def runcluster(workers=settings.WORKERS, port=settings.PORT):
+    processes, ports = start_workers(workers, port)
+    try:
+        run_simple(settings.HOST, int(port), Dispatcher(ports), threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
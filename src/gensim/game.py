@@ -0,0 +1,209 @@
+"""
+State of the running games.
+"""
+from collections import OrderedDict
+import pickle
+import re
+import threading
+import time
+
+from gensim.conf import settings
+from gensim.log import logged
+
+
+def request_save_id(headers, args):
+    """
+    Save id of a request: the X-Gensim-Save header or the save parameter.
+    None if it isn't a valid id.
+    """
+    save_id = headers.get("X-Gensim-Save") or args.get("save", "current")
+    if not re.fullmatch(r"[\w-]+", save_id):
+        return None
+    return save_id
+
+
+@logged
+class Game:
+    """
+    A game being played: the client connected to its save plus the calendar
+    (check cronie.py) of today's events.
+
+    :data lock:
+        Requests are handled concurrently. Everything that reads and writes the
+        calendar (or the time) must hold the lock.
+    :data working:
+        memdb.WorkingCopy the client plays on (if the save is in memory). Then
+        every request holds the lock.
+    """
+
+    def __init__(self, client, working=None):
+        self.client = client
+        self.working = working
+        self.lock = working.lock if working is not None else threading.RLock()
+        self.today = None
+        self.calendar = None
+        self.last_used = time.time()
+
+    def snapshot(self):
+        """State in memory to restore if the request is rolled back"""
+        return self.today, pickle.dumps(self.calendar)
+
+    def restore(self, snapshot):
+        """Undo the changes in memory of a request that was rolled back"""
+        self.today, calendar = snapshot
+        self.calendar = pickle.loads(calendar)
+        # the events it pruned are back
+        self.client.compile_events()
+
+    def checkpoint(self):
+        """Write the game to its save file if it's in memory"""
+        if self.working is not None:
+            self.working.checkpoint()
+
+    def close(self):
+        if self.working is not None:
+            self.working.close()
+        self.client.close()
+
+    def __str__(self):
+        return (
+            f"[{self.__class__.__name__}] ({self.client.engine.url}, "
+            f"today: {self.today})"
+        )
+
+
+@logged
+class GameManager:
+    """
+    Games hosted by the server keyed by save id.
+    The most recently used games stay open (engine, session, event graph and
+    calendar); the least recently used ones are closed when there are more than
+    max_games or they have been idle for more than max_idle seconds.
+    Games serving requests (between get and release) are never evicted, and
+    closing one of them waits until they are over.
+
+    :param open_game:
+        Callable[[save_id], Game] to open a game that isn't hosted yet
+    """
+
+    def __init__(
+        self,
+        open_game,
+        max_games=settings.MAX_GAMES,
+        max_idle=settings.GAME_IDLE_TIMEOUT,
+    ):
+        self.open_game = open_game
+        self.max_games = max_games
+        self.max_idle = max_idle
+        self.games = OrderedDict()
+        self.lock = threading.RLock()
+        self.released = threading.Condition(self.lock)
+        # game -> requests being served
+        self.requests = {}
+        # save ids of the games being closed
+        self.closing = set()
+
+    def get(self, save_id="current"):
+        """Game of a request. Release it when the request is over"""
+        with self.lock:
+            while save_id in self.closing:
+                self.released.wait()
+            if save_id in self.games:
+                self.games.move_to_end(save_id)
+                game = self.games[save_id]
+            else:
+                self.logger.info("Opening game %s", save_id)
+                game = self.open_game(save_id)
+                self.games[save_id] = game
+            game.last_used = time.time()
+            self.requests[game] = self.requests.get(game, 0) + 1
+            self.evict()
+            return game
+
+    def release(self, game):
+        """A request of the game is over"""
+        with self.lock:
+            self.requests[game] -= 1
+            if not self.requests[game]:
+                del self.requests[game]
+                self.released.notify_all()
+
+    def peek(self, save_id):
+        """The game if it's hosted (without opening it or marking it as used)"""
+        with self.lock:
+            return self.games.get(save_id)
+
+    def set(self, save_id, game):
+        """Host another game (after loading or creating it) under the save id"""
+        self.replace(save_id, lambda: game)
+
+    def replace(self, save_id, replace_game):
+        """
+        Close the game once the requests it's serving are over and host the one
+        returned by replace_game() (None to open it on the next request). The
+        requests of the save wait in the meantime, so its file can be replaced.
+        """
+        with self.lock:
+            while save_id in self.closing:
+                self.released.wait()
+            game = self.games.pop(save_id, None)
+            self.closing.add(save_id)
+            while game in self.requests:
+                self.released.wait()
+        try:
+            if game is not None:
+                self.logger.info("Closing game %s", save_id)
+                game.close()
+            game = replace_game()
+            if game is not None:
+                with self.lock:
+                    self.games[save_id] = game
+        finally:
+            with self.lock:
+                self.closing.discard(save_id)
+                self.released.notify_all()
+        if game is not None:
+            self.evict()
+
+    def close(self, save_id):
+        """Close the game once the requests it's serving are over"""
+        self.replace(save_id, lambda: None)
+
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            # only the games that aren't serving requests
+            free = [
+                save_id
+                for save_id, game in self.games.items()
+                if game not in self.requests
+            ]
+            idle = [
+                save_id
+                for save_id in free
+                if now - self.games[save_id].last_used > self.max_idle
+            ]
+            for save_id in idle:
+                self.close(save_id)
+            free = [save_id for save_id in free if save_id not in idle]
+            for save_id in free[: max(len(self.games) - self.max_games, 0)]:
+                self.close(save_id)
+
+    def close_all(self):
+        with self.lock:
+            save_ids = list(self.games)
+        for save_id in save_ids:
+            self.close(save_id)
+
+    def items(self):
+        with self.lock:
+            return list(self.games.items())
+
+    def __contains__(self, save_id):
+        return save_id in self.games
+
+    def __len__(self):
+        return len(self.games)
+
+    def __str__(self):
+        return f"[{self.__class__.__name__}] ({', '.join(self.games)})"
@@ -0,0 +1,134 @@
+"""
+In-memory graph of the event locks and activator chains.
+Checking if an event is available used to follow the activator relationships
+recursively and load the lockers of every event each time. Here we compile
+the EventLock table and the activator_name column once. Only the structure is
+cached: whether a locker is available depends on stats, the time and the
+effects of other events, so it's checked every time.
+"""
+from collections import defaultdict
+from logging import getLogger
+
+from sqlalchemy.orm import object_session
+
+from gensim.db import Event, EventLock
+
+logger = getLogger("user_info." + __name__)
+
+
+class EventGraph:
+    """
+    DAG of events.
+
+    :data activators:
+        name -> name of the activator (None if it's the root of the chain)
+    :data lockers:
+        name -> names of the events locking it (EventLock.key)
+    :data locks:
+        name -> names of the events it locks (EventLock.lock)
+    """
+
+    def __init__(self):
+        # False until the graph is loaded; events ignore it in the meantime
+        self.compiled = False
+        self.ids = {}
+        self.activators = {}
+        self.lockers = defaultdict(set)
+        self.locks = defaultdict(set)
+
+        # cache
+        self._roots = {}
+
+    def load(self, events, locks):
+        """
+        :param events: Iterable[Tuple[id, name, activator_name]]
+        :param locks: Iterable[Tuple[key, lock]]
+        """
+        self.__init__()
+        for id_, name, activator_name in events:
+            self.ids[name] = id_
+            self.activators[name] = activator_name
+        for key, lock in locks:
+            self.lockers[lock].add(key)
+            self.locks[key].add(lock)
+        self.compiled = True
+
+    def compile(self, session):
+        self.load(
+            session.query(Event.id, Event.name, Event.activator_name),
+            session.query(EventLock.key, EventLock.lock),
+        )
+
+    def get(self, session, name):
+        """Fetch the event from the identity map if possible"""
+        if name in self.ids:
+            return session.get(Event, self.ids[name])
+        event = session.query(Event).filter(Event.name == name).one_or_none()
+        if event is not None:
+            self.ids[name] = event.id
+        return event
+
+    def root(self, name):
+        """Resolve the first event of the activator chain"""
+        if name not in self._roots:
+            visited = {name}
+            root = name
+            while self.activators.get(root) is not None:
+                root = self.activators[root]
+                if root in visited:
+                    raise ValueError(f"Activator cycle detected at {root}")
+                visited.add(root)
+            self._roots[name] = root
+        return self._roots[name]
+
+    def locked(self, session, name):
+        return any(
+            self._locker_available(session, key) for key in self.lockers.get(name, ())
+        )
+
+    def _locker_available(self, session, name):
+        locker = self.get(session, name)
+        return locker is not None and self.available(locker)
+
+    def available(self, event):
+        """Event.available without traversing relationships"""
+        session = object_session(event)
+        root = self.root(event.name)
+        if root != event.name:
+            event = self.get(session, root)
+            if event is None:
+                return False
+        if self.locked(session, root):
+            return False
+        return all((requirement.fulfilled for requirement in event.requirements))
+
+    # updates
+    def add_event(self, name, activator_name=None, id_=None):
+        self.activators[name] = activator_name
+        if id_ is not None:
+            self.ids[name] = id_
+        self._roots.clear()
+
+    def add_lock(self, key, lock):
+        self.lockers[lock].add(key)
+        self.locks[key].add(lock)
+
+    def prune(self, name):
+        logger.debug("Removing %s from the event graph", name)
+        for lock in self.locks.pop(name, ()):
+            self.lockers[lock].discard(name)
+        for key in self.lockers.pop(name, ()):
+            self.locks[key].discard(name)
+        # the chain is broken; the events it activated are on their own now
+        for event, activator in self.activators.items():
+            if activator == name:
+                self.activators[event] = None
+        self.activators.pop(name, None)
+        self.ids.pop(name, None)
+        self._roots.clear()
+
+    def __str__(self):
+        return (
+            f"[{self.__class__.__name__}] ({len(self.activators)} events, "
+            f"{sum(map(len, self.locks.values()))} locks)"
+        )
@@ -0,0 +1,567 @@
+"""
+Benchmarks for the server.
+
+    gensim bench [name] [args]
+
+They run against a synthetic world in a temporary directory so they don't
+touch the saves.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+import logging
+from pathlib import Path
+import sys
+import threading
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.event import listen
+
+from gensim.api import Client
+from gensim.conf import settings
+from gensim.cronie import START_DATE
+from gensim.db import Base, Character
+from gensim.game import Game
+
+logger = logging.getLogger("user_info." + __name__)
+
+
+def make_db(directory, name="bench"):
+    """Create an empty database and return its url"""
+    url = "sqlite:///" + str(Path(directory) / f"{name}.sqlite3")
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    return url
+
+
+def make_world(client, locations=10, characters=20, events=50):
+    """
+    Populate the database with enough data to make the endpoints sweat.
+    """
+    home = client.create_area(name="Wonderland")
+    library = client.create_location(name="Dream Library", area=home)
+    alice = client.create_character(
+        name="Alice Liddell", home=home, energy=9999, location=library
+    )
+    time_stat = client.create_stat(label="time", value=int(START_DATE), character=alice)
+
+    area = client.create_area(name="Bench")
+    places = [
+        client.create_location(name=f"location_{index}", area=area)
+        for index in range(locations)
+    ]
+    for origin, destination in zip(places, places[1:]):
+        client.create_path(origin=origin, destination=destination, distance=10)
+
+    player = client.create_character(
+        name="anon", home=area, energy=2000, location=places[0], is_player=True
+    )
+    charas = [player] + [
+        client.create_character(
+            name=f"character_{index}",
+            home=area,
+            energy=2000,
+            location=places[index % locations],
+        )
+        for index in range(characters)
+    ]
+
+    for index in range(events):
+        chara = charas[index % len(charas)]
+        event = client.create_event(
+            name=f"event_{index}",
+            type_="GLOBAL" if index % 2 else "FLAVOR",
+            character_name=chara.name,
+        )
+        client.create_requirement(event, chara, "energy", value=0)
+        effect = client.create_effect(event, chara, "energy", change=0, score=5)
+        effect.available_dialog.append(effect.dialog(text=f"Text of {event.name}"))
+        client.create_effect(event, time_stat, "value", change=60, score=-1)
+
+    client.create_calendar(None)
+    client.session.commit()
+
+
+def _quiet():
+    for name in ("user_info", "global", "werkzeug", "gensim.server"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def _report(label, requests, elapsed):
+    print(
+        f"{label}: {requests} requests in {elapsed:.2f}s "
+        f"({requests / elapsed:.1f} req/s)"
+    )
+
+
+def bench_loop(requests=200, modes=("AUTOCOMMIT", "REQUEST")):
+    """
+    Throughput of /api/event/loop for every transaction mode
+    """
+    from gensim import server  # pylint: --disable=C0415
+
+    _quiet()
+    with TemporaryDirectory() as directory:
+        for mode in modes:
+            url = make_db(directory, name=mode.lower())
+            make_world(Client(url))
+
+            game = Game(Client(url, transaction_mode=mode))
+            game.client.compile_events()
+            server.app.games.set("current", game)
+            http = server.app.test_client()
+
+            start = time.time()
+            for _ in range(requests):
+                res = http.get("/api/event/loop", headers={"Accept": "*/*"})
+                assert res.status_code == 200, res.text
+            _report(f"loop ({mode})", requests, time.time() - start)
+
+
+def bench_threads(requests=400, max_workers=8, sync_ms=5):
+    """
+    Load test. Throughput of a mix of reads and walks (writes) handled by 1, 2,
+    4, ... max_workers threads. The requests are CPU bound in Python so threads
+    only help while they wait on I/O; the commits wait sync_ms more to emulate
+    the fsyncs of a durable commit on a real disk (they are ~free on a VM or a
+    tmpfs). Each count runs without the wait too.
+    """
+    from gensim import server  # pylint: --disable=C0415
+
+    _quiet()
+    urls = ("/api/character/", "/api/location/", "/api/character/player/")
+    with TemporaryDirectory() as directory:
+        url = make_db(directory)
+        make_world(Client(url))
+        game = Game(Client(url))
+        game.client.compile_events()
+        server.app.games.set("current", game)
+        sync = {"wait": 0}
+        # like a real fsync, sleeping releases the GIL
+        listen(game.client.engine, "commit", lambda conn: time.sleep(sync["wait"]))
+
+        def worker(indexes):
+            http = server.app.test_client()
+            for index in indexes:
+                if index % 4:
+                    res = http.get(urls[index % 3], headers={"Accept": "*/*"})
+                else:
+                    # one in four requests advances the game
+                    destination = f"location_{index // 4 % 2}"
+                    res = http.post(
+                        "/api/event/trigger/walk/",
+                        json={"character": "anon", "destination": destination},
+                        headers={"Accept": "*/*"},
+                    )
+                assert res.status_code == 200, res.text
+
+        for sync["wait"] in sorted({0, sync_ms / 1000}):
+            workers = 1
+            while workers <= max_workers:
+                start = time.time()
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    list(
+                        pool.map(
+                            worker,
+                            (range(i, requests, workers) for i in range(workers)),
+                        )
+                    )
+                _report(
+                    f"threads ({workers}, sync {sync['wait'] * 1000:g}ms)",
+                    requests,
+                    time.time() - start,
+                )
+                workers *= 2
+
+
+def bench_cluster(requests=400, max_workers=4, saves=8):
+    """
+    Throughput of /api/event/loop with the games sharded among 1, 2, 4, ...
+    max_workers processes (check gensim.dispatch).
+    """
+    # pylint: --disable=C0415
+    from werkzeug.serving import make_server
+
+    from gensim import dispatch
+    from gensim.management import db as man_db
+
+    _quiet()
+    save_ids = [f"bench-{index}" for index in range(saves)]
+    port = int(settings.PORT) + 100
+    # the workers play (and autosave) in the directory too
+    with TemporaryDirectory() as directory:
+        world = Path(make_db(directory).split("///")[1])
+        make_world(Client("sqlite:///" + str(world)))
+        saves_dir = Path(directory) / "saves"
+        saves_dir.mkdir()
+        for save_id in save_ids:
+            game_file = Path(man_db.get_game(save_id).split("///")[1])
+            (saves_dir / game_file.name).write_bytes(world.read_bytes())
+
+        def worker(indexes):
+            connection = HTTPConnection(settings.HOST, port)
+            for index in indexes:
+                headers = {"X-Gensim-Save": save_ids[index % saves], "Accept": "*/*"}
+                connection.request("GET", "/api/event/loop", headers=headers)
+                res = connection.getresponse()
+                body = res.read()
+                assert res.status == 200, body
+            connection.close()
+
+        workers = 1
+        while workers <= max_workers:
+            processes, ports = dispatch.start_workers(workers, port, saves=saves_dir)
+            server = make_server(
+                settings.HOST, port, dispatch.Dispatcher(ports), threaded=True
+            )
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+
+            clients = workers * 2
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                list(
+                    pool.map(
+                        worker, (range(i, requests, clients) for i in range(clients))
+                    )
+                )
+            _report(f"cluster ({workers} workers)", requests, time.time() - start)
+
+            server.shutdown()
+            for process in processes:
+                process.terminate()
+                process.join()
+            workers *= 2
+
+
+def bench_index(rows=5000, requests=20):
+    """
+    Throughput of /api/character/ (list endpoint) with lots of characters,
+    serializing the ORM objects (the old way) and the rows
+    """
+    from gensim import server  # pylint: --disable=C0415
+
+    _quiet()
+    with TemporaryDirectory() as directory:
+        url = make_db(directory)
+        make_world(Client(url), locations=2, characters=1, events=1)
+        client = Client(url)
+        client.session.execute(
+            insert(Character),
+            [
+                {
+                    "name": f"extra_{index}",
+                    "energy": 100,
+                    "home_name": "Bench",
+                    "location_name": "location_0",
+                }
+                for index in range(rows)
+            ],
+        )
+        client.session.commit()
+        game = Game(client)
+        server.app.games.set("current", game)
+        http = server.app.test_client()
+
+        def objects_index(self):
+            # how index used to be
+            return self.get_queryset("get").all()
+
+        rows_index = server.APIView.index
+        fast_json = settings.FAST_JSON
+        modes = (
+            ("objects, json", objects_index, False),
+            ("rows, json", rows_index, False),
+            ("rows, orjson", rows_index, True),
+        )
+        try:
+            for label, index, settings.FAST_JSON in modes:
+                if settings.FAST_JSON and server.orjson is None:
+                    continue
+                server.APIView.index = index
+                start = time.time()
+                for _ in range(requests):
+                    res = http.get("/api/character/", headers={"Accept": "*/*"})
+                    assert res.status_code == 200, res.text
+                    assert len(res.json) > rows
+                    # skip the ETag
+                    game.client.versions.bump(("character",))
+                _report(f"index ({label})", requests, time.time() - start)
+        finally:
+            server.APIView.index = rows_index
+            settings.FAST_JSON = fast_json
+
+
+def bench_soak(requests=5000, every=500):
+    """
+    Soak test. Memory (traced by tracemalloc) and objects held by the session
+    every few requests of a mix of loops, walks and reads; they should stay
+    flat (check the SESSION_* settings).
+    """
+    from gensim import server  # pylint: --disable=C0415
+
+    _quiet()
+    paths = ("/api/scene/", "/api/character/", "/api/location/location_0/characters")
+    with TemporaryDirectory() as directory:
+        url = make_db(directory)
+        make_world(Client(url))
+        game = Game(Client(url))
+        game.client.compile_events()
+        server.app.games.set("current", game)
+        http = server.app.test_client()
+
+        tracemalloc.start()
+        start = time.time()
+        try:
+            for index in range(1, requests + 1):
+                if index % 10 == 0:
+                    res = http.post(
+                        "/api/event/trigger/walk/",
+                        json={
+                            "character": "anon",
+                            "destination": f"location_{index // 10 % 2}",
+                        },
+                        headers={"Accept": "*/*"},
+                    )
+                else:
+                    res = http.get(paths[index % 3], headers={"Accept": "*/*"})
+                assert res.status_code == 200, res.text
+                if index % every == 0:
+                    current, _ = tracemalloc.get_traced_memory()
+                    print(
+                        f"soak: {index} requests in {time.time() - start:.1f}s, "
+                        f"{current / 1024:.0f} KiB, "
+                        f"{game.client.memory()['objects']} objects in the session"
+                    )
+        finally:
+            tracemalloc.stop()
+
+
+def bench_profiles(requests=200, saves=20):
+    """
+    Throughput of walks, loops and saves for every storage profile (check
+    settings.STORAGE_PROFILES)
+    """
+    # pylint: --disable=C0415
+    from gensim import server
+    from gensim.management.db import copy_db
+
+    _quiet()
+    headers = {"Accept": "*/*"}
+    with TemporaryDirectory() as directory:
+        for profile in settings.STORAGE_PROFILES:
+            url = make_db(directory, name=profile)
+            make_world(Client(url))
+            game = Game(Client(url, profile=profile))
+            game.client.compile_events()
+            server.app.games.set("current", game)
+            http = server.app.test_client()
+
+            start = time.time()
+            for index in range(requests):
+                res = http.post(
+                    "/api/event/trigger/walk/",
+                    json={"character": "anon", "destination": f"location_{index % 2}"},
+                    headers=headers,
+                )
+                assert res.status_code == 200, res.text
+            _report(f"walk ({profile})", requests, time.time() - start)
+
+            start = time.time()
+            for _ in range(requests):
+                res = http.get("/api/event/loop", headers=headers)
+                assert res.status_code == 200, res.text
+            _report(f"loop ({profile})", requests, time.time() - start)
+
+            db_file = url.split("///")[1]
+            start = time.time()
+            for _ in range(saves):
+                copy_db(db_file, Path(directory) / f"{profile}.gsav")
+            _report(f"save ({profile})", saves, time.time() - start)
+            server.app.games.close("current")
+
+
+def bench_saves(rows=50000, saves=5):
+    """
+    Time and size of full and differential saves (check settings.DIFF_SAVES)
+    of a big world after a few turns
+    """
+    # pylint: --disable=C0415
+    from gensim import server
+    from gensim.management import db as man_db
+
+    _quiet()
+    with TemporaryDirectory() as directory:
+        url = make_db(directory)
+        make_world(Client(url), locations=2, characters=1, events=1)
+        client = Client(url)
+        client.session.execute(
+            insert(Character),
+            [
+                {
+                    "name": f"extra_{index}",
+                    "energy": 100,
+                    "home_name": "Bench",
+                    "location_name": "location_0",
+                }
+                for index in range(rows)
+            ],
+        )
+        client.session.commit()
+        client.close()
+        world = url.split("///")[1]
+        digest = man_db.store_base(world)
+
+        game = Game(Client(url))
+        game.client.compile_events()
+        server.app.games.set("current", game)
+        http = server.app.test_client()
+        try:
+            for index in range(20):
+                res = http.post(
+                    "/api/event/trigger/walk/",
+                    json={"character": "anon", "destination": f"location_{index % 2}"},
+                    headers={"Accept": "*/*"},
+                )
+                assert res.status_code == 200, res.text
+
+            for label, save in (
+                ("full", man_db.copy_db),
+                ("diff", lambda source, file: man_db.save_diff(source, file, digest)),
+            ):
+                save_file = Path(directory) / f"{label}.gsav"
+                start = time.time()
+                for _ in range(saves):
+                    save(world, save_file)
+                elapsed = time.time() - start
+                print(
+                    f"save ({label}): {elapsed / saves * 1000:.1f} ms, "
+                    f"{save_file.stat().st_size / 1024:.0f} KiB"
+                )
+        finally:
+            server.app.games.close("current")
+            man_db.base_file(digest).unlink()
+
+
+def bench_migrate(rows=50000):
+    """
+    Time to upgrade a big save of an older version in place (check
+    gensim.db.migrate) against building its world again
+    """
+    # pylint: --disable=C0415
+    import sqlite3
+
+    from gensim.db import migrate
+
+    _quiet()
+    with TemporaryDirectory() as directory:
+        start = time.time()
+        url = make_db(directory)
+        make_world(Client(url), locations=2, characters=1, events=1)
+        client = Client(url)
+        client.session.execute(
+            insert(Character),
+            [
+                {
+                    "name": f"extra_{index}",
+                    "energy": 100,
+                    "home_name": "Bench",
+                    "location_name": "location_0",
+                }
+                for index in range(rows)
+            ],
+        )
+        client.session.commit()
+        client.close()
+        print(f"build: {time.time() - start:.2f}s")
+
+        # a new column, index and table since the save was written
+        db = sqlite3.connect(url.split("///")[1])
+        db.execute("ALTER TABLE character DROP COLUMN is_player")
+        db.execute("DROP INDEX ix_character_name")
+        db.execute("DROP TABLE IF EXISTS meta")
+        db.commit()
+        db.close()
+
+        start = time.time()
+        migrate(url)
+        print(f"migrate: {time.time() - start:.2f}s")
+        start = time.time()
+        migrate(url)
+        print(f"migrate (current): {(time.time() - start) * 1000:.1f} ms")
+
+
+def bench_build(events=2000, one_by_one=1):
+    """
+    Time to build a script of declarative events in build mode (check
+    gensim.serializers.bulk_build) and one commit at a time (unless
+    `one_by_one` is 0, it's slow)
+    """
+    # pylint: --disable=C0415
+    from gensim import serializers
+
+    _quiet()
+    # dialog files that don't exist
+    logging.getLogger("user_info").setLevel(logging.ERROR)
+
+    modes = (("build mode", True), ("one by one", False))
+    for label, bulk in modes if one_by_one else modes[:1]:
+        with TemporaryDirectory() as directory:
+            url = make_db(directory)
+            client = Client(url)
+            make_world(client, locations=2, characters=20, events=0)
+            for index in range(20):
+                client.create_relationship(from_="anon", to=f"character_{index}")
+            client.session.commit()
+            script = [
+                serializers.make_cls(
+                    serializers.Chat,
+                    name=f"scripted_{index}",
+                    character_name=f"character_{index % 20}",
+                    effects=[
+                        serializers.prel_eff(change=5),
+                        serializers.time_eff(minutes=30),
+                    ],
+                )
+                for index in range(events)
+            ]
+
+            start = time.time()
+            if bulk:
+                with serializers.bulk_build(client):
+                    for cls in script:
+                        cls(client)
+            else:
+                for cls in script:
+                    cls(client)
+            elapsed = time.time() - start
+            built = client.get_event().count()
+            client.close()
+        assert built == events, built
+        print(f"build ({label}): {events} events in {elapsed:.2f}s")
+
+
+BENCHMARKS = {
+    "build": bench_build,
+    "cluster": bench_cluster,
+    "index": bench_index,
+    "loop": bench_loop,
+    "migrate": bench_migrate,
+    "profiles": bench_profiles,
+    "saves": bench_saves,
+    "soak": bench_soak,
+    "threads": bench_threads,
+}
+
+
+def run(args=None):
+    args = args if args is not None else sys.argv[2:]
+    name = args[0] if args else "loop"
+    if name not in BENCHMARKS:
+        print(f"Bad benchmark {name}. Available: {', '.join(BENCHMARKS)}")
+        return
+    BENCHMARKS[name](*map(int, args[1:]))
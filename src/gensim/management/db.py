@@ -1,9 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
 import logging
-from functools import wraps
-from glob import glob
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial, wraps
+import hashlib
+import importlib
+import json
+import lzma
+import os
 from pathlib import Path
+import sqlite3
+import threading
 import time
 import shutil
+from types import SimpleNamespace
+import uuid
 
 try:
     import yaml
@@ -12,13 +24,20 @@ except ImportError:
 
 from gensim.data import models, events
 from gensim.data.player import make_player
+from gensim import serializers
 from gensim.api import Client
 from gensim.db import (
     create_db,
+    migrate,
+    MigrationError,
+    SCHEMA_KEY,
+    storage_profile,
+    Base,
     Area,
     Location,
     Event,
-    db_schema_modified,
+    Meta,
+    Relationship,
     EFFECT_CLASSES,
 )
 from gensim.conf import settings
@@ -31,13 +50,36 @@ DB_FILE = Path(ENGINE.split("///")[1])
 logger = logging.getLogger("user_info." + __name__)
 logger.info("Engine: %s. Saves: %s. DB file: %s", ENGINE, SAVES, DB_FILE)
 
+_setup_lock = threading.Lock()
+# saves copied in the background and the last one of every game (save id)
+_backups = ThreadPoolExecutor(
+    max_workers=settings.FILE_WORKERS, thread_name_prefix="gensim-save"
+)
+_background_saves = {}
+
+
+@contextmanager
+def _file_lock(path):
+    """Lock shared with the other processes (check gensim.dispatch)"""
+    with open(path, "w", encoding="utf-8") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _world_lock():
+    return _file_lock(DB_FILE.parent / (DB_FILE.name + ".lock"))
+
 
 def yml_data(yfile):
     def inner(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             with open(settings.DATA_DIR / yfile, encoding="utf8") as file:
-                data = yaml.safe_load(file)
+                # files with only comments are empty
+                data = yaml.safe_load(file) or {}
             return func(data, *args, **kwargs)
 
         return wrapper
@@ -61,6 +103,14 @@ def _locations(c, names, **kwargs):
 
 
 def _setup_declarative(c, module):
+    if settings.BULK_BUILD:
+        with serializers.bulk_build(c):
+            _make_declarative(c, module)
+    else:
+        _make_declarative(c, module)
+
+
+def _make_declarative(c, module):
     for cls in module.__dir__():
         if cls.startswith("_"):
             continue
@@ -225,31 +275,195 @@ def grep_dialog(client, old_name, new_name):
                 dialog.text = dialog.text.replace(old_name, new_name)
 
 
+# Incremental builds: the hash of every source of the world is kept in the Meta
+# table ("source:<path>") with the effects that read every dialog file
+# ("dialog:<path>"). When some of them change only what was built from them is
+# built again
+SOURCE_KEY = "source:"
+DIALOG_KEY = "dialog:"
+# source -> steps building what comes from it. The effects point to the
+# relationships so they are built again too. Any other source (paths,
+# characters, the player, the serializers...) builds the whole world again
+SOURCE_STEPS = {
+    "data/globals.yaml": ("globals",),
+    "data/relationships.yaml": ("relationships", "events"),
+    "data/events.py": ("events",),
+}
+
+
+def world_sources():
+    """Files the world is built from (relative to BASE_DIR) and their sha256"""
+    files = [
+        path
+        for path in settings.DATA_DIR.rglob("*")
+        if path.is_file() and "__pycache__" not in path.parts
+    ]
+    files.append(settings.BASE_DIR / "serializers.py")
+    return {
+        str(path.relative_to(settings.BASE_DIR)): file_hash(path)
+        for path in sorted(files)
+    }
+
+
+def _stored_sources(c):
+    """Sources of the world when it was built and the effects of the dialogs"""
+    sources, dialogs = {}, {}
+    for key, value in c.session.query(Meta.key, Meta.value):
+        if key.startswith(SOURCE_KEY):
+            sources[key[len(SOURCE_KEY) :]] = value
+        elif key.startswith(DIALOG_KEY):
+            dialogs[key[len(DIALOG_KEY) :]] = json.loads(value)
+    return sources, dialogs
+
+
+def _record_sources(c, sources, dialogs=None):
+    """
+    Keep the hashes of the sources and the effects of the dialogs (read by the
+    last build if `dialogs` is None)
+    """
+    if dialogs is None:
+        dialogs = {}
+        for path, effect, dialog in c.session.info.pop("dialog_files", ()):
+            path = str(Path(path).relative_to(settings.BASE_DIR))
+            dialogs.setdefault(path, []).append(
+                [effect.__table__.name, effect.id, dialog]
+            )
+    c.session.query(Meta).filter(
+        Meta.key.startswith(SOURCE_KEY) | Meta.key.startswith(DIALOG_KEY)
+    ).delete(synchronize_session=False)
+    c.session.add_all(
+        [Meta(key=SOURCE_KEY + path, value=digest) for path, digest in sources.items()]
+        + [
+            Meta(key=DIALOG_KEY + path, value=json.dumps(effects))
+            for path, effects in dialogs.items()
+        ]
+    )
+    c.session.commit()
+
+
+@yml_data("globals.yaml")
+def refresh_globals(data, c):
+    """
+    Update the global stats in place (the effects point to them). False if some
+    of them were removed
+    """
+    stats = {stat.label: stat for stat in c.get_global()}
+    if stats.keys() - data.keys():
+        return False
+    alice = c.get_character(name="Alice Liddell").one()
+    for label, value in data.items():
+        if label in stats:
+            stats[label].value = value
+        else:
+            c.create_stat(label=label, value=value, character=alice)
+    c.session.commit()
+    return True
+
+
+def clear_events(c):
+    """Delete the events and everything that points to them"""
+    tables = {Event.__table__}
+    for table in Base.metadata.sorted_tables:
+        if any(key.column.table in tables for key in table.foreign_keys):
+            tables.add(table)
+    for table in reversed(Base.metadata.sorted_tables):
+        if table in tables:
+            c.session.execute(table.delete())
+    c.session.commit()
+    c.session.expunge_all()
+
+
+def refresh_dialog(c, paths, dialogs):
+    """Read the dialog files again for the effects that use them"""
+    effects = {cls.__table__.name: cls for cls in EFFECT_CLASSES.values()}
+    for path in paths:
+        for table, effect_id, dialog in dialogs.get(path, ()):
+            effect = c.session.get(effects[table], effect_id)
+            c.session.query(effect.dialog).filter_by(parent_id=effect_id).delete()
+            dialog = getattr(serializers, dialog)
+            dialog._effect = SimpleNamespace(obj=effect)
+            for chunk in serializers._get_dialog_chunks(settings.BASE_DIR / path):
+                effect.available_dialog.append(dialog(text=chunk, client=c).obj)
+    c.session.commit()
+
+
+def update_world(c):
+    """
+    Build again what was built from the sources that changed since the world
+    was built. False if it has to be built from scratch
+    """
+    sources = world_sources()
+    stored, dialogs = _stored_sources(c)
+    changed = sorted(
+        path
+        for path in stored.keys() | sources.keys()
+        if stored.get(path) != sources.get(path)
+    )
+    steps = set()
+    for path in changed:
+        if path.startswith("data/dialog/"):
+            steps.add("dialog")
+        elif path in SOURCE_STEPS:
+            steps.update(SOURCE_STEPS[path])
+        else:
+            logger.info("%s changed. The world will be built from scratch", path)
+            return False
+    if not steps:
+        return True
+
+    start = time.time()
+    if "globals" in steps and not refresh_globals(c):
+        logger.info("Some globals were removed. The world will be built from scratch")
+        return False
+    if "relationships" in steps:
+        c.session.query(Relationship).delete()
+        setup_relationships(c)
+    if "events" in steps:
+        clear_events(c)
+        importlib.reload(events)
+        setup_events(c)
+        # read again
+        dialogs = None
+    elif "dialog" in steps:
+        refresh_dialog(c, changed, dialogs)
+    _record_sources(c, sources, dialogs)
+    logger.info(
+        "Built %s again in %.3fs (%s changed)",
+        ", ".join(sorted(steps)),
+        time.time() - start,
+        ", ".join(changed),
+    )
+    return True
+
+
 def setup_database(**kwargs):
     """
     Wraps the functions that create every single object required to start a gaem.
     The order of execution is important.
+
+    If the world was built already only what comes from the sources that changed
+    is built again (check update_world).
     """
     assert yaml, "Can't create a new database without pyaml installed"
     player_name = kwargs["name"]
     if DB_FILE.exists():
-        # if any file in the data directory has beed modified
-        # then we see if it is the same player as before
+        # the schema is upgraded in place (if needed) and if the world can be
+        # updated we see if it is the same player as before
         # this speeds up testing a lot
-        if (
-            not db_schema_modified("data")
-            and not db_schema_modified("db.py")
-            and not db_schema_modified("serializers.py")
-        ):
+        try:
+            migrate(ENGINE)
             ccheck = Client(url=ENGINE)
+        except MigrationError as exc:
+            logger.warning("Can't migrate %s (%s)", DB_FILE, exc)
+            ccheck = None
+        if ccheck is not None:
             p = ccheck.get_player()
-            if len(p.all()) == 1:
+            if len(p.all()) == 1 and update_world(ccheck):
                 player_obj = p.one()
                 if player_obj.name == player_name:
                     # nothing to do here
                     logger.info(
-                        "DB has not changed since last time it has built,"
-                        "the data havent changed either and the player is the"
+                        "The world is up to date and the player is the "
                         "same (%s)... nothing to do",
                         player_name,
                     )
@@ -260,16 +474,18 @@ def setup_database(**kwargs):
 
                     ccheck.session.commit()
                     logger.info(
-                        "DB has not changed since last time it has built,"
-                        "the data havent changed either. We only changed the name of"
+                        "The world is up to date. We only changed the name of "
                         "the player (and all references to him) to %s",
                         player_name,
                     )
+                ccheck.close()
                 return
+            ccheck.close()
         logger.warning("db file exists. moving it")
         shutil.move(DB_FILE, DB_FILE.parent / "db-bk.sqlite3")
     create_db(ENGINE)
     c = Client(url=ENGINE)
+    sources = world_sources()
 
     # timer
     start = time.time()
@@ -303,6 +519,8 @@ def setup_database(**kwargs):
     setup_events(c)
     logger.info("########## Created events ##########")
 
+    _record_sources(c, sources)
+    c.close()
     logger.info("DB populated in %d seconds", time.time() - start)
 
 
@@ -313,28 +531,719 @@ def get_save(num="current"):
     return "sqlite:///" + str(save_file)
 
 
+def get_game(save="current"):
+    """
+    Url of the database a game (save id) is played on. They are named
+    game-<save id> so they are never mistaken for the numbered slots
+    """
+    url = get_save(f"game-{save}")
+    game_file = Path(url.split("///")[1])
+    # older versions played on db.save.<save id>.gsav
+    legacy = Path(get_save(save).split("///")[1])
+    if not str(save).isdigit() and legacy.exists() and not game_file.exists():
+        logger.info("Moving game %s to %s", legacy, game_file)
+        Path(str(legacy) + "-shm").unlink(missing_ok=True)
+        if Path(str(legacy) + "-wal").exists():
+            os.replace(str(legacy) + "-wal", str(game_file) + "-wal")
+        os.replace(legacy, game_file)
+    return url
+
+
+# Saves (numbered slots and the autosaves of every game, autosave-<save id>-<n>)
+# are compressed with lzma if settings.COMPRESS_SAVES and listed in a catalog so
+# they can be listed without opening them
+CATALOG = SAVES / "catalog.json"
+AUTOSAVE_PREFIX = "autosave-"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+_catalog_lock = threading.Lock()
+
+
+_backfilled = False
+
+
+def _load_catalog():
+    try:
+        with open(CATALOG, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_catalog(catalog):
+    partial_file = CATALOG.with_name(CATALOG.name + ".part")
+    with open(partial_file, "w", encoding="utf-8") as file:
+        json.dump(catalog, file, indent=2)
+    os.replace(partial_file, CATALOG)
+
+
+def read_catalog():
+    """
+    slot -> metadata of the save. The saves written before the catalog (or
+    before it had their base) are added the first time it's read
+    """
+    global _backfilled  # pylint: disable=W0603
+    if not _backfilled:
+        with _catalog_lock, _file_lock(CATALOG.with_suffix(".lock")):
+            catalog = _load_catalog()
+            missing = [
+                (slot, path)
+                for slot, path in _slot_files()
+                if "base" not in catalog.get(slot, {})
+            ]
+            for slot, path in missing:
+                logger.info("Adding save %s to the catalog", path)
+                stat = path.stat()
+                saved_at = datetime.fromtimestamp(stat.st_mtime)
+                catalog[slot] = {
+                    "slot": int(slot) if slot.isdigit() else slot,
+                    "saved_at": saved_at.isoformat(timespec="seconds"),
+                    "size": stat.st_size,
+                    "checksum": file_hash(path),
+                    **catalog.get(slot, {}),
+                    **_inspect_save(path),
+                }
+            if missing:
+                _write_catalog(catalog)
+            _backfilled = True
+    return _load_catalog()
+
+
+def _slot_files():
+    """(slot, path) of every save file (the numbered slots and the autosaves)"""
+    pattern = Path(settings.DATABASES["play"]["engine"].split("///")[1])
+    prefix = pattern.name.split("{num}")[0]
+    for path in pattern.parent.glob(pattern.name.format(num="*")):
+        slot = path.name[len(prefix) :].split(".")[0]
+        if slot.isdigit() or slot.startswith(AUTOSAVE_PREFIX):
+            yield slot, path
+
+
+def _rows(db, table, diff):
+    """Source of the rows of a table of a save (replayed on the base if a diff)"""
+    if not diff:
+        return f'main."{table}"'
+    saved = set(_tables(db, "main", internal=True))
+    columns, key = _columns(db, "base", table)
+    rows = f'SELECT {_quote(columns)} FROM base."{table}"'
+    if f"__removed_{table}" in saved:
+        key = _quote(key or columns)
+        rows += f' WHERE ({key}) NOT IN (SELECT {key} FROM main."__removed_{table}")'
+    if table in saved:
+        rows += f' UNION ALL SELECT {_quote(columns)} FROM main."{table}"'
+    return f"({rows})"
+
+
+def _save_info(path):
+    """Player, game time and base world of a save (its raw database)"""
+    diff = is_diff(path)
+    db = sqlite3.connect(path)
+    try:
+        digest = None
+        if diff:
+            (digest,) = db.execute(
+                "SELECT value FROM __meta WHERE key = 'base'"
+            ).fetchone()
+            db.execute("ATTACH DATABASE ? AS base", (str(base_file(digest)),))
+        player = db.execute(
+            f"SELECT name FROM {_rows(db, 'character', diff)} WHERE is_player"
+        ).fetchone()
+        game_time = db.execute(
+            f"SELECT value FROM {_rows(db, 'stat', diff)} WHERE label = 'time'"
+            " AND chara_name = 'Alice Liddell'"
+        ).fetchone()
+    finally:
+        db.close()
+    return {
+        "player": player[0] if player else None,
+        "time": game_time and datetime.fromtimestamp(game_time[0]).isoformat(),
+        # hash of the base world of a differential save
+        "base": digest,
+    }
+
+
+def _inspect_save(path):
+    """_save_info of a save file (compressed or not)"""
+    unpacked = None
+    try:
+        if is_compressed(path):
+            unpacked = path.with_name(path.name + ".inspect")
+            decompress(path, unpacked)
+        return _save_info(unpacked or path)
+    except (sqlite3.Error, lzma.LZMAError) as exc:
+        logger.warning("Can't read save %s: %r", path, exc)
+        return {"player": None, "time": None, "base": None}
+    finally:
+        if unpacked is not None:
+            unpacked.unlink(missing_ok=True)
+
+
+def _catalog_save(num, save_file, info):
+    """
+    :param info: _save_info of the save, read before it's compressed
+    """
+    entry = {
+        "slot": num,
+        **info,
+        "saved_at": datetime.now().isoformat(timespec="seconds"),
+        "size": save_file.stat().st_size,
+        "checksum": file_hash(save_file),
+    }
+    with _catalog_lock, _file_lock(CATALOG.with_suffix(".lock")):
+        catalog = _load_catalog()
+        catalog[str(num)] = entry
+        _write_catalog(catalog)
+
+
+def list_saves():
+    # the numbered slots first
+    return sorted(
+        read_catalog().values(),
+        key=lambda save: (isinstance(save["slot"], str), save["slot"]),
+    )
+
+
 def total_saves():
-    return len(glob(str(SAVES / "*.gsav")))
+    return len(read_catalog())
+
 
+def compress(source, destination, preset=settings.COMPRESS_LEVEL):
+    """lzma a file chunk by chunk"""
+    destination = Path(destination)
+    partial_file = destination.with_name(destination.name + ".part")
+    with open(source, "rb") as file, lzma.open(
+        partial_file, "wb", preset=preset
+    ) as compressed:
+        shutil.copyfileobj(file, compressed, 1 << 20)
+    os.replace(partial_file, destination)
 
-def new_game(**kwargs):
-    logger.info("Setting up new game")
 
-    setup_database(**kwargs)
-    shutil.copy(DB_FILE, get_save("current").split("///")[-1])
+def decompress(source, destination):
+    with lzma.open(source, "rb") as compressed, open(destination, "wb") as file:
+        shutil.copyfileobj(compressed, file, 1 << 20)
 
 
-def load_game(num):
-    logger.info("Loading game #%d", num)
+def is_compressed(path):
+    with open(path, "rb") as file:
+        return file.read(len(XZ_MAGIC)) == XZ_MAGIC
 
-    save_file = get_save(num)
-    shutil.copy(save_file.split("///")[-1], get_save().split("///")[-1])
 
+class _Restarted(Exception):
+    pass
 
-def save_game(num):
-    logger.info("Saving game #%d", num)
+
+def _backup(source_db, target, pages):
+    """
+    Copy `pages` pages per step. With a rollback journal the read lock is only
+    held during the steps so the game can commit in between, but then the
+    copy starts over: after settings.BACKUP_RESTARTS restarts everything is
+    copied in one step (blocking the writers meanwhile). A WAL database is
+    copied from a snapshot instead, which doesn't block the writers at all.
+    """
+    if source_db.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        source_db.execute("BEGIN")
+        try:
+            source_db.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            source_db.backup(target, pages=pages)
+        finally:
+            source_db.execute("COMMIT")
+        return
+
+    restarts = 0
+    last = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > settings.BACKUP_RESTARTS:
+                raise _Restarted()
+        last = remaining
+
+    try:
+        source_db.backup(target, pages=pages, progress=progress)
+    except _Restarted:
+        logger.warning("The database changed while copying it. Copying at once")
+        source_db.backup(target)
+
+
+def copy_db(source, destination, pages=settings.BACKUP_PAGES):
+    """
+    Copy a database with SQLite's online backup API: the copy is consistent even
+    if the source is open and being written, and big saves are copied a few
+    pages at a time. It's written next to the destination and moved over it
+    once it's complete.
+
+    :param pages: Pages copied by every step (0 to copy everything at once)
+    """
+    destination = Path(destination)
+    partial_file = destination.with_name(destination.name + ".part")
+    partial_file.unlink(missing_ok=True)
+
+    start = time.time()
+    # no implicit transactions, _backup handles them
+    source_db = sqlite3.connect(source, isolation_level=None)
+    target = sqlite3.connect(partial_file)
+    try:
+        _backup(source_db, target, pages or -1)
+    finally:
+        target.close()
+        source_db.close()
+
+    _replace(partial_file, destination)
+    logger.debug("Copied %s to %s in %.2fs", source, destination, time.time() - start)
+
+
+def _replace(partial_file, destination):
+    # a WAL left by the old file would be replayed on the new one
+    for suffix in ("-wal", "-shm"):
+        Path(str(destination) + suffix).unlink(missing_ok=True)
+    os.replace(partial_file, destination)
+
+
+# ioctl cloning a file (Linux, only on filesystems with reflinks: btrfs, xfs...)
+FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def fork_db(source, destination):
+    """
+    Copy-on-write copy of a database: the files are cloned in constant time
+    and share the pages neither of them changes. The writers are held off
+    meanwhile so the clone is consistent (with the WAL, if any). Filesystems
+    without reflinks get a copy_db instead.
+
+    :return: "reflink" or "copy"
+    """
+    destination = Path(destination)
+    partial_file = destination.with_name(destination.name + ".part")
+    files = [("", Path(source))]
+    db = sqlite3.connect(source, isolation_level=None, timeout=30)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            wal = Path(str(source) + "-wal")
+            if wal.exists():
+                files.append(("-wal", wal))
+            for suffix, path in files:
+                _reflink(path, str(partial_file) + suffix)
+        finally:
+            db.execute("ROLLBACK")
+    except OSError as exc:
+        logger.info("Can't clone %s (%s). Copying it", source, exc)
+        for suffix, _ in files:
+            Path(str(partial_file) + suffix).unlink(missing_ok=True)
+        copy_db(source, destination)
+        return "copy"
+    finally:
+        db.close()
+
+    Path(str(destination) + "-shm").unlink(missing_ok=True)
+    if len(files) > 1:
+        os.replace(str(partial_file) + "-wal", str(destination) + "-wal")
+    else:
+        Path(str(destination) + "-wal").unlink(missing_ok=True)
+    os.replace(partial_file, destination)
+    return "reflink"
+
+
+# forks are hosted games named fork-<id>, apart from the slots and the other
+# games
+FORK_PREFIX = "fork-"
+
+
+def fork_game(save="current", fork=None):
+    """
+    Fork a game into another save to play it (X-Gensim-Save: <fork>) alongside
+    its parent
+
+    :param fork: Save id of the fork (fork-<id>), a new one by default
+    :return: Save id of the fork
+    :raise ValueError: If `fork` isn't a fork id
+    :raise FileExistsError: If there is a game `fork` already
+    """
+    fork = fork or f"{FORK_PREFIX}{uuid.uuid4().hex[:12]}"
+    if not fork.startswith(FORK_PREFIX) or fork == save:
+        raise ValueError(f"Forks are named {FORK_PREFIX}<id>, not {fork}")
+    destination = Path(get_game(fork).split("///")[-1])
+    # nobody else forks into it meanwhile
+    with _file_lock(destination.parent / "fork.lock"):
+        if destination.exists():
+            raise FileExistsError(f"There is a game {fork} already")
+        method = fork_db(get_game(save).split("///")[-1], destination)
+    logger.info("Forked game %s into %s (%s)", save, fork, method)
+    return fork
+
+
+# Differential saves: only the rows that differ from the master world the game
+# was built from. The world is kept as a base file named by its hash so the
+# saves can be replayed on it even after it's rebuilt, and the hash is kept in
+# the Meta table of the game ("base_world") when it's created. The bases no
+# game or save is built from are removed (check collect_bases).
+# A diff is a SQLite file with a table for every table of the game holding its
+# new (added or changed) rows, a "__removed_<table>" table with the primary
+# keys of its old (deleted or changed) rows and a "__meta" table.
+BASE_KEY = "base_world"
+_hashes = {}
+
+
+def file_hash(path):
+    """sha256 of a file, cached while it isn't modified"""
+    stat = os.stat(path)
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def base_file(digest):
+    return SAVES / f"base.{digest[:16]}.gbase"
+
+
+def store_base(world=None):
+    """Keep a copy of the world (DB_FILE by default) and return its hash"""
+    world = world or DB_FILE
+    digest = file_hash(world)
+    if not base_file(digest).exists():
+        logger.info("Storing base world %s", base_file(digest))
+        copy_db(world, base_file(digest))
+    return digest
+
+
+def record_base(path, digest):
+    """Keep the hash of the base world in the database `path` (None clears it)"""
+    db = sqlite3.connect(path)
+    try:
+        with db:
+            db.execute("DELETE FROM meta WHERE key = ?", (BASE_KEY,))
+            if digest is not None:
+                db.execute(
+                    "INSERT INTO meta (key, value) VALUES (?, ?)", (BASE_KEY, digest)
+                )
+    finally:
+        db.close()
+
+
+def _meta(path, key):
+    """Value of the Meta table of the database `path` (None if it has none)"""
+    db = sqlite3.connect(path)
+    try:
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        # older than the Meta table
+        row = None
+    finally:
+        db.close()
+    return row and row[0]
+
+
+def game_base(path):
+    """Hash of the base world of the database `path` (None if it has none)"""
+    return _meta(path, BASE_KEY)
+
+
+def collect_bases():
+    """
+    Remove the base worlds neither the world, a hosted game nor a save is
+    built from. Call it holding the _world_lock
+    """
+    pattern = Path(settings.DATABASES["play"]["engine"].split("///")[1])
+    used = set()
+    if DB_FILE.exists():
+        used.add(file_hash(DB_FILE))
+    for path in pattern.parent.glob(pattern.name.format(num="game-*")):
+        used.add(game_base(path))
+    catalog = read_catalog()
+    for slot, _ in _slot_files():
+        used.add(catalog.get(slot, {}).get("base"))
+    used = {base_file(digest) for digest in used if digest}
+    for path in SAVES.glob("base.*.gbase"):
+        if path not in used:
+            logger.info("Removing unused base world %s", path)
+            path.unlink(missing_ok=True)
+
+
+def _tables(db, schema="main", internal=False):
+    """Tables of a database (and the internal ones of the diffs if `internal`)"""
+    names = db.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")
+    return [
+        name
+        for (name,) in names
+        if not name.startswith("sqlite_") and (internal or not name.startswith("__"))
+    ]
+
+
+def _columns(db, schema, table):
+    """Names of the columns of a table and its primary key"""
+    # (cid, name, type, notnull, default, pk)
+    info = db.execute(f'PRAGMA {schema}.table_info("{table}")').fetchall()
+    key = [column[1] for column in sorted(info, key=lambda c: c[5]) if column[5]]
+    return [column[1] for column in info], key
+
+
+def _quote(columns, alias=None):
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(f'{prefix}"{column}"' for column in columns)
+
+
+def _diff_table(db, table):
+    """
+    Copy the new rows of a table of the save and the keys of the old rows of
+    the base to the diff. Joined by primary key (the base's index does the
+    lookups) unless there's none.
+    """
+    columns, key = _columns(db, "save", table)
+    if not key:
+        db.execute(
+            f'CREATE TABLE "{table}" AS SELECT * FROM save."{table}"'
+            f' EXCEPT SELECT * FROM base."{table}"'
+        )
+        db.execute(
+            f'CREATE TABLE "__removed_{table}" AS SELECT * FROM base."{table}"'
+            f' EXCEPT SELECT * FROM save."{table}"'
+        )
+        return
+
+    on = f"({_quote(key, 'b')}) = ({_quote(key, 's')})"
+    differs = f"({_quote(columns, 's')}) IS NOT ({_quote(columns, 'b')})"
+    # added and changed rows
+    db.execute(
+        f'CREATE TABLE "{table}" AS SELECT s.* FROM save."{table}" AS s'
+        f' LEFT JOIN base."{table}" AS b ON {on}'
+        f' WHERE b."{key[0]}" IS NULL OR {differs}'
+    )
+    # deleted and changed rows
+    db.execute(
+        f'CREATE TABLE "__removed_{table}" AS SELECT {_quote(key, "b")}'
+        f' FROM base."{table}" AS b LEFT JOIN save."{table}" AS s ON {on}'
+        f' WHERE s."{key[0]}" IS NULL OR {differs}'
+    )
+
+
+def save_diff(source, destination, digest):
+    """
+    Write the rows of the database `source` that differ from the base `digest`
+    (check store_base) to `destination`
+    """
+    destination = Path(destination)
+    partial_file = destination.with_name(destination.name + ".part")
+    partial_file.unlink(missing_ok=True)
+
+    start = time.time()
+    db = sqlite3.connect(partial_file, isolation_level=None)
+    try:
+        db.execute("ATTACH DATABASE ? AS save", (str(source),))
+        db.execute("ATTACH DATABASE ? AS base", (str(base_file(digest)),))
+        # one read transaction so the save doesn't change meanwhile
+        db.execute("BEGIN")
+        db.execute("CREATE TABLE __meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("INSERT INTO __meta VALUES ('base', ?)", (digest,))
+        base_tables = set(_tables(db, "base"))
+        for table in _tables(db, "save"):
+            if table in base_tables:
+                _diff_table(db, table)
+            else:
+                db.execute(f'CREATE TABLE "{table}" AS SELECT * FROM save."{table}"')
+        # unchanged tables
+        for table in _tables(db, internal=True):
+            if not db.execute(f'SELECT 1 FROM "{table}" LIMIT 1').fetchone():
+                db.execute(f'DROP TABLE "{table}"')
+        db.execute("COMMIT")
+        db.execute("DETACH DATABASE save")
+        db.execute("DETACH DATABASE base")
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+    _replace(partial_file, destination)
+    logger.debug("Diffed %s to %s in %.2fs", source, destination, time.time() - start)
+
+
+def is_diff(path):
+    db = sqlite3.connect(path)
+    try:
+        return bool(
+            db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = '__meta'"
+            ).fetchone()
+        )
+    finally:
+        db.close()
+
+
+def load_diff(diff, destination):
+    """
+    Rebuild the database saved in `diff` (check save_diff) in `destination`
+
+    :return: Hash of its base world
+    """
+    destination = Path(destination)
+    partial_file = destination.with_name(destination.name + ".replay")
+
+    start = time.time()
+    db = sqlite3.connect(diff)
+    try:
+        (digest,) = db.execute("SELECT value FROM __meta WHERE key = 'base'").fetchone()
+    finally:
+        db.close()
+    assert base_file(digest).exists(), f"Base world {base_file(digest)} is missing"
+    copy_db(base_file(digest), partial_file)
+
+    db = sqlite3.connect(partial_file, isolation_level=None)
+    try:
+        db.execute("ATTACH DATABASE ? AS diff", (str(diff),))
+        saved = set(_tables(db, "diff", internal=True))
+        tables = _tables(db)
+        db.execute("BEGIN")
+        for table in tables:
+            if f"__removed_{table}" in saved:
+                columns, key = _columns(db, "main", table)
+                key = _quote(key or columns)
+                db.execute(
+                    f'DELETE FROM main."{table}" WHERE ({key}) IN'
+                    f' (SELECT {key} FROM diff."__removed_{table}")'
+                )
+            if table in saved:
+                columns = _quote(_columns(db, "diff", table)[0])
+                db.execute(
+                    f'INSERT INTO main."{table}" ({columns})'
+                    f' SELECT {columns} FROM diff."{table}"'
+                )
+        # tables the base doesn't have
+        for table in set(_tables(db, "diff")).difference(tables):
+            db.execute(f'CREATE TABLE main."{table}" AS SELECT * FROM diff."{table}"')
+        db.execute("COMMIT")
+        db.execute("DETACH DATABASE diff")
+    finally:
+        db.close()
+
+    _replace(partial_file, destination)
+    logger.debug("Replayed %s to %s in %.2fs", diff, destination, time.time() - start)
+    return digest
+
+
+def new_game(save="current", **kwargs):
+    logger.info("Setting up new game (%s)", save)
+
+    # several games can be created at the same time (even by several
+    # processes) but there is only one master database
+    with _setup_lock, _world_lock():
+        setup_database(**kwargs)
+        game_file = get_game(save).split("///")[-1]
+        copy_db(DB_FILE, game_file)
+        # the saves of the game are diffed against the world it was built from
+        if settings.DIFF_SAVES:
+            record_base(game_file, store_base())
+        collect_bases()
+
+
+def load_game(num, save="current"):
+    logger.info("Loading game #%s into %s", num, save)
+
+    save_file = Path(get_save(num).split("///")[-1])
+    destination = Path(get_game(save).split("///")[-1])
+    # the game is only replaced once the save is unpacked and upgraded
+    partial_file = destination.with_name(destination.name + ".loading")
+    unpacked = None
+    try:
+        if is_compressed(save_file):
+            unpacked = destination.with_name(destination.name + ".unpacked")
+            decompress(save_file, unpacked)
+            save_file = unpacked
+        if is_diff(save_file):
+            digest = load_diff(save_file, partial_file)
+            # saved before the games recorded their base
+            if not game_base(partial_file):
+                record_base(partial_file, digest)
+        elif unpacked is not None:
+            os.replace(unpacked, partial_file)
+        else:
+            copy_db(save_file, partial_file)
+        # saves of older versions are upgraded when they are loaded (a
+        # MigrationError if they aren't playable with this version)
+        if migrate("sqlite:///" + str(partial_file), profile=storage_profile("play")):
+            # its old base doesn't have the same tables anymore: the upgraded
+            # save is the base of the next saves
+            if settings.DIFF_SAVES:
+                with _world_lock():
+                    record_base(partial_file, store_base(partial_file))
+            else:
+                record_base(partial_file, None)
+        _replace(partial_file, destination)
+    finally:
+        for path in (unpacked, partial_file):
+            if path is not None:
+                for suffix in ("", "-wal", "-shm"):
+                    Path(str(path) + suffix).unlink(missing_ok=True)
+
+
+def save_game(num, save="current", background=False):
+    """
+    :param num: Slot number (or name of an autosave)
+    :param background: Copy the save in the background and return its Future
+    """
+    if background:
+        status = {"slot": num, "status": "saving", "started": time.time()}
+        _background_saves[save] = status
+        future = _backups.submit(save_game, num, save=save)
+        future.add_done_callback(partial(_background_save_done, save, status))
+        return future
+    logger.info("Saving game %s to #%s", save, num)
 
     save_file = Path(get_save(num).split("///")[-1])
     if save_file.exists():
         logger.warning("Save file %s exists. Replacing...", save_file)
-    shutil.copy(get_save().split("///")[-1], save_file)
+    source = get_game(save).split("///")[-1]
+    assert Path(source).exists(), f"There is no game {save}"
+    # the database is written first and then compressed
+    raw_file = save_file
+    if settings.COMPRESS_SAVES:
+        raw_file = save_file.with_name(save_file.name + ".raw")
+    # games created before the bases were recorded (or whose base is gone)
+    # are saved whole
+    digest = settings.DIFF_SAVES and game_base(source) or None
+    if digest and not base_file(digest).exists():
+        logger.warning("Base world of game %s is missing", save)
+        digest = None
+    # (or whose schema was upgraded since)
+    if digest and _meta(base_file(digest), SCHEMA_KEY) != _meta(source, SCHEMA_KEY):
+        logger.warning("Base world of game %s has another schema", save)
+        digest = None
+    try:
+        if digest:
+            save_diff(source, raw_file, digest)
+        else:
+            copy_db(source, raw_file)
+        info = _save_info(raw_file)
+        if settings.COMPRESS_SAVES:
+            compress(raw_file, save_file)
+    finally:
+        if raw_file != save_file:
+            raw_file.unlink(missing_ok=True)
+    _catalog_save(num, save_file, info)
+    # the save it replaced may have been the last one built from its base
+    with _world_lock():
+        collect_bases()
+
+
+def _background_save_done(save, status, future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Saving game %s to #%s failed: %r", save, status["slot"], exc)
+        status.update(status="failed", error=str(exc))
+    else:
+        status["status"] = "done"
+    status["finished"] = time.time()
+
+
+def background_save_status(save="current"):
+    """Status of the last save of the game copied in the background (or None)"""
+    status = _background_saves.get(save)
+    return dict(status) if status is not None else None
@@ -1,7 +1,7 @@
 import os
 import sys
 
-from gensim.db import create_db
+from gensim.db import migrate
 from gensim.conf import settings
 from gensim.management import db
 from gensim.test.test_ft import run_test_server
@@ -14,7 +14,9 @@ def get_command(command: list = sys.argv[1]):
         import gensim.test.shell
 
     elif command == "migrate":
-        create_db()
+        # upgrade the schema of the database in place (saves are upgraded
+        # when they are loaded)
+        migrate(settings.DATABASES["default"]["engine"])
 
     elif command == "test":
         os.system(f"python -m pytest {settings.BASE_DIR / 'test'}")
@@ -22,11 +24,26 @@ def get_command(command: list = sys.argv[1]):
     elif command == "runserver":
         runserver()
 
+    elif command == "runcluster":
+        from gensim.dispatch import runcluster
+
+        runcluster(*map(int, sys.argv[2:3]))
+
+    elif command == "runasgi":
+        from gensim.asgi import runserver as runasgi
+
+        runasgi()
+
     elif command == "livetest":
         run_test_server()
     elif command == "setup":
         db.setup_database(name="anon")
 
+    elif command == "bench":
+        from gensim.management import bench
+
+        bench.run()
+
     else:
         print(f"Bad command {command}")
 
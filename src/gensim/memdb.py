@@ -0,0 +1,201 @@
+"""
+In-memory working database (settings.WORKING_DB = "memory").
+
+The save is loaded into memory when the game is opened and every read and
+write is served from there. The save file is only written by checkpoints: every
+settings.CHECKPOINT_INTERVAL seconds (if something changed), before saving the
+game and when it's closed.
+
+With settings.CHECKPOINT_JOURNAL the committed writes are also appended to
+<save>.journal (synced on every commit) and replayed when the game is opened
+again, so a crash doesn't lose what happened since the last checkpoint.
+"""
+import base64
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.event import listen
+
+from gensim.conf import settings
+
+logger = logging.getLogger("user_info." + __name__)
+
+
+# the parameters of the statements are written to the journal as JSON. Blobs
+# (like the calendar) are kept as {"b64": <base64>}
+def _encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"b64": base64.b64encode(bytes(value)).decode("ascii")}
+    raise TypeError(f"Can't journal {type(value).__name__} parameters")
+
+
+def _decode(obj):
+    if obj.keys() == {"b64"}:
+        return base64.b64decode(obj["b64"])
+    return obj
+
+
+def _fsync(path):
+    """Flush a file (or the entries of a directory) to the disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WorkingCopy:
+    """
+    In-memory copy of a save file. There is only one connection (it's shared by
+    the sessions of every thread) so whoever uses it must hold the lock; the
+    server holds it for the whole request.
+
+    :param path: Save file
+    :param interval: Seconds between checkpoints (0 to only checkpoint on
+        demand)
+    :param journal: Keep a journal of the writes since the last checkpoint
+    """
+
+    def __init__(
+        self,
+        path,
+        interval=settings.CHECKPOINT_INTERVAL,
+        journal=settings.CHECKPOINT_JOURNAL,
+    ):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.journal = journal
+        self.lock = threading.RLock()
+        self.dirty = False
+        # statements of the current transaction (for the journal)
+        self._pending = []
+        self._stop = threading.Event()
+        self._thread = None
+
+        start = time.time()
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        source = sqlite3.connect(self.path)
+        try:
+            source.backup(self.connection)
+            # checkpoints so far (check checkpoint)
+            (self.generation,) = source.execute("PRAGMA user_version").fetchone()
+        finally:
+            source.close()
+        logger.info("Loaded %s into memory in %.2fs", self.path, time.time() - start)
+        self._replay()
+
+        if interval:
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(interval,),
+                daemon=True,
+                name="gensim-checkpoint",
+            )
+            self._thread.start()
+
+    def connect(self):
+        """creator of the engine (with a StaticPool)"""
+        return self.connection
+
+    def attach(self, engine):
+        """Track the writes of the engine"""
+        listen(engine, "after_cursor_execute", self._after_execute)
+        listen(engine, "commit", self._commit)
+        listen(engine, "rollback", self._rollback)
+
+    # SQLAlchemy events
+    def _after_execute(self, conn, cursor, statement, parameters, context, many):
+        if statement.lstrip()[:6].upper() not in ("SELECT", "PRAGMA"):
+            self.dirty = True
+            if self.journal:
+                self._pending.append((statement, parameters, many))
+
+    def _commit(self, conn):
+        if self.journal and self._pending:
+            with open(self.journal_path, "a", encoding="utf-8") as file:
+                if file.tell() == 0:
+                    file.write(json.dumps({"generation": self.generation}) + "\n")
+                for entry in self._pending:
+                    file.write(json.dumps(entry, default=_encode) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        self._pending.clear()
+
+    def _rollback(self, conn):
+        self._pending.clear()
+
+    def _replay(self):
+        """Apply the journal left by a game that didn't checkpoint"""
+        if not self.journal_path.exists():
+            return
+        with open(self.journal_path, encoding="utf-8") as file:
+            header = file.readline()
+            # written by a checkpoint that is already in the file
+            if not header or json.loads(header)["generation"] != self.generation:
+                entries = []
+            else:
+                entries = [
+                    json.loads(line, object_hook=_decode)
+                    for line in file
+                    if line.strip()
+                ]
+        if entries:
+            logger.warning(
+                "Replaying %d statements of %s", len(entries), self.journal_path
+            )
+            for statement, parameters, many in entries:
+                if many:
+                    self.connection.executemany(statement, parameters)
+                else:
+                    self.connection.execute(statement, parameters)
+            self.connection.commit()
+            self.dirty = True
+            self.checkpoint()
+        else:
+            self.journal_path.unlink()
+
+    def checkpoint(self):
+        """Write the database to the save file (if it changed)"""
+        with self.lock:
+            if not self.dirty:
+                return
+            start = time.time()
+            partial_file = self.path.with_name(self.path.name + ".part")
+            partial_file.unlink(missing_ok=True)
+            target = sqlite3.connect(partial_file)
+            try:
+                self.connection.backup(target)
+                # the journal written from now on applies to this generation
+                target.execute(f"PRAGMA user_version = {self.generation + 1}")
+                target.commit()
+            finally:
+                target.close()
+            # the journal can only go once the new save is on the disk
+            _fsync(partial_file)
+            for suffix in ("-wal", "-shm"):
+                Path(str(self.path) + suffix).unlink(missing_ok=True)
+            os.replace(partial_file, self.path)
+            _fsync(self.path.parent)
+            self.generation += 1
+            self.journal_path.unlink(missing_ok=True)
+            self.dirty = False
+            logger.info("Checkpointed %s in %.2fs", self.path, time.time() - start)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.checkpoint()
+            except Exception as exc:  # pylint: disable=W0703
+                logger.error("Checkpoint of %s failed: %r", self.path, exc)
+
+    def close(self):
+        """Last checkpoint. The connection is closed by the engine"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.checkpoint()
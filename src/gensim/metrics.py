@@ -0,0 +1,262 @@
+"""
+Performance metrics of the server, exposed at /api/metrics in the Prometheus
+text format:
+
+- latency of every endpoint (histogram)
+- SQL statements run and time spent on them by every endpoint
+- events evaluated and completed by every trigger pass (histograms)
+- autosaves: how many, how long they wait in the queue and how long they take
+
+Only settings.METRICS_SAMPLE_RATE of the requests are measured. With 0 nothing
+is hooked at all so there is no overhead.
+"""
+from bisect import bisect_left
+import random
+import threading
+import time
+
+from flask import Response, request
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listen
+
+from gensim.conf import settings
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# events
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    :param name: Name of the metric (gensim_*)
+    :param help_: Description
+    :param labels: Names of the labels; every observation passes their values
+    """
+
+    type_ = None
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type_}"
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def __init__(self, name, help_, labels=()):
+        super().__init__(name, help_, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = buckets
+        # labels -> [count of every bucket (not cumulative) + +Inf, sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            counts, _ = self.values[labels]
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels][1] += value
+
+    def render(self):
+        yield from super().render()
+        with self.lock:
+            values = [
+                (labels, list(counts), sum_)
+                for labels, (counts, sum_) in self.values.items()
+            ]
+        names = (*self.labels, "le")
+        for labels, counts, sum_ in values:
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                yield f"{self.name}_bucket{_labels(names, (*labels, bound))} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {sum_}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = (line for metric in self.metrics for line in metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(
+    Histogram(
+        "gensim_request_duration_seconds",
+        "Time spent handling the requests",
+        labels=("endpoint", "method", "status"),
+    )
+)
+SQL_STATEMENTS = REGISTRY.register(
+    Counter(
+        "gensim_sql_statements_total",
+        "SQL statements run by the requests",
+        labels=("endpoint",),
+    )
+)
+SQL_TIME = REGISTRY.register(
+    Counter(
+        "gensim_sql_seconds_total",
+        "Time spent running SQL statements by the requests",
+        labels=("endpoint",),
+    )
+)
+TRIGGER_EVALUATED = REGISTRY.register(
+    Histogram(
+        "gensim_trigger_evaluated_events",
+        "Events evaluated by every trigger pass",
+        buckets=SIZE_BUCKETS,
+    )
+)
+TRIGGER_COMPLETED = REGISTRY.register(
+    Histogram(
+        "gensim_trigger_completed_events",
+        "Events completed by every trigger pass",
+        buckets=SIZE_BUCKETS,
+    )
+)
+AUTOSAVES = REGISTRY.register(
+    Counter(
+        "gensim_autosaves_total",
+        "Autosaves by trigger and status",
+        labels=("trigger", "status"),
+    )
+)
+AUTOSAVE_LAG = REGISTRY.register(
+    Histogram(
+        "gensim_autosave_lag_seconds",
+        "Time autosaves wait in the queue after being triggered",
+    )
+)
+AUTOSAVE_DURATION = REGISTRY.register(
+    Histogram(
+        "gensim_autosave_duration_seconds",
+        "Time spent writing the autosaves",
+    )
+)
+
+# stats of the request being measured in this thread (None if it's not sampled)
+_local = threading.local()
+
+
+def sampled():
+    return getattr(_local, "request", None) is not None
+
+
+def observe_trigger(evaluated, completed):
+    if sampled():
+        TRIGGER_EVALUATED.observe(evaluated)
+        TRIGGER_COMPLETED.observe(completed)
+
+
+# SQLAlchemy events
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, "request", None)
+    if stats is not None:
+        stats["sql_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, "request", None)
+    if stats is not None and "sql_start" in stats:
+        stats["sql_statements"] += 1
+        stats["sql_time"] += time.perf_counter() - stats.pop("sql_start")
+
+
+# Flask hooks
+def _start_request():
+    _local.request = None
+    if random.random() < settings.METRICS_SAMPLE_RATE:
+        _local.request = {
+            "start": time.perf_counter(),
+            "sql_statements": 0,
+            "sql_time": 0.0,
+        }
+
+
+def _end_request(response):
+    stats = getattr(_local, "request", None)
+    if stats is None:
+        return response
+
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+
+    def observe():
+        _local.request = None
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - stats["start"],
+            endpoint,
+            method,
+            response.status_code,
+        )
+        SQL_STATEMENTS.inc(endpoint, amount=stats["sql_statements"])
+        SQL_TIME.inc(endpoint, amount=stats["sql_time"])
+
+    # once the response is sent: after the teardown (commit) and the whole
+    # body of the streams
+    response.call_on_close(observe)
+    return response
+
+
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+def instrument(app):
+    """Measure the requests of the app and serve the metrics at /api/metrics"""
+    app.add_url_rule("/api/metrics", "metrics", metrics)
+    if settings.METRICS_SAMPLE_RATE <= 0:
+        return
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    listen(Engine, "after_cursor_execute", _after_cursor_execute)
@@ -2,12 +2,17 @@
 Serializers for creating populated data models declaratively. (Using Python classes to
 put data in the DB)
 """
+from contextlib import contextmanager
 from logging import getLogger
 
 # from functools import lru_cache
 from uuid import uuid4
 
+from sqlalchemy import func, insert, inspect, select
+from sqlalchemy.orm import MANYTOMANY, MANYTOONE
+
 from gensim.db import (
+    Base,
     # Terrain,
     Path,
     Event,
@@ -29,7 +34,7 @@ from gensim.log import logged
 
 DATA_DIR = settings.BASE_DIR / "data"
 
-logger = getLogger("user-info." + __name__)
+logger = getLogger("user_info." + __name__)
 
 
 #
@@ -55,6 +60,228 @@ class TextDescriptor:
         self._text = self._text.format(**var_dict).strip()
 
 
+# Build mode (check bulk_build)
+class Builder:
+    """
+    Collects the objects made by the serializers instead of adding them to the
+    session and writes them with one bulk insert per table. Their primary keys
+    are assigned beforehand so the foreign keys can be filled from their
+    relationships without flushing.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.objects = []
+        # (getter, filters) -> object, check _one
+        self.cache = {}
+        # mapper -> how to make its rows, check _plan
+        self.plans = {}
+
+    def add(self, obj):
+        self.objects.append(obj)
+
+    def one(self, getter, **filters):
+        key = (getter, tuple(sorted(filters.items())))
+        if key not in self.cache:
+            self.cache[key] = getattr(self.client, getter)(**filters).one()
+        return self.cache[key]
+
+    def _plan(self, mapper):
+        """
+        Columns of a model (attribute, column, default) and its relationships
+        (attribute, is a list, direction, [(attribute, column)] to copy)
+        """
+        if mapper not in self.plans:
+            columns = []
+            for attr in mapper.column_attrs:
+                column = attr.columns[0]
+                default = None
+                if column.default is not None and column.default.is_scalar:
+                    default = column.default.arg
+                columns.append((attr.key, column.key, default))
+            relationships = []
+            for prop in mapper.relationships:
+                if prop.direction is MANYTOMANY:
+                    relationships.append(
+                        (prop, prop.key, prop.uselist, self._association(mapper, prop))
+                    )
+                    continue
+                if prop.direction is MANYTOONE:
+                    pairs = [
+                        (prop.mapper.get_property_by_column(remote).key, local.key)
+                        for local, remote in prop.local_remote_pairs
+                    ]
+                else:
+                    pairs = [
+                        (mapper.get_property_by_column(local).key, remote.key)
+                        for local, remote in prop.local_remote_pairs
+                    ]
+                relationships.append((prop, prop.key, prop.uselist, pairs))
+            self.plans[mapper] = (columns, relationships)
+        return self.plans[mapper]
+
+    @staticmethod
+    def _association(mapper, prop):
+        """
+        [(attribute, column)] to copy from both sides of a many to many
+        relationship to the rows of its association table, and the columns of
+        the table it can't fill (it only gets the keys and the defaults)
+        """
+        local = [
+            (mapper.get_property_by_column(column).key, secondary.key)
+            for column, secondary in prop.synchronize_pairs
+        ]
+        remote = [
+            (prop.mapper.get_property_by_column(column).key, secondary.key)
+            for column, secondary in prop.secondary_synchronize_pairs
+        ]
+        filled = {secondary for _, secondary in local + remote}
+        required = [
+            column.key
+            for column in prop.secondary.columns
+            if column.key not in filled
+            and not column.nullable
+            and not column.primary_key
+            and column.default is None
+            and column.server_default is None
+        ]
+        return local, remote, required
+
+    def _collect(self):
+        """The objects added and the new ones they point to (like a cascade)"""
+        objects = {}
+        pending = list(reversed(self.objects))
+        while pending:
+            obj = pending.pop()
+            state = inspect(obj)
+            if id(obj) in objects or not state.transient:
+                continue
+            objects[id(obj)] = (obj, state)
+            for _, key, uselist, _ in self._plan(state.mapper)[1]:
+                value = state.dict.get(key)
+                if value is not None:
+                    pending.extend(value if uselist else (value,))
+        return list(objects.values())
+
+    def _assign_keys(self, objects):
+        next_ids = {}
+        for obj, state in objects:
+            if state.dict.get("id") is not None:
+                continue
+            table = obj.__table__
+            if table not in next_ids:
+                last = self.client.session.execute(select(func.max(table.c.id)))
+                next_ids[table] = (last.scalar() or 0) + 1
+            obj.id = next_ids[table]
+            next_ids[table] += 1
+
+    def write(self):
+        """Insert the objects (in the transaction of the session)"""
+        objects = self._collect()
+        self._assign_keys(objects)
+        rows = {}
+        for obj, state in objects:
+            values = state.dict
+            rows[id(obj)] = {
+                column: values.get(key, default)
+                for key, column, default in self._plan(state.mapper)[0]
+            }
+
+        # the foreign keys, from the relationships of both sides
+        associations = {}
+        for obj, state in objects:
+            row = rows[id(obj)]
+            for prop, key, uselist, pairs in self._plan(state.mapper)[1]:
+                value = state.dict.get(key)
+                # (events are falsy when they aren't available)
+                if value is None or (uselist and not value):
+                    continue
+                if prop.direction is MANYTOMANY:
+                    # a row of the association table for every pair (once, the
+                    # backref may list it on the other side too)
+                    local, remote, required = pairs
+                    if required:
+                        raise ValueError(
+                            f"{prop} can't be built in build mode: its association"
+                            f" table needs {', '.join(required)}"
+                        )
+                    keys = [(column, getattr(obj, attr)) for attr, column in local]
+                    for child in value:
+                        association = keys + [
+                            (column, getattr(child, attr)) for attr, column in remote
+                        ]
+                        associations.setdefault(prop.secondary, set()).add(
+                            frozenset(association)
+                        )
+                    continue
+                if prop.direction is MANYTOONE:
+                    for attr, column in pairs:
+                        row[column] = getattr(value, attr)
+                    continue
+                for child in value if uselist else (value,):
+                    if id(child) in rows:
+                        for attr, column in pairs:
+                            rows[id(child)][column] = getattr(obj, attr)
+
+        tables = {}
+        for obj, _ in objects:
+            tables.setdefault(obj.__table__, []).append(rows[id(obj)])
+        session = self.client.session
+        for table in Base.metadata.sorted_tables:
+            if table in tables:
+                session.execute(insert(table), tables[table])
+        # once both sides are there
+        for table, pairs in associations.items():
+            session.execute(insert(table), [dict(row) for row in pairs])
+        api.written(session, [table.name for table in (*tables, *associations)])
+        # in case a backref put some of them in the session
+        for obj, _ in objects:
+            if obj in session:
+                session.expunge(obj)
+        logger.info("Built %d rows in %d tables", len(objects), len(tables))
+
+
+def building(client):
+    """Builder of the session of the client (None if it's not in build mode)"""
+    builder = client.session.info.get("builder")
+    return builder if isinstance(builder, Builder) else None
+
+
+@contextmanager
+def bulk_build(client):
+    """
+    Build mode: what the serializers make in the block is written at the end
+    with bulk inserts in one transaction, and their targets (the player, the
+    globals...) are only looked up once
+    """
+    builder = client.session.info["builder"] = Builder(client)
+    try:
+        yield builder
+        builder.write()
+        client.session.commit()
+    except BaseException:
+        client.session.rollback()
+        raise
+    finally:
+        del client.session.info["builder"]
+
+
+def _add(client, obj):
+    builder = building(client)
+    if builder is not None:
+        builder.add(obj)
+    else:
+        client.session.add(obj)
+
+
+def _one(client, getter, **filters):
+    """getattr(client, getter)(**filters).one(), cached in build mode"""
+    builder = building(client)
+    if builder is not None:
+        return builder.one(getter, **filters)
+    return getattr(client, getter)(**filters).one()
+
+
 #
 class Serializer:
     """
@@ -114,7 +341,7 @@ class Serializer:
         in the database
         """
         self.obj = self.model(**self._get_kw())  # pylint: --disable=not-callable
-        self.client.session.add(self.obj)
+        _add(self.client, self.obj)
 
 
 class GenericTableSerializer(Serializer):
@@ -220,7 +447,7 @@ class DialogWPlayer(GenericDialog):
 
     @property
     def player(self):
-        return self.client.get_player().one().name
+        return _one(self.client, "get_player").name
 
 
 class GenericEffect(GenericTableSerializer):
@@ -269,6 +496,11 @@ class GenericEffect(GenericTableSerializer):
             self.obj.available_dialog.append(
                 self._dialog(text=chunk, client=client).obj
             )
+        # to read it again when the file changes (check
+        # gensim.management.db.update_world)
+        client.session.info.setdefault("dialog_files", []).append(
+            (filename, self.obj, self._dialog.__name__)
+        )
 
 
 class TimeEffect(GenericEffect):
@@ -282,7 +514,7 @@ class TimeEffect(GenericEffect):
 
     @property
     def target(self):
-        return self.client.get_global(label="time").one()
+        return _one(self.client, "get_global", label="time")
 
 
 class NoEffect(GenericEffect):
@@ -298,7 +530,7 @@ class NoEffect(GenericEffect):
 
     @property
     def target(self):
-        return self.client.get_player().one()
+        return _one(self.client, "get_player")
 
 
 class GenericBuff(Serializer):
@@ -403,7 +635,7 @@ class GenericEvent(Serializer):
                 name = event.name
 
             event_lock = EventLock(key=self.name, lock=name)
-            self.client.session.add(event_lock)
+            _add(self.client, event_lock)
 
         for event in self.locked_by:
             if isinstance(event, str):
@@ -412,8 +644,10 @@ class GenericEvent(Serializer):
                 name = event.name
 
             event_lock = EventLock(key=name, lock=self.name)
-            self.client.session.add(event_lock)
-        self.client.session.commit()
+            _add(self.client, event_lock)
+        # written at the end in build mode
+        if not building(self.client):
+            self.client.session.commit()
 
 
 #
@@ -456,7 +690,7 @@ class ScheduleMixin:
             date_indexes=date_indexes,
             type_=self.schedule_type,
         )
-        self.client.session.add(obj)
+        _add(self.client, obj)
 
 
 class ScheduleWork(ScheduleMixin):
@@ -472,7 +706,7 @@ class ScheduleDaily(ScheduleMixin):
 class PlayerMixin:
     @property
     def player(self):
-        return self.client.get_player().one()
+        return _one(self.client, "get_player")
 
 
 class CharacterMixin:
@@ -495,7 +729,7 @@ class CharacterMixin:
 
     @property
     def character_obj(self):
-        return self.client.get_character(name=self.character_name).one()
+        return _one(self.client, "get_character", name=self.character_name)
 
 
 class PlayerRelationshipMixin(PlayerMixin, CharacterMixin):
@@ -506,9 +740,12 @@ class PlayerRelationshipMixin(PlayerMixin, CharacterMixin):
 
     @property
     def target(self):
-        return self.client.get_relationship(
-            from_=self.player.name, to=self.character_name
-        ).one()
+        return _one(
+            self.client,
+            "get_relationship",
+            from_=self.player.name,
+            to=self.character_name,
+        )
 
 
 class PlayerStatEffect(GenericEffect, PlayerMixin):
@@ -517,7 +754,9 @@ class PlayerStatEffect(GenericEffect, PlayerMixin):
 
     @property
     def target(self):
-        return self.client.get_stat(chara_name=self.player.name, label=self.label).one()
+        return _one(
+            self.client, "get_stat", chara_name=self.player.name, label=self.label
+        )
 
 
 class MoveEffect(GenericEffect, CharacterMixin):
@@ -540,7 +779,7 @@ class TimeRequirement(GenericRequirement):
 
     @property
     def target(self):
-        return self.client.get_global(label="time").one()
+        return _one(self.client, "get_global", label="time")
 
 
 # API
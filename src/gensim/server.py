@@ -1,27 +1,129 @@
+import atexit
 from datetime import datetime
+from functools import wraps
+import gc
+from inspect import signature
 from json.encoder import JSONEncoder
 import re
+import resource
+import tracemalloc
+from urllib.parse import urlsplit
 
-from flask import Blueprint, Flask, request, make_response
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    g,
+    make_response,
+    request,
+    stream_with_context,
+)
 from flask_classful import FlaskView, route
 from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
+from werkzeug.routing import RequestRedirect
 
+from gensim import metrics
 from gensim.api import Client
+from gensim.autosave import Autosaver
 from gensim.conf import settings
-from gensim.db import Base, Event
+from gensim.db import (
+    Base,
+    Command,
+    CommandMap,
+    Event,
+    MigrationError,
+    storage_profile,
+)
+from gensim.game import Game, GameManager, request_save_id
 from gensim.management import db as man_db
+from gensim.memdb import WorkingCopy
 from gensim.cronie import Notice
 
 
 api = Blueprint("api", __name__)
 
 app = Flask(__name__)
+metrics.instrument(app)
 api = Blueprint("api", __name__, url_prefix="/api")
 
-try:
-    app.client = Client(man_db.get_save("current"))
-except AssertionError:
-    app.client = None  # maybe point to the master db?
+def open_game(save_id, new=False):
+    url = man_db.get_game(save_id)
+    working = None
+    if settings.WORKING_DB == "memory":
+        working = WorkingCopy(url.split("///")[1])
+    game = Game(Client(url, profile=storage_profile("play"), working=working), working)
+    game.client.compile_events()
+    # get today to keep a schedule
+    # NOTE not just the day because it will break at the end
+    # of the month and that would be silly
+    game.today = game.client.get_time()
+    if new:
+        # XXX reset calendar
+        # make it so we trigger from a date to another
+        game.client.create_calendar(game.calendar)
+        game.client.commit()
+    else:
+        game.calendar = game.client.get_calendar()
+    return game
+
+
+app.games = GameManager(open_game)
+# games in memory are written to their save file when they are closed
+atexit.register(app.games.close_all)
+app.autosaver = Autosaver(app.games)
+
+
+def get_save_id():
+    """Game (save) of the request. Defaults to the current save"""
+    save_id = request_save_id(request.headers, request.args)
+    if save_id is None:
+        raise APIException("Invalid save id")
+    return save_id
+
+
+def current_game():
+    if g.get("game") is None:
+        raise NoGame()
+    return g.game
+
+
+# client of the game of the request
+client = LocalProxy(lambda: current_game().client)
+
+
+def hold_lock():
+    """
+    Hold the lock of the game until the request is over, so its writes are
+    committed (check commit_request) before another request reads them.
+    """
+    if not g.get("locked"):
+        current_game().lock.acquire()
+        g.locked = True
+
+
+def release_lock():
+    if g.pop("locked", False):
+        current_game().lock.release()
+
+
+def locked(function):
+    """
+    Requests are handled concurrently; only one of them can advance the
+    game (time and calendar) at a time.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        hold_lock()
+        return function(*args, **kwargs)
+
+    return wrapper
 
 
 class ModelSerializer(JSONEncoder):
@@ -34,10 +136,167 @@ class ModelSerializer(JSONEncoder):
 encoder = ModelSerializer()
 
 
+def _orjson_default(o):
+    if isinstance(o, Base):
+        return o.as_dict()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def dumps(data) -> str:
+    """Encode a response. orjson is a lot faster; use it if it's installed"""
+    if orjson is not None and settings.FAST_JSON:
+        return orjson.dumps(
+            data, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return encoder.encode(data)
+
+
+def replaces_game(function):
+    """
+    The view closes the game of the request and hosts another one, so it runs
+    without it (closing a game waits for the requests using it)
+    """
+    function.replaces_game = True
+    return function
+
+
+# one unit of work for each request
+@api.before_request
+def begin_request():
+    view = app.view_functions.get(request.endpoint)
+    if getattr(view, "replaces_game", False):
+        g.game = None
+        return
+    try:
+        g.game = app.games.get(get_save_id())
+    except AssertionError:
+        # there is no save yet
+        g.game = None
+        return
+    if g.game.working is not None:
+        # the game in memory has only one connection
+        hold_lock()
+    g.client = g.game.client
+    g.client.begin()
+    g.unit_of_work = True
+
+
+def keep_snapshot():
+    """Restore the game in memory (calendar...) if the request is rolled back"""
+    g.snapshot = current_game().snapshot()
+
+
+def end_unit_of_work(exc=None):
+    """Commit the writes of the request (rollback if it failed)"""
+    if not g.pop("unit_of_work", False):
+        return
+    snapshot = g.pop("snapshot", None)
+    try:
+        g.client.end(exc)
+    except BaseException:
+        # the commit failed and was rolled back
+        if snapshot is not None:
+            g.game.restore(snapshot)
+        raise
+    if exc is not None:
+        if snapshot is not None:
+            g.game.restore(snapshot)
+        return
+    save_id = request_save_id(request.headers, request.args)
+    app.autosaver.notify(save_id, g.game)
+
+
+@api.after_request
+def commit_request(response):
+    """
+    Commit before the response is sent so a failed commit isn't answered with
+    a 200. Streamed responses commit before their last chunk (check
+    EventAPIView.loop_stream).
+    """
+    # not response.is_streamed: the errors (HTTPException) are iterators too
+    if g.get("streaming"):
+        return response
+    failed = None
+    if response.status_code >= 400:
+        failed = f"status {response.status_code}"
+    try:
+        end_unit_of_work(failed)
+    except Exception as exc:  # pylint: disable=W0703
+        app.logger.error("Commit of %s failed: %r", request.path, exc)
+        return APIException(f"Couldn't save the changes: {exc}", 500).get_response()
+    return response
+
+
+@api.teardown_request
+def end_request(exc):
+    if g.get("streaming"):
+        # flask tears the request down before the stream and once it's over
+        return
+    request_client = g.get("client")
+    if request_client is not None:
+        try:
+            end_unit_of_work(exc)
+        except Exception as error:  # pylint: disable=W0703
+            app.logger.error("Commit of %s failed: %r", request.path, error)
+        # don't keep the objects of this request around
+        request_client.release()
+        g.pop("client")
+    release_lock()
+    if g.get("game") is not None:
+        app.games.release(g.game)
+
+
+def debug_memory():
+    """
+    Objects held by the sessions of every game and, if tracemalloc is
+    tracing (?trace=on|off), the lines that allocated the most memory.
+    """
+    trace = request.args.get("trace")
+    if trace is not None and not settings.DEBUG:
+        raise APIException("Tracing is only available in DEBUG mode", 403)
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError as exc:
+        raise APIException(f"Bad limit: {exc}") from exc
+    if limit < 1:
+        raise APIException("The limit must be positive")
+    if trace == "on" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif trace == "off" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    memory = {
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "gc_objects": len(gc.get_objects()),
+        "games": {
+            save_id: game.client.memory() for save_id, game in app.games.items()
+        },
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        memory["traced"] = {"current": current, "peak": peak}
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        memory["top"] = [
+            {"line": str(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in stats[:limit]
+        ]
+    return make_response(dumps(memory), 200, {"Content-Type": "application/json"})
+
+
+if settings.DEBUG:
+    app.add_url_rule("/api/debug/memory", "debug_memory", debug_memory)
+
+
+def sse(event, data):
+    """Server-sent event frame"""
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
 # REST API
 def output_json(data, code, headers=None):
     content_type = "application/json"
-    dumped = encoder.encode(data)
+    dumped = dumps(data)
     if headers:
         headers.update({"Content-Type": content_type})
     else:
@@ -46,6 +305,52 @@ def output_json(data, code, headers=None):
     return response
 
 
+def conditional(*tables):
+    """
+    Conditional GET. The ETag is made of the versions of the tables the
+    resource depends on, so unchanged resources are answered with a 304
+    without touching the database.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return function(*args, **kwargs)
+
+            versions = client.versions
+            etag = versions.etag(tables)
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = function(*args, **kwargs)
+                if isinstance(response, tuple):
+                    response = output_json(*response)
+                elif not isinstance(response, Response):
+                    response = output_json(response, 200)
+            response.set_etag(etag)
+            response.last_modified = versions.last_modified(tables)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _parse_arg(column, value: str):
+    """Query string value to the type of the column"""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is bool:
+        return value.lower() in ("1", "true", "yes")
+    try:
+        return python_type(value)
+    except ValueError as exc:
+        raise APIException(f"Bad value for {column.name}: {value}") from exc
+
+
 class APIView(FlaskView):
     representations = {"application/json": output_json}
     model = None
@@ -61,7 +366,7 @@ class APIView(FlaskView):
         return FlaskView.__new__(cls, *args, **kwargs)
 
     def get_queryset(self, method, *args, **kwargs):
-        cli = app.client
+        cli = client
         return getattr(cli, f"{method}_{self.model}")(*args, **kwargs)
 
     def post(self):
@@ -69,7 +374,53 @@ class APIView(FlaskView):
         return self.get_queryset("create", **request.json).as_dict()
 
     def index(self):
-        return self.get_queryset("get").all()
+        """
+        List of every row or, with keyset pagination, a page of them:
+
+            ?limit=N      rows per page (settings.PAGE_SIZE if there is only
+                          ?after)
+            ?after=ID     rows after this id (the X-Next-Cursor header of
+                          the previous page)
+            ?fields=a,b   only these columns (and the id)
+
+        Any other argument filters the rows (i.e. ?location_name=Library)
+        """
+        args = request.args.to_dict()
+        paginated = "limit" in args or "after" in args
+        try:
+            limit = int(args.pop("limit", settings.PAGE_SIZE))
+            limit = max(1, min(limit, settings.MAX_PAGE_SIZE))
+            after = int(args.pop("after", 0))
+        except ValueError as exc:
+            raise APIException(f"Bad pagination argument: {exc}") from exc
+        fields = args.pop("fields", None)
+        args.pop("save", None)
+
+        model = self.get_queryset("get").column_descriptions[0]["entity"]
+        columns = model.__table__.columns
+        if fields is not None:
+            fields = ["id"] + [
+                field for field in fields.split(",") if field and field != "id"
+            ]
+        for key in [*args, *(fields or ())]:
+            if key not in columns:
+                raise APIException(f"{model.__name__} has no field '{key}'")
+        filters = {key: _parse_arg(columns[key], value) for key, value in args.items()}
+
+        try:
+            query = self.get_queryset("get", **filters)
+        except TypeError as exc:
+            raise APIException(f"Bad filter: {exc}") from exc
+        query = query.filter(model.id > after).order_by(model.id)
+        if paginated:
+            query = query.limit(limit)
+        # list endpoints skip the ORM objects
+        rows = model.rows_as_dicts(query, fields)
+
+        headers = {}
+        if paginated and len(rows) == limit:
+            headers["X-Next-Cursor"] = str(rows[-1]["id"])
+        return rows, 200, headers
 
     def get(self, id):
         return self.get_queryset("get", **{self.pk_field: id}).one()
@@ -79,14 +430,14 @@ class APIView(FlaskView):
         kwargs = request.json
 
         obj = self.get_queryset("get", **{self.pk_field: id}).one()
-        nu_obj = app.client.update(obj, **kwargs)
+        nu_obj = client.update(obj, **kwargs)
 
         return nu_obj.as_dict()
 
     def delete(self, id):
         obj = self.get_queryset("get", **{self.pk_field: id}).one()
 
-        app.client.session.remove(obj)
+        client.session.remove(obj)
 
         return {}
 
@@ -95,6 +446,11 @@ class APIException(HTTPException):
     code = 400
     description = "bad request"
 
+    def __init__(self, description=None, code=None, response=None):
+        super().__init__(description, response)
+        if code is not None:
+            self.code = code
+
     def get_description(
         self,
         environ=None,
@@ -116,7 +472,7 @@ class APIException(HTTPException):
     ) -> str:
         """Get the HTML body."""
         return encoder.encode(
-            {"status_code": self.code, "errors": self.get_description}
+            {"status_code": self.code, "errors": self.get_description()}
         )
 
     def get_headers(
@@ -128,60 +484,108 @@ class APIException(HTTPException):
         return [("Content-Type", "application/json")]
 
 
+class NoGame(APIException):
+    code = 404
+    description = "There is no game for this save. Create or load one first"
+
+
 class GameAPIView(APIView):
+    @replaces_game
     def post(self):
         post_data = request.json
         if not "name" in post_data:
             raise APIException("field 'name' is required")
 
-        man_db.new_game(**post_data)
-        current_save = man_db.get_save("current")
-        app.client = Client(current_save)
-        # get today to keep a schedule
-        # NOTE not just the day because it will break at the end
-        # of the month and that would be silly
-        app.today = app.client.get_time()
-        # XXX reset calendar
-        # make it so we trigger from a date to another
-        app.calendar = None
-        app.client.create_calendar(app.calendar)
+        save_id = get_save_id()
+
+        def create():
+            man_db.new_game(save=save_id, **post_data)
+            return open_game(save_id, new=True)
+
+        app.games.replace(save_id, create)
 
-        app.logger.info("Created newge.")
-        app.client.session.commit()
+        app.logger.info("Created newge (%s).", save_id)
         return {}
 
     def index(self):
         """
         List saves
         """
-        # XXX make them save objects in man_db to add timestamp, player, etc
-        return {"num": man_db.total_saves()}
-
-    @route("/load/<int:num>/")
-    def load_game(self, num: int):
-        if num > 0:
-            # if 0 we just give the current save
-            man_db.load_game(num)
-
-        current_save = man_db.get_save("current")
-        app.client = Client(current_save)
-        app.calendar = app.client.get_calendar()
-        app.today = app.client.get_time()
+        saves = man_db.list_saves()
+        return {"num": len(saves), "saves": saves}
+
+    @route("/load/<num>/")
+    @replaces_game
+    def load_game(self, num: str):
+        """Load save #num or an autosave (autosave-<save id>-<n>)"""
+        if num.isdigit():
+            num = int(num)
+        elif (
+            not num.startswith(man_db.AUTOSAVE_PREFIX)
+            or request_save_id({}, {"save": num}) is None
+        ):
+            raise APIException(f"There is no save {num}", 404)
+        save_id = get_save_id()
+
+        def load():
+            if num != 0:
+                # if 0 we just give the current save
+                man_db.load_game(num, save=save_id)
+            return open_game(save_id)
+
+        try:
+            app.games.replace(save_id, load)
+        except MigrationError as exc:
+            raise APIException(f"Can't upgrade save #{num}: {exc}", 409) from exc
 
         return {}
 
+    @route("/fork/", methods=["POST"])
+    def fork_game(self):
+        """
+        Fork the game into another save ({"save": "fork-<id>"} or a new one)
+        that can be played at the same time
+        """
+        fork = (request.get_json(silent=True) or {}).get("save")
+        if fork is not None and request_save_id({}, {"save": fork}) is None:
+            raise APIException(f"Invalid save id {fork}")
+        if fork is not None and fork in app.games:
+            raise APIException(f"Game {fork} is being played", 409)
+        current_game().checkpoint()
+        try:
+            return {"save": man_db.fork_game(get_save_id(), fork)}
+        except ValueError as exc:
+            raise APIException(str(exc)) from exc
+        except FileExistsError as exc:
+            raise APIException(str(exc), 409) from exc
+
     @route("/save/<int:num>/")
     def save_game(self, num: int):
-        man_db.save_game(num)
-
-        return {}
-
-
-def _trigger(events):
-    completed_events = []
-    player_location = app.client.get_player().one().location
+        """?background=1 to answer right away while the save is copied"""
+        background = bool(request.args.get("background"))
+        current_game().checkpoint()
+        man_db.save_game(num, save=get_save_id(), background=background)
+
+        return {}, 202 if background else 200
+
+    @route("/save/status/")
+    def save_status(self):
+        """Status of the last ?background=1 save of the game"""
+        status = man_db.background_save_status(get_save_id())
+        if status is None:
+            raise APIException("The game wasn't saved in the background", 404)
+        return status
+
+
+def _itrigger(events):
+    """Complete the available events yielding them one by one"""
+    pruned = []
+    evaluated = completed = 0
+    player_location = client.get_player().one().location
     for event in events:
+        evaluated += 1
         if event.available:
+            completed += 1
             app.logger.info("The event %s is currently available.", event)
             effects = event.complete()
             # prune the text if the player is not in the location
@@ -203,26 +607,26 @@ def _trigger(events):
             event_info = event.as_dict()
             event_info["effects"] = effects
 
-            completed_events.append(event_info)
-
             if event.prune:
-                app.logger.warning("Pruning %s", event)
-                for effect in event.effects:
-                    app.client.session.delete(effect)
-                for req in event.requirements:
-                    app.client.session.delete(req)
-                app.client.session.delete(event)
-    app.client.session.commit()
-    return completed_events
+                app.logger.warning("Pruning %s", event.name)
+                pruned.append(event)
 
+            yield event_info
+    # one-shot events go away together
+    client.prune_events(pruned)
+    client.commit()
+    metrics.observe_trigger(evaluated, completed)
 
-def trigger(events: list) -> list:
+
+def itrigger(events: list):
     """
-    Decide what events should be triggered and how.
+    Decide what events should be triggered and how. The completed events are
+    yielded as soon as they are done (check EventAPIView.loop_stream).
     """
-    date_start = app.client.get_time()
-    completed_events = _trigger(events)
-    date_end = app.client.get_time()
+    game = current_game()
+    date_start = client.get_time()
+    yield from _itrigger(events)
+    date_end = client.get_time()
     # schedule
 
     MASKS = {
@@ -240,23 +644,23 @@ def trigger(events: list) -> list:
     }
 
     # if this is ever refactored move it to a function
-    if app.calendar is None or date_end.date() > app.today.date():
-        app.today = date_end
+    if game.calendar is None or date_end.date() > game.today.date():
+        game.today = date_end
         app.logger.info(
             "Resetting schedule. REASON: %s",
-            "NO CALENDAR" if app.calendar is None else "DATE_CHANGE",
+            "NO CALENDAR" if game.calendar is None else "DATE_CHANGE",
         )
-        notices = app.client.get_today_schedule(date_end)
+        notices = client.get_today_schedule(date_end)
         for notice in notices:
             # we set up the date, and time requirements here
             event = notice.event
             date = int(MASKS[notice.type_] + notice.date)
 
             # flush old date requirements
-            app.client.flush_date_requirements(event)
+            client.flush_date_requirements(event)
 
             # create date req
-            app.client.create_date_requirement(event, value=date)
+            client.create_date_requirement(event, value=date)
             app.logger.debug("Using date: %s", datetime.fromtimestamp(date))
             if notice.duration:
                 # create aditional req
@@ -264,145 +668,247 @@ def trigger(events: list) -> list:
                     "Event %s is continuous, adding another requirement", event
                 )
                 # negative know how the req should be evaluated
-                app.client.create_date_requirement(
+                client.create_date_requirement(
                     event, value=-(date + notice.duration)
                 )
             sched = Notice(event_id=event.id, date=date)
 
-            if app.calendar:
-                app.calendar.insert(sched)
+            if game.calendar:
+                game.calendar.insert(sched)
                 # update head
-                app.calendar = app.calendar.next()
+                game.calendar = game.calendar.next()
             else:
-                app.calendar = sched
+                game.calendar = sched
 
         # save today's schedule calendar
-        app.client.update_calendar(app.calendar)
-        app.logger.info("Calendar updated: %s", app.calendar)
+        client.update_calendar(game.calendar)
+        app.logger.info("Calendar updated: %s", game.calendar)
 
     # get all the events to the date
-    if isinstance(app.calendar, Notice):
-        sched_events = app.calendar.event_ids(
+    if isinstance(game.calendar, Notice):
+        sched_events = game.calendar.event_ids(
             date_start=int(date_start.timestamp()), date_end=int(date_end.timestamp())
         )
         # update head
-        app.calendar = sched_events["notice"]
-        if app.calendar is None:
+        game.calendar = sched_events["notice"]
+        if game.calendar is None:
             app.logger.warning("No more events for today at %s", date_end)
-            # to make "app.calendar is None" fail to force
+            # to make "game.calendar is None" fail to force
             # it to wait to tomorrow
-            app.calendar = True
+            game.calendar = True
 
         # add events
-        completed_events.extend(
-            _trigger(app.client.get_events(sched_events["event_ids"]))
+        yield from _itrigger(client.get_events(sched_events["event_ids"]))
+
+
+@locked
+def trigger(events: list) -> list:
+    return list(itrigger(events))
+
+
+def walk_to(character: str, destination: str) -> dict:
+    character = client.get_character(name=character).one()
+
+    walked: dict = client.walk(origin=character.location.name, destination=destination)
+
+    time_stat = client.get_global(label="time").one()
+    time_stat.value += walked["time"]
+    character.location = client.get_location(name=destination).one()
+
+    client.session.add(time_stat)
+    client.commit()
+
+    # trigger events
+    events = []
+    characters = list(map(lambda c: c.name, character.location.characters))
+    # NOTE add random events; trigger for every location
+    events.extend(
+        client.get_event(type_="ENCOUNTER")
+        # event
+        .filter(Event.character_name.in_(characters)).all()
+    )
+
+    completed_events = trigger(events)
+
+    walked["events"] = completed_events
+
+    return walked
+
+
+def chat_with(character: str) -> list:
+    character = client.get_character(name=character).one()
+    if character.location_name != client.get_player().one().location_name:
+        # fuck off retard
+        raise APIException(
+            description="You can not chat with a character in another location!",
+            code=400,
         )
+    # chat event
+    chat = client.get_event(type_="CHAT").filter(Event.character == character)
+    return trigger(chat)
 
-    return completed_events
 
+def loop_events(location=None):
+    """
+    1. Get the location of the player (unless we already have it)
+    2. Get global events
+    3. Get location events (flavor text for work, maybe)
+    4. Get character FLAVOR events
+    """
+    location = location or client.get_player().one().location
+    events = client.get_event(type_="GLOBAL").all()
+    characters = list(map(lambda c: c.name, location.characters))
 
-class EventAPIView(APIView):
+    #
+    events.extend(location.active_events)
+    # maybe one encounter event per character, yes?
+    events.extend(
+        client.get_event(type_="FLAVOR")
+        # event
+        .filter(Event.character_name.in_(characters)).all()
+    )
+
+    return location, characters, events
+
+
+def event_loop() -> dict:
     """
-    CRUD for Events and endpoint to trigger globals
+    Procedure to trigger events in a location. It's used often so I wrapped
+    them in a single endpoint rather than let the fron-end implement it.
+    Trigger them all and send them.
     """
+    location, characters, events = loop_events()
 
-    # action
-    @route("/trigger/walk/", methods=["POST"])
-    def walk(self):
-        character = app.client.get_character(name=request.json["character"]).one()
-        destination = request.json["destination"]
+    return {
+        "time": str(client.get_time()),
+        "location": location.name,
+        "characters": characters,
+        "events": trigger(events),
+    }
 
-        walked: dict = app.client.walk(
-            origin=character.location.name, destination=destination
-        )
 
-        time_stat = app.client.get_global(label="time").one()
-        time_stat.value += walked["time"]
-        character.location = app.client.get_location(name=destination).one()
-
-        app.client.session.add(time_stat)
-        app.client.session.commit()
-
-        # trigger events
-        events = []
-        characters = list(map(lambda c: c.name, character.location.characters))
-        # NOTE add random events; trigger for every location
-        events.extend(
-            app.client.get_event(type_="ENCOUNTER")
-            # event
-            .filter(Event.character_name.in_(characters)).all()
-        )
+def scene() -> dict:
+    """
+    Everything the CLI shows every turn in one pass over the same objects:
+    the loop, the player, the characters present, the commands available at
+    the location (the GAME ones plus the ones of its tags) and the locations
+    of the area.
+    """
+    player = client.get_player().one()
+    location = player.location
+    time = str(client.get_time())
+    location, characters, events = loop_events(location)
+    events = trigger(events)
+
+    keys = ["GAME", *(tag.name.upper() for tag in location.tags)]
+    commands = []
+    for (name,) in (
+        client.session.query(Command.name)
+        .join(Command.cmd)
+        .filter(CommandMap.key.in_(keys))
+        .order_by(Command.id)
+    ):
+        if name not in commands:
+            commands.append(name)
+
+    return {
+        "time": time,
+        "location": location.name,
+        "events": events,
+        "player": player.as_dict(),
+        "characters": [character.as_dict() for character in location.characters],
+        "commands": commands,
+        "close_locations": [place.as_dict() for place in location.area.locations],
+    }
 
-        completed_events = trigger(events)
 
-        walked["events"] = completed_events
+class EventAPIView(APIView):
+    """
+    CRUD for Events and endpoint to trigger globals
+    """
 
-        return walked
+    # action
+    @route("/trigger/walk/", methods=["POST"])
+    @locked
+    def walk(self):
+        return walk_to(request.json["character"], request.json["destination"])
 
     @route("/trigger/chat/", methods=["POST"])
     def chat(self):
-        character = app.client.get_character(name=request.json["character"]).one()
-        if character.location_name != app.client.get_player().one().location_name:
-            # fuck off retard
-            raise APIException(
-                description="You can not chat with a character in another location!",
-                code=400,
-            )
-        # chat event
-        chat = app.client.get_event(type_="CHAT").filter(Event.character == character)
-        return trigger(chat)
+        return chat_with(request.json["character"])
 
     @route("/trigger/fish/", methods=["GET"])
     def fish(self):
-        fish = app.client.get_event(type_="FISH")
+        fish = client.get_event(type_="FISH")
 
         return trigger(fish)
 
     @route("/trigger/cook/", methods=["GET"])
     def cook(self):
-        cook = app.client.get_event(type_="COOK")
+        cook = client.get_event(type_="COOK")
 
         return trigger(cook)
     #
     @route("/trigger/<name>/")
     def trigger_event(self, name: str):
-        event = app.client.get_event(name=name)
+        event = client.get_event(name=name)
 
         return trigger(event)
 
     @route("/loop")
     def loop(self):
+        return event_loop()
+
+    @route("/loop/stream")
+    def loop_stream(self):
         """
-        Procedure to trigger events in a location. It's used often so I wrapped
-        them in a single endpoint rather than let the fron-end implement it.
+        Same as loop but the events are sent (server-sent events) as soon as
+        they are completed:
 
-        2. Get global events
-        3. Get location events (flavor text for work, maybe)
-        4. Get character FLAVOR events
-        5. Trigger them all and send them
+            event: loop   -> time, location and characters
+            event: event  -> one for every completed event
+            event: end    -> number of events
         """
-        # app.client.session.commit()
-
-        location = app.client.get_player().one().location
-        events = app.client.get_event(type_="GLOBAL").all()
-        characters = list(map(lambda c: c.name, location.characters))
-
-        #
-        events.extend(location.active_events)
-        # maybe one encounter event per character, yes?
-        events.extend(
-            app.client.get_event(type_="FLAVOR")
-            # event
-            .filter(Event.character_name.in_(characters)).all()
+        game = current_game()
+        # the request is over once the stream ends (check end_request)
+        g.streaming = True
+
+        def stream():
+            try:
+                hold_lock()
+                keep_snapshot()
+                try:
+                    location, characters, events = loop_events()
+                    yield sse(
+                        "loop",
+                        {
+                            "time": str(client.get_time()),
+                            "location": location.name,
+                            "characters": characters,
+                        },
+                    )
+                    total = 0
+                    for event_info in itrigger(events):
+                        total += 1
+                        yield sse("event", event_info)
+                    end_unit_of_work()
+                except BaseException as exc:
+                    # the events failed or the client went away (GeneratorExit)
+                    end_unit_of_work(exc)
+                    raise
+                # committed; the game in memory keeps the lock until the end
+                if game.working is None:
+                    release_lock()
+                yield sse("end", {"events": total})
+            finally:
+                g.streaming = False
+
+        return Response(
+            stream_with_context(stream()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
 
-        return {
-            "time": str(app.client.get_time()),
-            "location": location.name,
-            "characters": characters,
-            "events": trigger(events),
-        }
-
 
 # character
 class CharacterAPIView(APIView):
@@ -410,6 +916,10 @@ class CharacterAPIView(APIView):
     Character CRUD view
     """
 
+    @conditional("character")
+    def index(self):
+        return super().index()
+
     def get(self, id):
         if id == "player":
             return self.get_queryset("get", **{"is_player": True}).one()
@@ -417,27 +927,175 @@ class CharacterAPIView(APIView):
 
 
 class LocationAPIView(APIView):
+    @conditional("location")
+    def index(self):
+        return super().index()
+
+    @conditional("location")
+    def get(self, id):
+        return super().get(id)
+
     @route("/<location>/characters")
+    @conditional("location", "character")
     def characters(self, location):
-        location = app.client.get_location(name=location).one()
+        location = client.get_location(name=location).one()
         return location.characters
 
 
 class AreaAPIView(APIView):
+    @conditional("area")
+    def index(self):
+        return super().index()
+
+    @conditional("area")
+    def get(self, id):
+        return super().get(id)
+
     @route("close_locations")
+    @conditional("character", "location")
     def close_locations(self):
-        return app.client.get_player().one().location.area.locations
+        return client.get_player().one().location.area.locations
 
     @route("<area>/locations")
+    @conditional("area", "location")
     def locations(self, area):
-        area = app.client.get_area(name=area).one()
+        area = client.get_area(name=area).one()
         return area.locations
 
 class CommandAPIView(APIView):
     pass
 
 class CommandMapAPIView(APIView):
-    pass
+    model = "command_map"
+    pk_field = "key"
+
+    @conditional("command_map")
+    def index(self):
+        return super().index()
+
+    @conditional("command_map")
+    def get(self, id):
+        return super().get(id)
+
+# views the get operation of the batch endpoint can read: the ones that don't
+# write (like the triggers, the saves and the event loop), stream or replace the
+# game
+BATCH_READS = {"index", "get", "characters", "locations", "close_locations"}
+
+
+def _match_path(path):
+    """(endpoint, view args) of a path the get operation can read"""
+    adapter = app.url_map.bind_to_environ(request.environ)
+    path = "/api/" + str(path).strip("/")
+    try:
+        try:
+            endpoint, view_args = adapter.match(path, method="GET")
+        except RequestRedirect as redirect:
+            # the trailing slash
+            endpoint, view_args = adapter.match(
+                urlsplit(redirect.new_url).path, method="GET"
+            )
+    except HTTPException as exc:
+        raise APIException(f"Can't get {path}: {exc.description}", exc.code) from exc
+    view = app.view_functions[endpoint]
+    if (
+        not endpoint.startswith(api.name + ".")
+        or endpoint.rsplit(":", 1)[-1] not in BATCH_READS
+        or getattr(view, "replaces_game", False)
+    ):
+        raise APIException(f"Can't get {path} in a batch")
+    return endpoint, view_args
+
+
+def get_path(path: str):
+    """Response (data) of a GET to another endpoint, i.e. character/player"""
+    endpoint, view_args = _match_path(path)
+    # flask_classful reads the arguments from the request
+    batch_view_args, request.view_args = request.view_args, view_args
+    try:
+        return app.view_functions[endpoint](**view_args).get_json()
+    finally:
+        request.view_args = batch_view_args
+
+
+# operations of the batch endpoint
+BATCH_OPERATIONS = {
+    "loop": event_loop,
+    "scene": scene,
+    "walk": walk_to,
+    "chat": chat_with,
+    "trigger": lambda name: trigger(client.get_event(name=name)),
+    "get": get_path,
+}
+
+
+class SceneAPIView(APIView):
+    excluded_methods = ["get_queryset", "get", "post", "update", "delete"]
+
+    @locked
+    def index(self):
+        return scene()
+
+
+class BatchAPIView(APIView):
+    excluded_methods = ["get_queryset", "index", "get", "update", "delete"]
+
+    @locked
+    def post(self):
+        """
+        Run several operations in one request and one transaction. If any of
+        them fails nothing is saved.
+
+            [
+                {"op": "walk", "character": "anon", "destination": "Library"},
+                {"op": "chat", "character": "Patchouli"},
+                {"op": "trigger", "name": "event_name"},
+                {"op": "loop"},
+                {"op": "scene"},
+                {"op": "get", "path": "character/player"},
+            ]
+
+        Returns the results in the same order.
+        """
+        operations = request.json
+        if not isinstance(operations, list):
+            raise APIException("Expected a list of operations")
+
+        # check every operation (and its parameters) before running any of them
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                raise APIException(f"Operation #{index}: expected an object")
+            params = dict(operation)
+            name = params.pop("op", None)
+            if name not in BATCH_OPERATIONS:
+                raise APIException(f"Operation #{index}: unknown op '{name}'")
+            try:
+                signature(BATCH_OPERATIONS[name]).bind(**params)
+                if name == "get":
+                    _match_path(params["path"])
+            except TypeError as exc:
+                raise APIException(f"Operation #{index} ({name}): {exc}") from exc
+            except APIException as exc:
+                raise APIException(
+                    f"Operation #{index} ({name}): {exc.description}", code=exc.code
+                ) from exc
+
+        keep_snapshot()
+        results = []
+        with client.transaction():
+            for index, operation in enumerate(operations):
+                params = dict(operation)
+                name = params.pop("op")
+                try:
+                    results.append(BATCH_OPERATIONS[name](**params))
+                except HTTPException as exc:
+                    raise APIException(
+                        f"Operation #{index} ({name}): {exc.description}",
+                        code=exc.code,
+                    ) from exc
+
+        return results
+
 
 _loc = locals().copy()
 _keys = _loc.keys()
@@ -451,4 +1109,4 @@ app.register_blueprint(api)
 
 
 def runserver():
-    app.run(port=settings.PORT, threaded=False)
+    app.run(port=settings.PORT, threaded=settings.THREADED)
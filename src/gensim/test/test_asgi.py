@@ -0,0 +1,118 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import unittest.mock
+
+from gensim.asgi import app
+from gensim.game import Game
+from gensim.server import app as wsgi_app
+from gensim.test.test_server import TestWorld
+
+SAVE = "asgi-test"
+
+
+def send_request(path, method="GET", query_string=b"", body=b"", save=SAVE):
+    """Run a request through the ASGI app and return the messages it sent"""
+    messages = []
+    request = {"type": "http.request", "body": body, "more_body": False}
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": [
+            (b"accept", b"*/*"),
+            (b"content-type", b"application/json"),
+            (b"x-gensim-save", save.encode()),
+        ],
+    }
+
+    async def receive():
+        return request
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def call(*args, **kwargs):
+    """Run a request through the ASGI app and return (status, headers, body)"""
+    start, *body = send_request(*args, **kwargs)
+    return (
+        start["status"],
+        dict(start["headers"]),
+        b"".join(message.get("body", b"") for message in body),
+    )
+
+
+class TestASGI(TestWorld):
+    save = SAVE
+
+    def test_view(self):
+        status, headers, body = call("/api/character/player/")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(json.loads(body)["name"], "anon")
+
+    def test_stream(self):
+        start, *body = send_request("/api/event/loop/stream")
+        self.assertEqual(start["status"], 200)
+        self.assertTrue(
+            dict(start["headers"])[b"content-type"].startswith(b"text/event-stream")
+        )
+        # every frame is sent as soon as it's produced
+        frames = [message["body"] for message in body if message["body"]]
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(frames[0].startswith(b"event: loop"))
+        self.assertTrue(frames[-1].startswith(b"event: end"))
+        self.assertFalse(body[-1]["more_body"])
+
+    def test_not_found(self):
+        status, _, _ = call("/api/nothing/")
+        self.assertEqual(status, 404)
+
+    def test_save(self):
+        with unittest.mock.patch("gensim.management.db.save_game") as save_game:
+            status, _, _ = call("/api/game/save/3/")
+            self.assertEqual(status, 200)
+            save_game.assert_called_once_with(3, save=SAVE, background=False)
+            # the game is released once it's copied
+            self.assertNotIn(wsgi_app.games.peek(SAVE), wsgi_app.games.requests)
+
+            status, _, body = call("/api/game/save/3/", save="asgi-nothing")
+            self.assertEqual(status, 404)
+            self.assertIn("no game", json.loads(body)["errors"])
+
+    def test_load(self):
+        loaded = Game(unittest.mock.MagicMock())
+        game = wsgi_app.games.get(SAVE)
+        with unittest.mock.patch(
+            "gensim.management.db.load_game"
+        ) as load_game, unittest.mock.patch(
+            "gensim.server.open_game", return_value=loaded
+        ), ThreadPoolExecutor(max_workers=1) as pool:
+            loading = pool.submit(call, "/api/game/load/2/")
+            # the game is serving a request
+            with self.assertRaises(TimeoutError):
+                loading.result(timeout=0.2)
+            load_game.assert_not_called()
+
+            wsgi_app.games.release(game)
+            status, _, _ = loading.result()
+        self.assertEqual(status, 200)
+        load_game.assert_called_once_with(2, save=SAVE)
+        self.assertIs(wsgi_app.games.peek(SAVE), loaded)
+
+    def test_websocket(self):
+        sent = []
+
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(app({"type": "websocket", "path": "/api/"}, receive, send))
+        self.assertEqual(sent, [{"type": "websocket.close"}])
@@ -1,10 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pathlib
+import sqlite3
+from tempfile import TemporaryDirectory
 import unittest
 import unittest.mock
 import time
 
-from gensim.db import TERR_TYPE, create_db
+from sqlalchemy import text
+
+from gensim.db import (
+    TERR_TYPE,
+    Event,
+    EventLock,
+    Location,
+    Meta,
+    MigrationError,
+    Schedule,
+    create_db,
+    migrate,
+    schema_fingerprint,
+)
 from gensim.api import Client
+from gensim import memdb
+from gensim.memdb import WorkingCopy
 from gensim import serializers
+from gensim.management import db as man_db
+from gensim.management.db import (
+    base_file,
+    copy_db,
+    is_diff,
+    load_diff,
+    read_catalog,
+    save_diff,
+    store_base,
+)
 from gensim.test import ENGINE, settings
 
 TEST_FILES = settings.SAVES
@@ -157,6 +187,94 @@ class TestAPI(TestDB):
 
         assert not event.available
 
+    def test_event_graph(self):
+        area = self.client.create_area(name="SDM")
+        location = self.client.create_location(name="Hakurei Shrine", area=area)
+        character = self.client.create_character(
+            name="Yamato", energy=2000, location=location, home=area
+        )
+        stat = self.client.create_stat(character=character, label="alive", value=1)
+
+        root = self.client.create_event(name="root", type_="GLOBAL")
+        lock = self.client.create_event(name="lock", type_="GLOBAL")
+        chained = self.client.create_event(
+            name="chained", type_="GLOBAL", activator=root
+        )
+        root.locked_by.append(lock)
+        # the lock goes away after it's triggered once
+        self.client.create_requirement(lock, stat, "value", value=1)
+        self.client.create_effect(lock, stat, "value", change=-1, score=-1)
+        self.client.session.commit()
+
+        graph = self.client.compile_events()
+        self.assertEqual(graph.root("chained"), "root")
+        assert not root.available
+        assert not chained.available
+
+        lock.complete()
+        assert root.available
+        assert chained.available
+
+        # the lockers are checked every time, not only when they complete
+        stat.value = 1
+        assert not root.available
+        # even through another locker
+        outer = self.client.create_event(name="outer", type_="GLOBAL")
+        lock.locked_by.append(outer)
+        self.client.session.commit()
+        graph.add_lock("outer", "lock")
+        assert root.available
+        self.client.create_requirement(outer, stat, "value", value=2)
+        self.client.session.commit()
+        assert not root.available
+
+        graph.prune("root")
+        self.assertEqual(graph.root("chained"), "chained")
+
+    def test_prune_events(self):
+        area = self.client.create_area(name="SDM")
+        location = self.client.create_location(name="Hakurei Shrine", area=area)
+        yamato, reimu = (
+            self.client.create_character(
+                name=name, energy=2000, location=location, home=area
+            )
+            for name in ("Yamato", "Reimu")
+        )
+        relationship = self.client.create_relationship(from_=yamato.name, to=reimu.name)
+        event = self.client.create_event(name="one-shot", type_="GLOBAL", prune=True)
+        keep = self.client.create_event(name="keep", type_="GLOBAL")
+        event.locks.append(keep)
+        child = self.client.create_event(name="child", type_="GLOBAL", parent=event)
+        chained = self.client.create_event(
+            name="chained", type_="GLOBAL", activator=event
+        )
+        event.due_date.append(Schedule(type_="DAILY", date=0))
+
+        effect = self.client.create_effect(event, relationship, "strength", change=1)
+        effect.available_dialog.append(effect.dialog(text="..."))
+        buff = effect.buff(mod=2)
+        effect.buffs.append(buff)
+        self.client.create_requirement(buff, relationship, "strength", value=1)
+        self.client.create_requirement(event, relationship, "strength", value=0)
+        self.client.session.commit()
+
+        Effect = effect.__class__
+        tables = (Effect, Effect.dialog, Effect.buff, event.requirements[0].__class__)
+        self.client.prune_events([event])
+        # the loaded events that pointed to it are up to date
+        self.assertIsNone(child.parent)
+        self.assertIsNone(chained.activator)
+        self.client.session.commit()
+
+        self.assertEqual(
+            {event.name for event in self.client.get_event()},
+            {"keep", "child", "chained"},
+        )
+        self.assertEqual(self.client.get_schedule().all(), [])
+        for table in tables:
+            self.assertEqual(self.client._get(table).count(), 0, table)
+        self.assertEqual(keep.locked_by, [])
+
 
 def override_make(model, fn=lambda args: None):
     """
@@ -236,6 +354,602 @@ class TestPopulate(TestDB):
 
         self.assertEqual(cmd, self.client.get_command_map("WATER").one().commands[0])
 
+    def test_rows_as_dicts(self):
+        parent = self.client.create_event(name="parent", type_="GLOBAL")
+        self.client.create_event(name="child", type_="GLOBAL", parent=parent)
+        self.client.session.commit()
+
+        query = self.client.get_event()
+        rows = Event.rows_as_dicts(query)
+        self.assertEqual(
+            [{**event.as_dict(), "children": None} for event in query],
+            [{**row, "children": None} for row in rows],
+        )
+        self.assertEqual(rows[0]["children"], [rows[1]])
+
+        # the children aren't in the results
+        (row,) = Event.rows_as_dicts(self.client.get_event(name="parent"))
+        self.assertEqual(row["children"], [rows[1]])
+
+    def test_release(self):
+        def request():
+            self.client.get_area().all()
+            self.client.release()
+
+        first = self.client.session
+        with unittest.mock.patch(
+            "gensim.api.settings.SESSION_MAX_REQUESTS", 4
+        ), ThreadPoolExecutor(max_workers=1) as pool:
+            request()
+            for _ in range(3):
+                pool.submit(request).result()
+            # the requests of every thread count
+            self.assertIs(self.client.session, first)
+            request()
+        self.assertIsNot(self.client.session, first)
+
+    def test_versions(self):
+        versions = self.client.versions
+        area = self.client.create_area(name="SDM")
+        etag = versions.etag(("area", "location"))
+        self.client.session.commit()
+        self.assertNotEqual(etag, versions.etag(("area", "location")))
+
+        # writes through the ORM count too but only once they are committed
+        etag = versions.etag(("area", "location"))
+        area.name = "Scarlet Devil Mansion"
+        self.client.session.flush()
+        self.client.session.rollback()
+        self.assertEqual(etag, versions.etag(("area", "location")))
+
+        self.assertEqual(versions.counters["area"], 1)
+        self.client.create_location(name="Library", area=area)
+        self.client.session.commit()
+        self.assertEqual(versions.counters["location"], 1)
+
+    def test_storage_profile(self):
+        def pragma(name):
+            return client.session.execute(text(f"PRAGMA {name}")).scalar()
+
+        client = Client(url=str(self.client.engine.url), profile="fast-local")
+        try:
+            self.assertEqual(pragma("journal_mode"), "wal")
+            self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+            self.assertEqual(pragma("temp_store"), 2)  # MEMORY
+        finally:
+            client.close()
+        self.assertEqual(
+            self.client.session.execute(text("PRAGMA synchronous")).scalar(), 2
+        )
+
+    def test_copy_db(self):
+        self.client.create_area(name="SDM")
+        self.client.session.commit()
+        # the session is writing while the file is copied
+        self.client.create_area(name="Hakugyokurou")
+        self.client.session.flush()
+
+        with TemporaryDirectory() as directory:
+            destination = pathlib.Path(directory) / "copy.sqlite3"
+            copy_db(self.client.engine.url.database, destination, pages=1)
+            copy = Client(url="sqlite:///" + str(destination))
+            names = [area.name for area in copy.get_area()]
+            copy.close()
+        self.assertEqual(names, ["SDM"])
+        self.client.session.rollback()
+
+    def test_diff_save(self):
+        def dump(path):
+            db = sqlite3.connect(path)
+            tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            rows = {
+                name: sorted(db.execute(f'SELECT * FROM "{name}"'), key=str)
+                for (name,) in tables.fetchall()
+            }
+            db.close()
+            return rows
+
+        world = self.client.engine.url.database
+        sdm = self.client.create_area(name="SDM")
+        self.client.create_area(name="Hakugyokurou")
+        self.client.session.commit()
+        digest = store_base(world)
+
+        # added, changed and deleted rows
+        self.client.create_location(name="Library", area=sdm)
+        sdm.name = "Scarlet Devil Mansion"
+        self.client.session.delete(self.client.get_area(name="Hakugyokurou").one())
+        self.client.session.commit()
+
+        try:
+            with TemporaryDirectory() as directory:
+                diff = pathlib.Path(directory) / "save.gsav"
+                save_diff(world, diff, digest)
+                self.assertTrue(is_diff(diff))
+                # only the new rows are saved
+                self.assertEqual(len(dump(diff)["area"]), 1)
+                self.assertEqual(len(dump(diff)["__removed_area"]), 2)
+                loaded = pathlib.Path(directory) / "loaded.gsav"
+                load_diff(diff, loaded)
+                self.assertEqual(dump(world), dump(loaded))
+        finally:
+            base_file(digest).unlink()
+
+    def test_working_copy(self):
+        def areas(path):
+            db = sqlite3.connect(path)
+            names = [name for (name,) in db.execute("SELECT name FROM area")]
+            db.close()
+            return names
+
+        url = str(self.client.engine.url)
+        path = self.client.engine.url.database
+        self.client.close()
+
+        working = WorkingCopy(path, interval=0, journal=True)
+        client = Client(url=url, working=working)
+        client.create_area(name="SDM")
+        client.create_calendar({})
+        client.session.commit()
+        self.assertEqual(areas(path), [])
+        working.checkpoint()
+        self.assertEqual(areas(path), ["SDM"])
+
+        # crash before the next checkpoint
+        client.create_area(name="Hakugyokurou")
+        # the calendar is bound as bytes
+        client.update_calendar({"day": 1})
+        client.session.commit()
+        client.close()
+        self.assertEqual(areas(path), ["SDM"])
+
+        working = WorkingCopy(path, interval=0, journal=True)
+        self.assertEqual(areas(path), ["SDM", "Hakugyokurou"])
+        working.close()
+        client = Client(url=url)
+        self.assertEqual(client.get_calendar(), {"day": 1})
+        client.close()
+
+    def test_checkpoint_synced(self):
+        path = pathlib.Path(self.client.engine.url.database)
+        url = str(self.client.engine.url)
+        self.client.close()
+        working = WorkingCopy(path, interval=0, journal=True)
+        client = Client(url=url, working=working)
+        client.create_area(name="SDM")
+        client.session.commit()
+        synced = []
+
+        def fsync(target):
+            # the journal is kept until the new save and its entry are synced
+            synced.append((pathlib.Path(target), working.journal_path.exists()))
+            fsync.wrapped(target)
+
+        fsync.wrapped = memdb._fsync
+        with unittest.mock.patch("gensim.memdb._fsync", fsync):
+            working.checkpoint()
+        client.close()
+        working.close()
+        self.assertEqual(
+            synced,
+            [(path.with_name(path.name + ".part"), True), (path.parent, True)],
+        )
+        self.assertFalse(working.journal_path.exists())
+
+    def test_fork_db(self):
+        self.client.create_area(name="SDM")
+        self.client.session.commit()
+        world = self.client.engine.url.database
+
+        with TemporaryDirectory() as directory:
+            forks = [pathlib.Path(directory) / f"fork_{i}.gsav" for i in range(2)]
+            for index, fork in enumerate(forks):
+                self.assertIn(man_db.fork_db(world, fork), ("reflink", "copy"))
+                client = Client(url="sqlite:///" + str(fork))
+                client.create_area(name=f"branch_{index}")
+                client.session.commit()
+                client.close()
+
+            for path, names in (
+                (world, ["SDM"]),
+                (forks[0], ["SDM", "branch_0"]),
+                (forks[1], ["SDM", "branch_1"]),
+            ):
+                client = Client(url="sqlite:///" + str(path))
+                self.assertEqual([area.name for area in client.get_area()], names)
+                client.close()
+
+    def test_fork_game(self):
+        def game(save):
+            return pathlib.Path(man_db.get_game(save).split("///")[1])
+
+        man_db.copy_db(self.client.engine.url.database, game("test-source"))
+        fork = None
+        try:
+            fork = man_db.fork_game("test-source")
+            self.assertTrue(fork.startswith(man_db.FORK_PREFIX))
+            self.assertTrue(game(fork).exists())
+            # slots, the other games and the source itself aren't forks
+            for target in ("1", "current", "test-source"):
+                with self.assertRaises(ValueError):
+                    man_db.fork_game("test-source", target)
+            with self.assertRaises(FileExistsError):
+                man_db.fork_game("test-source", fork)
+        finally:
+            game("test-source").unlink()
+            if fork is not None:
+                game(fork).unlink()
+
+    def test_background_save(self):
+        future = man_db.save_game(98, save="test-nothing", background=True)
+        with self.assertRaises(AssertionError):
+            future.result()
+        # the status is set by a callback once the future is done
+        deadline = time.time() + 5
+        while man_db.background_save_status("test-nothing")["status"] == "saving":
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        status = man_db.background_save_status("test-nothing")
+        self.assertEqual((status["slot"], status["status"]), (98, "failed"))
+        self.assertIn("There is no game", status["error"])
+        self.assertIsNone(man_db.background_save_status("test-other"))
+
+    def test_save_game(self):
+        area = self.client.create_area(name="SDM")
+        library = self.client.create_location(name="Library", area=area)
+        self.client.create_character(
+            name="Sakuya", home=area, energy=10, location=library, is_player=True
+        )
+        alice = self.client.create_character(
+            name="Alice Liddell", home=area, energy=10, location=library
+        )
+        self.client.create_stat(label="time", value=0, character=alice)
+        self.client.session.commit()
+
+        def path(num):
+            return pathlib.Path(man_db.get_save(num).split("///")[1])
+
+        def game(save):
+            return pathlib.Path(man_db.get_game(save).split("///")[1])
+
+        # hosted games never share a file with the slots
+        self.assertNotEqual(game("1"), path(1))
+        current, loaded = game("test-current"), game("test-loaded")
+        man_db.copy_db(self.client.engine.url.database, current)
+        db = sqlite3.connect(current)
+        db.execute("UPDATE character SET energy = 20 WHERE name = 'Sakuya'")
+        db.commit()
+        db.close()
+
+        with TemporaryDirectory() as directory, unittest.mock.patch.object(
+            man_db, "CATALOG", pathlib.Path(directory) / "catalog.json"
+        ), unittest.mock.patch.object(man_db, "_backfilled", False):
+            try:
+                man_db.save_game(99, save="test-current")
+                self.assertTrue(man_db.is_compressed(path(99)))
+                (save,) = man_db.list_saves()
+                self.assertEqual(save["slot"], 99)
+                self.assertEqual(save["player"], "Sakuya")
+                self.assertEqual(save["time"], datetime.fromtimestamp(0).isoformat())
+                self.assertEqual(save["size"], path(99).stat().st_size)
+
+                # saves written before the catalog are added when it's read
+                man_db.CATALOG.unlink()
+                man_db._backfilled = False
+                self.assertEqual(man_db.list_saves(), [save])
+
+                man_db.load_game(99, save="test-loaded")
+                db = sqlite3.connect(loaded)
+                (energy,) = db.execute(
+                    "SELECT energy FROM character WHERE name = 'Sakuya'"
+                ).fetchone()
+                db.close()
+                self.assertEqual(energy, 20)
+
+                # a save that can't be upgraded doesn't replace the game
+                with unittest.mock.patch.object(
+                    man_db, "migrate", side_effect=MigrationError("no")
+                ), self.assertRaises(MigrationError):
+                    man_db.load_game(99, save="test-loaded")
+                self.assertTrue(loaded.exists())
+                self.assertEqual(list(loaded.parent.glob(loaded.name + ".*")), [])
+            finally:
+                for save_file in (current, loaded, path(99)):
+                    save_file.unlink(missing_ok=True)
+
+    def test_diff_game(self):
+        area = self.client.create_area(name="SDM")
+        library = self.client.create_location(name="Library", area=area)
+        self.client.create_character(
+            name="Sakuya", home=area, energy=10, location=library, is_player=True
+        )
+        self.client.session.commit()
+        world = self.client.engine.url.database
+        save_file = pathlib.Path(man_db.get_save(97).split("///")[1])
+        current, loaded = (
+            pathlib.Path(man_db.get_game(save).split("///")[1])
+            for save in ("test-diffed", "test-loaded")
+        )
+        # the game records the world it's created from
+        digest = store_base(world)
+        man_db.copy_db(world, current)
+        man_db.record_base(current, digest)
+        db = sqlite3.connect(current)
+        db.execute("UPDATE area SET name = 'Scarlet Devil Mansion'")
+        db.commit()
+        db.close()
+        # and the world is rebuilt
+        area.name = "Hakugyokurou"
+        self.client.session.commit()
+
+        with TemporaryDirectory() as directory, unittest.mock.patch.object(
+            man_db, "CATALOG", pathlib.Path(directory) / "catalog.json"
+        ), unittest.mock.patch("gensim.management.db.settings.DIFF_SAVES", True):
+            try:
+                man_db.save_game(97, save="test-diffed")
+                (save,) = man_db.list_saves()
+                self.assertEqual(save["base"], digest)
+                # the player isn't in the diff, it's read from the base
+                self.assertEqual(save["player"], "Sakuya")
+                man_db.load_game(97, save="test-loaded")
+                db = sqlite3.connect(loaded)
+                names = [name for (name,) in db.execute("SELECT name FROM area")]
+                db.close()
+                self.assertEqual(names, ["Scarlet Devil Mansion"])
+                self.assertEqual(man_db.game_base(loaded), digest)
+
+                # the base is kept while a game or a save is built from it
+                for path in (current, loaded):
+                    path.unlink()
+                    man_db.collect_bases()
+                    self.assertTrue(base_file(digest).exists())
+                save_file.unlink()
+                man_db.collect_bases()
+                self.assertFalse(base_file(digest).exists())
+            finally:
+                for path in (current, loaded, save_file):
+                    path.unlink(missing_ok=True)
+                base_file(digest).unlink(missing_ok=True)
+
+    def test_migrated_diff(self):
+        area = self.client.create_area(name="SDM")
+        library = self.client.create_location(name="Library", area=area)
+        for name in ("Sakuya", "Remilia"):
+            self.client.create_character(
+                name=name, home=area, energy=10, location=library
+            )
+        self.client.create_relationship(from_="Sakuya", to="Remilia")
+        self.client.session.commit()
+
+        def game(save):
+            return pathlib.Path(man_db.get_game(save).split("///")[1])
+
+        def path(num):
+            return pathlib.Path(man_db.get_save(num).split("///")[1])
+
+        # a game of an older version, built from its world
+        old, migrated, loaded = (
+            game(save) for save in ("test-old", "test-migrated", "test-loaded")
+        )
+        man_db.copy_db(self.client.engine.url.database, old)
+        db = sqlite3.connect(old)
+        db.execute("ALTER TABLE relationship DROP COLUMN strength")
+        db.execute("UPDATE meta SET value = 'old' WHERE key = 'schema'")
+        db.commit()
+        db.close()
+        digests = [store_base(old)]
+        man_db.record_base(old, digests[0])
+
+        with TemporaryDirectory() as directory, unittest.mock.patch.object(
+            man_db, "CATALOG", pathlib.Path(directory) / "catalog.json"
+        ), unittest.mock.patch("gensim.management.db.settings.DIFF_SAVES", True):
+            try:
+                man_db.save_game(96, save="test-old")
+                # upgraded when it's loaded: the old base lacks strength
+                man_db.load_game(96, save="test-migrated")
+                digests.append(man_db.game_base(migrated))
+                self.assertNotEqual(digests[1], digests[0])
+                man_db.save_game(95, save="test-migrated")
+                self.assertEqual(read_catalog()["95"]["base"], digests[1])
+
+                # and games still pointing to a base of another schema are
+                # saved whole
+                man_db.record_base(migrated, digests[0])
+                man_db.save_game(95, save="test-migrated")
+                self.assertIsNone(read_catalog()["95"]["base"])
+                man_db.load_game(95, save="test-loaded")
+                db = sqlite3.connect(loaded)
+                self.assertEqual(
+                    db.execute("SELECT from_, strength FROM relationship").fetchall(),
+                    [("Sakuya", 0)],
+                )
+                db.close()
+            finally:
+                for file in (old, migrated, loaded, path(95), path(96)):
+                    file.unlink(missing_ok=True)
+                for digest in digests:
+                    base_file(digest).unlink(missing_ok=True)
+
+    def test_update_world(self):
+        area = self.client.create_area(name="SDM")
+        library = self.client.create_location(name="Library", area=area)
+        player = self.client.create_character(
+            name="Sakuya", home=area, energy=10, location=library, is_player=True
+        )
+        stat = self.client.create_stat(character=player, label="knives", value=0)
+        event = self.client.create_event(name="welcome", type_="GLOBAL")
+        effect = self.client.create_effect(event, stat, "value", change=1, score=100)
+        effect.available_dialog.append(effect.dialog(text="stale"))
+        self.client.session.commit()
+
+        def change(source):
+            self.client.session.query(Meta).filter_by(key="source:" + source).update(
+                {"value": "old"}
+            )
+
+        welcome = "data/dialog/characters/Alice Liddell/GLOBAL/welcome.txt"
+        man_db._record_sources(
+            self.client,
+            man_db.world_sources(),
+            {welcome: [[effect.__table__.name, effect.id, "DialogWPlayer"]]},
+        )
+        self.assertTrue(man_db.update_world(self.client))
+        self.assertEqual(effect.text, "stale")
+
+        # only the dialog of the effects that read the file is read again
+        change(welcome)
+        self.assertTrue(man_db.update_world(self.client))
+        chunks = serializers._get_dialog_chunks(settings.BASE_DIR / welcome)
+        self.assertEqual(
+            [dialog.text for dialog in effect.available_dialog],
+            [chunk.strip() for chunk in chunks],
+        )
+        self.assertEqual(self.client.get_event().one(), event)
+
+        # the world is built from scratch for the others
+        change("data/paths.yaml")
+        self.assertFalse(man_db.update_world(self.client))
+
+    def test_bulk_build(self):
+        class Child(serializers.GenericEvent):
+            name = "child"
+
+        class Parent(serializers.GenericEvent):
+            name = "parent"
+            children = [
+                Child,
+            ]
+
+        with serializers.bulk_build(self.client):
+            Parent(self.client)
+            # nothing is written until the end of the block
+            self.assertFalse(self.client.session.new)
+            self.assertEqual(self.client.get_event().all(), [])
+
+        parent = self.client.get_event(name="parent").one()
+        self.assertEqual([child.name for child in parent.children], ["child"])
+        self.assertIsNone(serializers.building(self.client))
+
+        # an error discards the whole block
+        with self.assertRaises(ValueError):
+            with serializers.bulk_build(self.client):
+                Child(self.client)
+                raise ValueError
+        self.assertEqual(len(self.client.get_event().all()), 2)
+
+        # the rows of the association tables (once, even with a backref)
+        with serializers.bulk_build(self.client) as builder:
+            lock = Event(name="lock", type_="GLOBAL")
+            builder.add(Event(name="key", type_="GLOBAL", locks=[lock]))
+        key = self.client.get_event(name="key").one()
+        self.assertEqual([event.name for event in key.locks], ["lock"])
+        self.assertEqual(len(self.client.session.query(EventLock).all()), 1)
+
+        # unless they need more than the keys
+        with self.assertRaises(ValueError):
+            with serializers.bulk_build(self.client) as builder:
+                builder.add(Location(name="Library", paths=[Location(name="Hall")]))
+        self.assertEqual(self.client.get_location().all(), [])
+        with serializers.bulk_build(self.client) as builder:
+            builder.add(Location(name="Hall"))
+        self.assertEqual(len(self.client.get_location().all()), 1)
+
+    def test_migrate(self):
+        area = self.client.create_area(name="SDM")
+        library = self.client.create_location(name="Library", area=area)
+        self.client.create_character(
+            name="Sakuya", home=area, energy=10, location=library
+        )
+        self.client.session.commit()
+
+        with TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "old.sqlite3"
+            copy_db(self.client.engine.url.database, path)
+            url = "sqlite:///" + str(path)
+            self.assertFalse(migrate(url))
+
+            # a save of an older version
+            db = sqlite3.connect(path)
+            db.execute("ALTER TABLE character DROP COLUMN is_player")
+            db.execute("DROP INDEX ix_stat_chara_name")
+            db.execute("DROP TABLE event_lock")
+            db.execute("DROP TABLE meta")
+            db.commit()
+            self.assertTrue(migrate(url))
+            self.assertFalse(migrate(url))
+            self.assertEqual(
+                db.execute("SELECT name, is_player FROM character").fetchall(),
+                [("Sakuya", 0)],
+            )
+            indexes = db.execute(
+                "SELECT name FROM sqlite_master WHERE name IN"
+                " ('ix_stat_chara_name', 'event_lock')"
+            ).fetchall()
+            self.assertEqual(len(indexes), 2)
+
+            # nothing is changed if it can't be done in place
+            db.execute("ALTER TABLE command DROP COLUMN name")
+            db.execute("DROP INDEX ix_area_name")
+            db.execute("UPDATE meta SET value = 'old'")
+            db.commit()
+            with self.assertRaises(MigrationError):
+                migrate(url)
+            self.assertFalse(
+                db.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'ix_area_name'"
+                ).fetchone()
+            )
+            db.close()
+
+            # removed tables and indexes are dropped
+            path.unlink()
+            copy_db(self.client.engine.url.database, path)
+            db = sqlite3.connect(path)
+            db.execute("CREATE TABLE removed (name VARCHAR)")
+            db.execute("CREATE INDEX ix_removed ON character (energy)")
+            db.execute("DROP INDEX ix_area_name")
+            db.execute("CREATE UNIQUE INDEX ix_area_name ON area (id)")
+            db.execute("UPDATE meta SET value = 'old'")
+            db.commit()
+            self.assertTrue(migrate(url))
+            self.assertEqual(
+                db.execute(
+                    "SELECT name FROM sqlite_master"
+                    " WHERE name IN ('removed', 'ix_removed')"
+                ).fetchall(),
+                [],
+            )
+            # changed
+            self.assertEqual(
+                db.execute("PRAGMA index_info(ix_area_name)").fetchone()[2], "name"
+            )
+            db.close()
+
+            # changed types and foreign keys can't be upgraded
+            for table, old, new in (
+                ("meta", "value VARCHAR", "value INTEGER"),
+                (
+                    "command",
+                    ", \n\tFOREIGN KEY(cmd_id) REFERENCES command_map (id)",
+                    "",
+                ),
+            ):
+                path.unlink()
+                copy_db(self.client.engine.url.database, path)
+                db = sqlite3.connect(path)
+                (sql,) = db.execute(
+                    "SELECT sql FROM sqlite_master WHERE name = ?", (table,)
+                ).fetchone()
+                self.assertIn(old, sql)
+                db.execute(f"DROP TABLE {table}")
+                db.execute(sql.replace(old, new))
+                db.execute("UPDATE meta SET value = 'old'")
+                db.commit()
+                db.close()
+                with self.assertRaises(MigrationError):
+                    migrate(url)
+        self.assertEqual(len(schema_fingerprint()), 64)
+
 
 def main_suite() -> unittest.TestSuite:
     s = unittest.TestSuite()
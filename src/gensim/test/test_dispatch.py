@@ -0,0 +1,119 @@
+import socketserver
+import threading
+import unittest
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from gensim.dispatch import Dispatcher, shard
+
+
+class Worker(socketserver.ThreadingTCPServer):
+    """
+    HTTP/1.1 worker closing the connection after every response without
+    saying so, like a keep-alive connection timing out between two requests
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.requests = []
+        # the second chunk of /stream is sent once it's set
+        self.resume = threading.Event()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        method, path, _ = self.rfile.readline().decode().split(" ")
+        headers = {}
+        while line := self.rfile.readline().strip():
+            key, value = line.decode().split(":", 1)
+            headers[key.lower()] = value.strip()
+        body = self.rfile.read(int(headers.get("content-length", 0)))
+        self.server.requests.append((method, path, headers, body))
+
+        if path == "/stream":
+            self.wfile.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n6\r\nfirst\n\r\n"
+            )
+            self.server.resume.wait(5)
+            self.wfile.write(b"7\r\nsecond\n\r\n0\r\n\r\n")
+            return
+        self.wfile.write(
+            b"HTTP/1.1 201 Created\r\nContent-Length: 2\r\n"
+            b"Keep-Alive: timeout=5\r\nX-Worker: yes\r\n\r\nok"
+        )
+
+
+def request(path, method="GET", **kwargs):
+    return Request(EnvironBuilder(path, method=method, **kwargs).get_environ())
+
+
+def body(response):
+    # the body is streamed (direct passthrough)
+    return b"".join(response.response)
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.worker = Worker()
+        self.addCleanup(self.worker.server_close)
+        self.addCleanup(self.worker.shutdown)
+        self.dispatcher = Dispatcher([self.worker.server_address[1]], "127.0.0.1")
+
+    def test_shard(self):
+        self.assertEqual(shard("game", 4), shard("game", 4))
+        self.assertEqual({shard(str(index), 4) for index in range(100)}, {0, 1, 2, 3})
+
+    def test_forward(self):
+        response = self.dispatcher.forward(
+            0, request("/api/game/", "POST", data=b"{}", headers={"Upgrade": "h2c"})
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(body(response), b"ok")
+        self.assertEqual(response.headers["X-Worker"], "yes")
+        # hop-by-hop headers aren't forwarded either way
+        self.assertNotIn("Keep-Alive", response.headers)
+        ((method, path, headers, data),) = self.worker.requests
+        self.assertEqual((method, path, data), ("POST", "/api/game/", b"{}"))
+        self.assertNotIn("upgrade", headers)
+
+    def test_stale_connection(self):
+        # the worker closed the connection: reads are sent again
+        for _ in range(2):
+            response = self.dispatcher.forward(0, request("/api/game/"))
+            self.assertEqual(body(response), b"ok")
+            response.close()
+        self.assertEqual(len(self.worker.requests), 2)
+
+        # but not writes the worker may have run (sent in one write, that's
+        # only noticed while waiting for the response)
+        with self.assertRaises(OSError):
+            self.dispatcher.forward(0, request("/api/game/", "POST"))
+        self.assertEqual(len(self.worker.requests), 2)
+
+        # a new connection is opened for the next one
+        response = self.dispatcher.forward(0, request("/api/game/", "POST"))
+        self.assertEqual(response.status_code, 201)
+
+    def test_stream(self):
+        response = self.dispatcher.forward(0, request("/stream"))
+        chunks = iter(response.response)
+        # the first event is forwarded before the worker sends the next one
+        self.assertEqual(next(chunks), b"first\n")
+        self.worker.resume.set()
+        self.assertEqual(b"".join(chunks), b"second\n")
+        response.close()
+
+    def test_client_gone(self):
+        response = self.dispatcher.forward(0, request("/stream"))
+        next(iter(response.response))
+        # the rest of the stream is never read, the connection can't be reused
+        response.close()
+        self.worker.resume.set()
+        response = self.dispatcher.forward(0, request("/api/game/", "POST"))
+        self.assertEqual(body(response), b"ok")
@@ -0,0 +1,136 @@
+from datetime import datetime
+import os
+import pathlib
+import threading
+import unittest
+import unittest.mock
+
+from gensim.autosave import Autosaver
+from gensim.game import GameManager
+from gensim.management import db as man_db
+
+
+class TestGameManager(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+
+        def open_game(save_id):
+            game = unittest.mock.Mock(last_used=0)
+            self.opened.append(save_id)
+            return game
+
+        self.games = GameManager(open_game, max_games=2, max_idle=60)
+
+    def use(self, save_id):
+        """A request of the game"""
+        game = self.games.get(save_id)
+        self.games.release(game)
+        return game
+
+    def test_lru(self):
+        first = self.use("a")
+        self.use("b")
+        self.assertIs(self.use("a"), first)
+        self.use("c")
+
+        # "b" was the least recently used
+        self.assertEqual(list(self.games.games), ["a", "c"])
+        self.assertEqual(self.opened, ["a", "b", "c"])
+
+        self.use("b")
+        self.assertEqual(self.opened, ["a", "b", "c", "b"])
+        first.close.assert_called_once()
+
+    def test_idle(self):
+        game = self.use("a")
+        game.last_used -= 120
+        self.use("b")
+
+        self.assertNotIn("a", self.games)
+        game.close.assert_called_once()
+
+    def test_requests(self):
+        # games serving requests aren't evicted
+        first = self.games.get("a")
+        self.use("b")
+        self.use("c")
+        self.assertEqual(list(self.games.games), ["a", "c"])
+        first.close.assert_not_called()
+
+        # closing one waits for its requests
+        closing = threading.Thread(target=self.games.close, args=("a",))
+        closing.start()
+        closing.join(0.1)
+        self.assertTrue(closing.is_alive())
+        first.close.assert_not_called()
+        self.games.release(first)
+        closing.join()
+        first.close.assert_called_once()
+
+
+class TestAutosaver(unittest.TestCase):
+    def setUp(self):
+        self.game = unittest.mock.Mock(today=datetime(2020, 1, 1, 12))
+        self.game.client.versions.commits = 0
+        self.hosted = {"a", "b"}
+        games = unittest.mock.Mock(
+            peek=lambda save_id: self.game if save_id in self.hosted else None
+        )
+        self.autosaver = Autosaver(games, actions=3, daily=True, interval=0, slots=2)
+        # save the queued games by hand
+        patch = unittest.mock.patch.object(Autosaver, "start")
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def autosaves(self):
+        def save_game(num, save):
+            path = pathlib.Path(man_db.get_save(num).split("///")[1])
+            self.addCleanup(path.unlink, missing_ok=True)
+            path.touch()
+            # one after the other, even if the clock is coarse
+            self.saved += 1
+            os.utime(path, ns=(self.saved, self.saved))
+
+        self.saved = getattr(self, "saved", 0)
+        with unittest.mock.patch.object(
+            man_db, "save_game", side_effect=save_game
+        ) as saved:
+            while not self.autosaver.queue.empty():
+                self.autosaver.save(*self.autosaver.queue.get())
+        return [call.args[0] for call in saved.call_args_list]
+
+    def test_triggers(self):
+        for _ in range(2):
+            self.game.client.versions.commits += 1
+            self.autosaver.notify("a", self.game)
+        self.assertEqual(self.autosaves(), [])
+
+        # actions
+        self.game.client.versions.commits += 1
+        self.autosaver.notify("a", self.game)
+        self.assertEqual(self.autosaves(), ["autosave-a-1"])
+
+        # new day
+        self.game.today = datetime(2020, 1, 2, 8)
+        self.autosaver.notify("a", self.game)
+        self.assertEqual(self.autosaves(), ["autosave-a-2"])
+        self.game.checkpoint.assert_called()
+
+    def test_rotation(self):
+        # every game replaces its oldest autosave
+        saved = []
+        for save_id in ("a", "b", "a", "a"):
+            self.game.client.versions.commits += 3
+            self.autosaver.notify(save_id, self.game)
+            saved += self.autosaves()
+        self.assertEqual(
+            saved, ["autosave-a-1", "autosave-b-1", "autosave-a-2", "autosave-a-1"]
+        )
+
+    def test_prune(self):
+        for save_id in ("a", "b"):
+            self.autosaver.notify(save_id, self.game)
+        # b is closed
+        self.hosted.remove("b")
+        self.autosaver.prune()
+        self.assertEqual(list(self.autosaver.states), ["a"])
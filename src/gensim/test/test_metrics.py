@@ -0,0 +1,70 @@
+import time
+import unittest
+import unittest.mock
+
+from flask import Flask
+
+from gensim import metrics
+from gensim.metrics import Counter, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram("latency", "Latency", ("endpoint",), buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, "/api/event/loop")
+
+        self.assertEqual(
+            list(histogram.render())[2:],
+            [
+                'latency_bucket{endpoint="/api/event/loop",le="1"} 2',
+                'latency_bucket{endpoint="/api/event/loop",le="5"} 3',
+                'latency_bucket{endpoint="/api/event/loop",le="+Inf"} 4',
+                'latency_sum{endpoint="/api/event/loop"} 14.5',
+                'latency_count{endpoint="/api/event/loop"} 4',
+            ],
+        )
+
+    def test_counter(self):
+        counter = Counter("statements", "Statements", ("endpoint",))
+        counter.inc('say "hi"', amount=2)
+        counter.inc('say "hi"')
+
+        self.assertEqual(
+            list(counter.render()),
+            [
+                "# HELP statements Statements",
+                "# TYPE statements counter",
+                'statements{endpoint="say \\"hi\\""} 3',
+            ],
+        )
+
+    def test_request_latency(self):
+        app = Flask(__name__)
+
+        @app.route("/stream")
+        def stream():
+            def body():
+                yield "a"
+                time.sleep(0.05)
+                yield "b"
+
+            return body()
+
+        @app.teardown_request
+        def teardown(exc):
+            time.sleep(0.05)
+
+        with unittest.mock.patch.object(metrics.settings, "METRICS_SAMPLE_RATE", 1):
+            metrics.instrument(app)
+            response = app.test_client().get("/stream")
+            self.assertEqual(response.data, b"ab")
+            response.close()
+
+        # the teardown and the whole stream are measured
+        ((_, latency),) = [
+            value
+            for labels, value in metrics.REQUEST_LATENCY.values.items()
+            if labels[0] == "/stream"
+        ]
+        self.assertGreaterEqual(latency, 0.1)
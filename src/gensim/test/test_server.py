@@ -0,0 +1,369 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import threading
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+import unittest
+import unittest.mock
+
+import requests
+from sqlalchemy.orm import Session
+
+from gensim.api import Client
+from gensim.cronie import Notice
+from gensim.game import Game
+from gensim.management.bench import make_db, make_world
+from gensim.server import APIException, app as wsgi_app, client
+from gensim_cli.client import Client as CLIClient
+
+SAVE = "server-test"
+
+
+def call(path, method="GET", query_string="", body=b"", save=SAVE):
+    """Run a request through the WSGI app and return (status, headers, body)"""
+    response = wsgi_app.test_client().open(
+        path,
+        method=method,
+        query_string=query_string,
+        data=body,
+        headers={
+            "Accept": "*/*",
+            "Content-Type": "application/json",
+            "X-Gensim-Save": save,
+        },
+    )
+    return response.status_code, response.headers, response.get_data()
+
+
+class TestWorld(unittest.TestCase):
+    """A small world hosted as the game self.save"""
+
+    save = SAVE
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        url = make_db(self.directory.name)
+        client = Client(url)
+        make_world(client, locations=2, characters=2, events=2)
+        client.create_command_map("game", [client.create_command("move")])
+        client.create_command_map("water", [client.create_command("fish")])
+        location = client.get_location(name="location_0").one()
+        location.tags.append(location.tag(name="water"))
+        client.session.commit()
+        game = Game(Client(url))
+        game.client.compile_events()
+        wsgi_app.games.set(self.save, game)
+
+    def tearDown(self):
+        wsgi_app.games.close(self.save)
+        self.directory.cleanup()
+
+
+class TestServer(TestWorld):
+    def test_stream(self):
+        status, headers, body = call("/api/event/loop/stream")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-Type"].startswith("text/event-stream"))
+
+        frames = body.decode().strip().split("\n\n")
+        events = [frame.split("\n")[0] for frame in frames]
+        self.assertEqual(events[0], "event: loop")
+        self.assertEqual(events[-1], "event: end")
+        self.assertEqual(
+            json.loads(frames[-1].split("data: ")[1])["events"], len(events) - 2
+        )
+
+    def stream(self):
+        """Frames of /api/event/loop/stream through the WSGI app, as they come"""
+        response = wsgi_app.test_client().get(
+            "/api/event/loop/stream",
+            headers={"X-Gensim-Save": SAVE, "Accept": "*/*"},
+            buffered=False,
+        )
+        self.addCleanup(response.close)
+        return response, iter(response.response)
+
+    def assertRequestOver(self, game):
+        self.assertNotIn(game, wsgi_app.games.requests)
+        self.assertTrue(game.lock.acquire(blocking=False))
+        game.lock.release()
+
+    def test_stream_closed(self):
+        game = wsgi_app.games.peek(SAVE)
+        with unittest.mock.patch.object(Session, "commit") as commit:
+            response, frames = self.stream()
+            self.assertTrue(next(frames).startswith(b"event: loop"))
+            self.assertTrue(next(frames).startswith(b"event: event"))
+            # the client went away
+            response.close()
+        commit.assert_not_called()
+        self.assertRequestOver(game)
+
+    def test_stream_failed(self):
+        game = wsgi_app.games.peek(SAVE)
+        with unittest.mock.patch.object(
+            Session, "commit", side_effect=OSError("disk I/O error")
+        ):
+            _, frames = self.stream()
+            with self.assertRaises(OSError):
+                list(frames)
+        # the day didn't change
+        self.assertIsNone(game.today)
+        self.assertRequestOver(game)
+        _, _, body = call("/api/character/player/")
+        self.assertEqual(json.loads(body)["name"], "anon")
+
+    def test_scene(self):
+        status, _, body = call("/api/scene/")
+        self.assertEqual(status, 200)
+        scene = json.loads(body)
+        self.assertEqual(scene["player"]["name"], "anon")
+        self.assertEqual(scene["location"], "location_0")
+        self.assertEqual(
+            [chara["name"] for chara in scene["characters"]], ["anon", "character_0"]
+        )
+        self.assertEqual(scene["commands"], ["move", "fish"])
+        self.assertEqual(
+            [location["name"] for location in scene["close_locations"]],
+            ["location_0", "location_1"],
+        )
+
+    def test_pagination(self):
+        names = []
+        cursor = "0"
+        while cursor:
+            status, headers, body = call(
+                "/api/character/",
+                query_string=f"limit=2&fields=name&after={cursor}",
+            )
+            self.assertEqual(status, 200)
+            page = json.loads(body)
+            self.assertTrue(all(set(row) == {"id", "name"} for row in page))
+            names.extend(row["name"] for row in page)
+            cursor = headers.get("X-Next-Cursor", "")
+
+        self.assertEqual(
+            names, ["Alice Liddell", "anon", "character_0", "character_1"]
+        )
+
+    def test_no_pagination(self):
+        with unittest.mock.patch("gensim.server.settings.PAGE_SIZE", 1):
+            status, headers, body = call("/api/character/")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 4)
+        self.assertNotIn("X-Next-Cursor", headers)
+
+    def test_client_pages(self):
+        """The cursor of a page that didn't change (304) is still followed"""
+        test_client = wsgi_app.test_client()
+        statuses = []
+
+        def request(session, method, url, json=None, headers=None):
+            res = test_client.open(
+                url.replace("http://localhost", ""),
+                method=method,
+                json=json,
+                headers={**session.headers, **(headers or {})},
+                follow_redirects=True,
+            )
+            statuses.append(res.status_code)
+            return SimpleNamespace(
+                status_code=res.status_code,
+                headers=res.headers,
+                json=lambda: res.json,
+                url=url,
+            )
+
+        cli = CLIClient(url="http://localhost/api/", save=SAVE)
+        with unittest.mock.patch.object(requests.Session, "request", request):
+            for _ in range(2):
+                names = [
+                    row["name"]
+                    for row in cli.character.pages({"limit": 2, "fields": "name"})
+                ]
+                self.assertEqual(
+                    names, ["Alice Liddell", "anon", "character_0", "character_1"]
+                )
+        self.assertEqual(statuses, [200, 200, 200, 304, 304, 304])
+
+    def test_batch(self):
+        def batch(*operations):
+            return call("/api/batch/", "POST", body=json.dumps(operations).encode())
+
+        status, _, body = batch(
+            {"op": "walk", "character": "anon", "destination": "location_1"},
+            {"op": "get", "path": "character/player"},
+            {"op": "loop"},
+        )
+        self.assertEqual(status, 200)
+        walked, player, loop = json.loads(body)
+        self.assertIn("time", walked)
+        self.assertEqual(player["location_name"], "location_1")
+        self.assertEqual(loop["location"], "location_1")
+
+        # the walk is rolled back
+        status, _, body = batch(
+            {"op": "walk", "character": "anon", "destination": "location_0"},
+            {"op": "chat", "character": "character_1"},
+        )
+        self.assertEqual(status, 400)
+        self.assertIn("Operation #1 (chat)", json.loads(body)["errors"])
+        _, _, body = call("/api/character/player/")
+        self.assertEqual(json.loads(body)["location_name"], "location_1")
+
+        # and so are the changes of the game in memory
+        game = wsgi_app.games.peek(SAVE)
+        game.today = datetime(2022, 1, 1)
+        game.calendar = Notice(event_id=1, date=0)
+        status, _, _ = batch(
+            {"op": "loop"},
+            {"op": "walk", "character": "anon", "destination": "location_0"},
+            {"op": "chat", "character": "character_1"},
+        )
+        self.assertEqual(status, 400)
+        self.assertEqual(game.today, datetime(2022, 1, 1))
+        self.assertEqual(
+            (game.calendar.event_id, game.calendar.date, game.calendar.following),
+            (1, 0, None),
+        )
+
+        # the parameters are checked before running anything
+        status, _, body = batch(
+            {"op": "loop"}, {"op": "walk", "character": "anon", "to": "location_0"}
+        )
+        self.assertEqual(status, 400)
+        self.assertIn("Operation #1 (walk)", json.loads(body)["errors"])
+        self.assertIs(game.calendar.following, None)
+
+    def test_batch_get(self):
+        # only the views that read
+        for path, status in (
+            ("game/load/0", 400),
+            ("game/save/3", 400),
+            ("event/trigger/event_0", 400),
+            ("event/trigger/fish", 400),
+            ("event/trigger/cook", 400),
+            ("event/loop", 400),
+            ("event/loop/stream", 400),
+            ("metrics", 400),
+            ("nothing", 404),
+        ):
+            body = json.dumps([{"op": "get", "path": path}]).encode()
+            responses = []
+            # (a view replacing the game would wait for the batch forever)
+            thread = threading.Thread(
+                target=lambda: responses.append(call("/api/batch/", "POST", body=body)),
+                daemon=True,
+            )
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), path)
+            (response,) = responses
+            self.assertEqual(response[0], status, path)
+            self.assertIn("Operation #0 (get)", json.loads(response[2])["errors"])
+        status, _, body = call(
+            "/api/batch/",
+            "POST",
+            body=json.dumps([{"op": "get", "path": "location/location_0"}]).encode(),
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)[0]["name"], "location_0")
+
+    def test_lock_until_commit(self):
+        game = wsgi_app.games.peek(SAVE)
+        commit = Session.commit
+        free = []
+
+        def lock_is_free():
+            if game.lock.acquire(blocking=False):
+                game.lock.release()
+                return True
+            return False
+
+        def check_lock(session):
+            # another thread can't advance the game before it's committed
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                free.append(pool.submit(lock_is_free).result())
+            commit(session)
+
+        walk = json.dumps({"character": "anon", "destination": "location_1"})
+        with unittest.mock.patch.object(Session, "commit", check_lock):
+            status, _, _ = call("/api/event/trigger/walk/", "POST", body=walk.encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(free, [False])
+
+    def test_failed_commit(self):
+        walk = json.dumps({"character": "anon", "destination": "location_1"})
+        with unittest.mock.patch.object(
+            Session, "commit", side_effect=OSError("disk I/O error")
+        ):
+            status, _, body = call(
+                "/api/event/trigger/walk/", "POST", body=walk.encode()
+            )
+        self.assertEqual(status, 500)
+        self.assertIn("disk I/O error", json.loads(body)["errors"])
+        _, _, body = call("/api/character/player/")
+        self.assertEqual(json.loads(body)["location_name"], "location_0")
+
+    def test_error_rolled_back(self):
+        def chat_with(character):
+            client.get_player().one().location_name = "location_1"
+            client.commit()
+            raise APIException(f"Can't chat with {character}")
+
+        with unittest.mock.patch("gensim.server.chat_with", chat_with):
+            status, _, _ = call(
+                "/api/event/trigger/chat/", "POST", body=b'{"character": "Alice"}'
+            )
+        self.assertEqual(status, 400)
+        _, _, body = call("/api/character/player/")
+        self.assertEqual(json.loads(body)["location_name"], "location_0")
+
+    def test_debug_memory(self):
+        status, _, body = call("/api/debug/memory", query_string="limit=2")
+        self.assertEqual(status, 200)
+        self.assertIn(SAVE, json.loads(body)["games"])
+        status, _, _ = call("/api/debug/memory", query_string="limit=all")
+        self.assertEqual(status, 400)
+
+    def test_save_status(self):
+        status, _, _ = call("/api/game/save/status/")
+        self.assertEqual(status, 404)
+        with unittest.mock.patch(
+            "gensim.management.db.background_save_status",
+            return_value={"slot": 3, "status": "done"},
+        ):
+            status, _, body = call("/api/game/save/status/")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["status"], "done")
+
+    def test_load_autosave(self):
+        loaded = Game(unittest.mock.MagicMock())
+        with unittest.mock.patch(
+            "gensim.management.db.load_game"
+        ) as load_game, unittest.mock.patch(
+            "gensim.server.open_game", return_value=loaded
+        ):
+            status, _, _ = call("/api/game/load/autosave-other-2/")
+            self.assertEqual(status, 200)
+            load_game.assert_called_once_with("autosave-other-2", save=SAVE)
+            status, _, _ = call("/api/game/load/nothing/")
+            self.assertEqual(status, 404)
+
+    def test_fork(self):
+        wsgi_app.games.set("fork-hosted", Game(unittest.mock.MagicMock()))
+        self.addCleanup(wsgi_app.games.close, "fork-hosted")
+        with unittest.mock.patch("gensim.management.db.fork_db") as fork_db:
+            for target, status in (
+                ("../current", 400),
+                ("1", 400),
+                ("current", 400),
+                # the source itself and the other hosted games
+                (SAVE, 409),
+                ("fork-hosted", 409),
+            ):
+                body = json.dumps({"save": target}).encode()
+                response = call("/api/game/fork/", "POST", body=body)
+                self.assertEqual(response[0], status, target)
+            fork_db.assert_not_called()
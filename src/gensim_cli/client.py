@@ -12,16 +12,26 @@ from gensim_cli import settings
 class Client(Session):
     """HTTP client. Inherits from Session"""
 
-    def __init__(self, *args, url: str = None, **kwargs):
+    def __init__(self, *args, url: str = None, save: str = None, **kwargs):
         self.BASE_URL: str = url or settings.BASE_URL
         self.URLS: dict = settings.URLS  # DEBUGGING: all urls
         self.URL_PARAMS: set = settings.URL_PARAMS
 
         self._url = self.BASE_URL
         self._res = None  # DEBUG: last response
+        # url -> (ETag, data, X-Next-Cursor) of the resources the server sent
+        # with an ETag
+        self._etags: dict = {}
+        # X-Next-Cursor of the last page of a list (check pages)
+        self._cursor = None
 
         super().__init__(*args, **kwargs)
 
+        # the server can host several games
+        save = save or settings.SAVE
+        if save:
+            self.headers["X-Gensim-Save"] = save
+
     def __getattr__(self, name):
         """Takes any attribute that is placed in settings.py PARAMS and adds it to
         the _url attribute"""
@@ -83,17 +93,34 @@ class Client(Session):
 
     # --- core methods ---
     def request(self, method, url, data=None):
-        """Base request function"""
-        res = super().request(method=method, url=url, json=data)
+        """
+        Base request function. GET requests are conditional if we have seen the
+        resource before: the server answers 304 if it didn't change and we use
+        the data we already have.
+        """
+        headers = {}
+        cached = self._etags.get(url) if method == "GET" else None
+        if cached:
+            headers["If-None-Match"] = cached[0]
+
+        res = super().request(method=method, url=url, json=data, headers=headers)
         self._res = res
 
         self._url = self.BASE_URL  # clean up
 
+        if res.status_code == 304:
+            # the cursor isn't sent again either
+            self._cursor = cached[2]
+            return cached[1]
+        self._cursor = res.headers.get("X-Next-Cursor")
         if not self.check_for_errors(res):
             if (
                 res.status_code != 204
             ):  # XXX no way around it. DELETE doesn't send a JSON response
-                return res.json()
+                data = res.json()
+                if method == "GET" and "ETag" in res.headers:
+                    self._etags[url] = (res.headers["ETag"], data, self._cursor)
+                return data
         return None
 
     # --- overriden convenience methods ---
@@ -119,6 +146,24 @@ class Client(Session):
         )  # list accepts url kwargs. so we can't add the slash
         return self.request("GET", self._url + url_params)
 
+    def pages(self, params: dict = None):
+        """
+        Yield every row of a list endpoint a page at a time, following the
+        X-Next-Cursor (list sends every row at once)
+        """
+        url = self._url
+        params = {"after": 0, **(params or {})}
+        while True:
+            self._url = url
+            rows = self.list(params)
+            if rows is None:
+                return
+            yield from rows
+            cursor = self._cursor
+            if not cursor:
+                return
+            params["after"] = cursor
+
     def delete(self, id_):  # pylint: disable=C0116
         return self.request("DELETE", self._url + f"{id_}/")
 
@@ -171,7 +216,65 @@ def shell():
             print(f"{cls.__name__}:", exc)
 
 
+class Pipeline:
+    """
+    Queue several actions and send them in one request (and one transaction
+    on the server). Nothing is saved if any of them fails.
+
+    >>> with client.pipeline() as pipe:
+    ...     pipe.action_walk("anon", "Library")
+    ...     pipe.event_loop()
+    ...     pipe.player_status()
+    >>> walked, loop, player = pipe.results
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations: list = []
+        self.results: list = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, op, **params):
+        self.operations.append({"op": op, **params})
+        return self
+
+    def execute(self):
+        self.results = self.client.batch.create(self.operations)
+        self.operations = []
+        return self.results
+
+    def event_loop(self):
+        return self.add("loop")
+
+    def trigger_event(self, name):
+        return self.add("trigger", name=name)
+
+    def action_walk(self, character, destination):
+        return self.add("walk", character=character, destination=destination)
+
+    def action_chat(self, character):
+        return self.add("chat", character=character)
+
+    def get(self, path):
+        return self.add("get", path=path)
+
+    def player_status(self):
+        return self.get("character/player")
+
+    def close_locations(self):
+        return self.get("area/close_locations")
+
+
 class GensimClient(Client):
+    def pipeline(self):
+        return Pipeline(self)
+
     def new_game(self, **kwargs):
         return self.game.create(kwargs)
 
@@ -181,9 +284,42 @@ class GensimClient(Client):
     def load_game(self, num):
         return self.game.load.get(num)
 
+    def fork_game(self, save=None):
+        """
+        Fork the game into another save (fork-<id>, a new one by default) and
+        return its id. Play it with GensimClient(save=id)
+        """
+        return self.game.fork.create({"save": save} if save else {})["save"]
+
     def event_loop(self):
         return self.event.loop.list()
 
+    def scene(self):
+        """Loop, player, characters, commands and close locations at once"""
+        # the url param would clash with this method
+        return self.kwarg("scene").list()
+
+    def event_loop_stream(self):
+        """
+        Same as event_loop but it yields (event, data) as soon as the server
+        sends them. The first one is ("loop", {time, location, characters}),
+        then ("event", completed event) and ("end", {events}).
+        """
+        url = self.event.loop.stream._url.rstrip("/")
+        self._url = self.BASE_URL  # clean up
+        with super(Client, self).request(
+            "GET", url, stream=True, headers={"Accept": "text/event-stream"}
+        ) as res:
+            self._res = res
+            if self.check_for_errors(res):
+                return
+            event = None
+            for line in res.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:") :].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:") :])
+
     def trigger_event(self, name):
         return self.event.trigger.get(name)
 
@@ -109,6 +109,14 @@ class CEnum:
 
 CEnum = CEnum()
 
+# commands sent by the server (CommandMap) -> CEnum
+SERVER_COMMANDS = {
+    "chat": "action_chat",
+    "move": "action_walk",
+    "fish": "action_fish",
+    "cook": "action_cook",
+}
+
 
 class Style(Enum, metaclass=EnumContainer):
 
@@ -246,6 +254,7 @@ class Game:
     #
     # present
     characters = []
+    close_locations = []
     # selected to execute actions
     selected = 1
 
@@ -340,8 +349,8 @@ class Game:
         # we get a raw input not a cmd so we use sindex and pass the
         # index as a string
         locations = {
-            str(index): location["name"]
-            for index, location in enumerate(self.client.area.close_locations.list())
+            str(index): location
+            for index, location in enumerate(self.close_locations)
         }
         self.pres.print_cmds(align="center", cmds=locations)
 
@@ -388,17 +397,17 @@ class Game:
         self.pres.print_line()
         self.pres.print_blank(number=2)
 
-        saves = self.client.ls_saves()
-        num = saves["num"]
+        saves = self.client.ls_saves()["saves"]
 
-        if num == 0:
+        if not saves:
             self.pres.print("No saves yet", align="center", style="title")
-        else:
-            # current
-            self.pres.print_cmd(align="left", cmds={0: "(Auto) {Date} - {Player}"})
-
-        for save in range(num - 1):
-            self.pres.print_cmd(align="left", cmds={num - 1: "{Date} - {Player}"})
+        # current
+        self.pres.print_cmd(align="left", cmds={0: "(Auto) Continue"})
+        for save in saves:
+            self.pres.print_cmd(
+                align="left",
+                cmds={save["slot"]: f"{save['time']} - {save['player']}"},
+            )
         self.pres.print_blank(number=2)
         self.pres.print_cmd(
             align="left",
@@ -410,7 +419,7 @@ class Game:
         gamenum = sinput()
         if gamenum.isnumeric():
             gamenum = int(gamenum)
-            if gamenum not in range(num + 1):
+            if gamenum != 0 and gamenum not in [save["slot"] for save in saves]:
                 self.logger_file.warning("%s is not a valid savefile number", gamenum)
                 return
 
@@ -450,7 +459,7 @@ class Game:
 
         self.pres.print_cmd(
             align="center",
-            cmds=self.client.get_cmds("main_menu"),
+            cmds=[CEnum.new_game, CEnum.load_game],
         )
 
         cmd = input()
@@ -460,38 +469,31 @@ class Game:
         while True:
             try:
                 self.pres.print_line()
-                data = self.client.event_loop()
+                # everything we show in one request
+                scene = self.client.scene()
 
                 # present location
                 self.pres.print(
-                    f"[{data['time']}] You are at {data['location']}", align="left"
+                    f"[{scene['time']}] You are at {scene['location']}", align="left"
                 )
 
                 # present environment
-                self.characters = data["characters"]  # cache
+                self.characters = [chara["name"] for chara in scene["characters"]]
+                self.close_locations = [
+                    location["name"] for location in scene["close_locations"]
+                ]
                 self.pres.print(
                     "Characters present: " + str(self.characters), align="left"
                 )
-                self.handle_events(data["events"])
-
-                # available cmds
-                available_cmds = []
-                # basic
-                available_cmds.extend(self.client.get_cmds("game"))
-                # location
-                available_cmds.extend(self.client.get_cmds(data["location"]))
-                # terrain
-                terrain = self.client.get_location
-                available_cmds.extend(self.client.get_cmds(data[""]))
+                self.handle_events(scene["events"])
 
+                # available cmds (the basic ones and the ones of the location)
                 self.pres.print_cmds(
                     align="center",
-                    cmds=self.client.get_cmds("game")
                     cmds=[
-                        CEnum.action_walk,
-                        CEnum.action_chat,
-                        CEnum.action_fish,
-                        CEnum.action_cook,
+                        getattr(CEnum, SERVER_COMMANDS[name])
+                        for name in scene["commands"]
+                        if name in SERVER_COMMANDS
                     ],
                 )
 
@@ -18,6 +18,8 @@ DEBUG = settings.DEBUG if gensim else "False"
 HOST = os.environ.get("HOST", settings.HOST if gensim else "localhost")
 PORT = os.environ.get("PORT", settings.PORT if gensim else "8000")
 BASE_URL = f"http://{HOST}:{PORT}/api/"
+# game (save id) played with this client
+SAVE = os.environ.get("GENSIM_SAVE", "current")
 
 # merely documentation
 URLS = {
@@ -25,6 +27,7 @@ URLS = {
     "game/",
     "game/load/{num}",
     "game/save/{num}",
+    "game/fork/",
     # --- event urls ---
     "event/trigger/",
     # --- character urls ---
@@ -42,10 +45,12 @@ URL_PARAMS = {
     "game",
     "load",
     "save",
+    "fork",
     #
     "event",
     "trigger",
     "loop",
+    "stream",
     #
     "action",
     "walk",
@@ -63,6 +68,8 @@ URL_PARAMS = {
     "area",
     "locations",
     "close_locations",
+    #
+    "batch",
 }
 
 # data schemes